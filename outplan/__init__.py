@@ -1,6 +1,4 @@
-from .client import ExperimentGroupClient
-from .exceptions import ExperimentBaseError
-from .experiment import ExperimentItem, GroupItem, NamespaceItem
+from typing import TYPE_CHECKING, Any
 
 __version__ = "3.0.1"
 
@@ -11,3 +9,33 @@ __all__ = (
     "ExperimentItem",
     "ExperimentBaseError",
 )
+
+# 用到时才导入,`import outplan`(比如只读取 __version__ 的命令行工具)不加载分组相关的模块
+_LAZY_ATTRS = {
+    "ExperimentGroupClient": ".client",
+    "ExperimentBaseError": ".exceptions",
+    "ExperimentItem": ".experiment",
+    "GroupItem": ".experiment",
+    "NamespaceItem": ".experiment",
+}
+
+if TYPE_CHECKING:
+    from .client import ExperimentGroupClient
+    from .exceptions import ExperimentBaseError
+    from .experiment import ExperimentItem, GroupItem, NamespaceItem
+
+
+def __getattr__(name: str) -> Any:
+    module_name = _LAZY_ATTRS.get(name)
+    if module_name is None:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+    from importlib import import_module
+
+    value = getattr(import_module(module_name, __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(list(globals()) + list(_LAZY_ATTRS))
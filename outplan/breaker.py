@@ -0,0 +1,70 @@
+"""外部依赖(lazy load、标签判断、指定分组)的熔断器,依赖持续超时或出错时直接走降级逻辑,不再拖慢每个请求。"""
+
+import threading
+import time
+from typing import Any, Dict, Optional
+
+
+class CircuitBreaker:
+    """连续失败 failure_threshold 次后打开,reset_timeout 秒内拒绝所有调用;
+    之后放行一次试探调用(半开),成功则关闭,失败则重新打开。
+    """
+
+    closed = "closed"
+    open = "open"
+    half_open = "half_open"
+
+    def __init__(self, name: str, failure_threshold: int = 5, reset_timeout: float = 30.0) -> None:
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0  # 连续失败次数
+        self.rejected = 0
+        self.opened_at: Optional[float] = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return self.closed
+
+        if self._probing or time.monotonic() - self.opened_at >= self.reset_timeout:
+            return self.half_open
+
+        return self.open
+
+    def allow(self) -> bool:
+        """是否可以调用,半开时只放行一个试探调用,调用方需要接着 record_success/record_failure"""
+        if self.opened_at is None:
+            return True
+
+        with self._lock:
+            if not self._probing and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self._probing = True
+                return True
+
+            self.rejected += 1
+            return False
+
+    def record_success(self) -> None:
+        if self.opened_at is None and not self.failures:
+            return
+
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._probing = False
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+            if self._probing or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+                self._probing = False
+
+    def stats(self) -> Dict[str, Any]:
+        return {"state": self.state, "failures": self.failures, "rejected": self.rejected}
+
+    def reinit_after_fork(self) -> None:
+        self._lock = threading.Lock()
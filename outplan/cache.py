@@ -0,0 +1,130 @@
+"""编译好的 namespace 的本地缓存,worker 启动或重新加载时跳过 from_dict 的构造、校验和 segment 抽样。"""
+
+import os
+import pickle
+import tempfile
+from typing import Callable, Iterator, Optional, Tuple
+
+from . import __version__
+from .experiment import ExperimentItem, NamespaceItem
+from .plan import MAX_CONDITIONAL_EXPERIMENTS
+
+# 缓存文件的格式版本,NamespaceItem 保存的字段变化时加一
+CACHE_FORMAT = 4
+CACHE_SUFFIX = ".pickle"
+
+
+def _iter_experiment_items(namespace_item: NamespaceItem) -> Iterator[ExperimentItem]:
+    for experiment_item in namespace_item.experiment_items:
+        yield experiment_item
+        for group_item in experiment_item.group_items:
+            for namespace in group_item.layer_namespaces:
+                yield from _iter_experiment_items(namespace)
+
+
+class CompiledNamespaceCache:
+    """按 spec 内容哈希(见 ``loader.SpecMemo.digest``)把构造好的 NamespaceItem 用 pickle 保存在本地目录
+
+    文件名里带 outplan 版本和缓存格式版本,spec 或版本变化后不会命中旧文件;文件开头的 header 读出来再校验一次,
+    读取失败或 header 不一致时当作没有缓存并删掉该文件。写入时先写临时文件再 rename,多个 worker 可以共用一个目录。
+    pickle 加载时可以执行任意代码,目录只能由服务自己写入。
+
+    Example:
+
+        >>> cache = CompiledNamespaceCache("/var/cache/outplan")
+        >>> source = FileNamespaceSource("/etc/outplan/namespaces.jsonl", cache=cache)
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        logger=None,
+        max_conditional_experiments: int = MAX_CONDITIONAL_EXPERIMENTS,
+    ) -> None:
+        self.directory = directory
+        self.logger = logger
+        self.max_conditional_experiments = max_conditional_experiments
+        self.hits = 0
+        self.misses = 0
+
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def header(digest: str) -> Tuple[int, str, str]:
+        return CACHE_FORMAT, __version__, digest
+
+    def path(self, digest: str) -> str:
+        return os.path.join(self.directory, f"{digest}-{__version__}-{CACHE_FORMAT}{CACHE_SUFFIX}")
+
+    def get(self, digest: str, tag_filter_func: Optional[Callable] = None) -> Optional[NamespaceItem]:
+        """读取缓存的 namespace,没有或者已失效时返回 None
+
+        :param tag_filter_func: 不会保存到缓存里,加载后重新设置到所有实验上
+        """
+        path = self.path(digest)
+        try:
+            with open(path, "rb") as f:
+                if pickle.load(f) != self.header(digest):
+                    raise ValueError("header mismatch")
+
+                namespace_item = pickle.load(f)
+            if not isinstance(namespace_item, NamespaceItem):
+                raise ValueError(f"unexpected object: {type(namespace_item)}")
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        except Exception as e:
+            self.misses += 1
+            self._log_error(f"compiled namespace cache broken: path: {path}, msg: {e!s}")
+            self._remove(path)
+            return None
+
+        for experiment_item in _iter_experiment_items(namespace_item):
+            experiment_item.tag_filter_func = tag_filter_func
+
+        self.hits += 1
+        return namespace_item
+
+    def set(self, digest: str, namespace_item: NamespaceItem) -> bool:
+        """计算好 segment 表后保存,返回是否保存成功,不能 pickle(比如代码里定义的 pre_condition)时不缓存"""
+        namespace_item.precompute(self.max_conditional_experiments)
+        try:
+            data = pickle.dumps(self.header(digest), protocol=pickle.HIGHEST_PROTOCOL) + pickle.dumps(
+                namespace_item, protocol=pickle.HIGHEST_PROTOCOL
+            )
+        except Exception as e:
+            self._log_error(f"compiled namespace cache dump error: namespace: {namespace_item.name}, msg: {e!s}")
+            return False
+
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, self.path(digest))
+        except OSError as e:
+            self._remove(tmp_path)
+            self._log_error(f"compiled namespace cache write error: namespace: {namespace_item.name}, msg: {e!s}")
+            return False
+
+        return True
+
+    def prune(self) -> int:
+        """删除其他 outplan 版本或缓存格式写入的文件,返回删除的文件数"""
+        suffix = f"-{__version__}-{CACHE_FORMAT}{CACHE_SUFFIX}"
+        removed = 0
+        for name in os.listdir(self.directory):
+            if name.endswith(CACHE_SUFFIX) and not name.endswith(suffix):
+                self._remove(os.path.join(self.directory, name))
+                removed += 1
+
+        return removed
+
+    def _remove(self, path: str) -> None:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def _log_error(self, msg: str) -> None:
+        if self.logger:
+            self.logger.error(msg)
@@ -1,14 +1,34 @@
-import json
+import os
+import random
+import threading
 import time
+import weakref
 from contextlib import contextmanager
-from typing import Any, Callable, Dict, Iterator, List, Optional, Union
-
-from typing_extensions import Protocol
-
-from .const import ONE_MINUTE
-from .exceptions import ExperimentValidateError
+from functools import partial
+from typing import TYPE_CHECKING, Any, Callable, Dict, Iterable, Iterator, List, Mapping, Optional, Tuple, Union
+
+try:
+    from typing import Protocol
+except ImportError:  # python < 3.8
+    from typing_extensions import Protocol  # type: ignore
+
+from .breaker import CircuitBreaker
+from .concurrency import Outcome, new_lock
+from .const import ONE_MINUTE, REQUEST_CACHE_SIZE, Hook, LazyLoadState
+from .exceptions import CircuitOpenError, ExecutorTimeoutError, ExperimentValidateError
 from .experiment import NamespaceItem, TrackingGroup
 from .local import experiment_context
+from .plan import encode_unit, export_plan, exposure_sampled
+from .registry import LazyNamespaceEntry, NamespaceRegistry, build_lazy_directory, frozen_dict, merged
+
+if TYPE_CHECKING:
+    from .loader import NamespaceLoader
+
+
+def _dumps(data: Any) -> str:
+    import json
+
+    return json.dumps(data)
 
 
 class _TrackingClient(Protocol):
@@ -21,10 +41,61 @@ class _Logger(Protocol):
     def info(self, msg: str): ...
 
 
+class _NamespaceSource(Protocol):
+    def get(self, namespace_name: str) -> Optional[NamespaceItem]: ...
+
+
+class _Executor(Protocol):
+    def map(self, func: Callable, items: Iterable[Any], timeout: Optional[float] = None) -> List[Outcome]: ...
+
+
+def track_exposure(
+    tracking_client: _TrackingClient, tracking_group: TrackingGroup, user_id: int, pdid: str, unit: Union[str, int]
+) -> None:
+    """上报分组曝光事件 user_experiment_group_info"""
+    # 按 unit 确定性采样,同一个 unit 要么一直上报,要么一直不上报
+    rate = tracking_group.exposure_sample_rate
+    if rate is not None and not exposure_sampled(encode_unit(unit), rate):
+        return
+
+    properties = dict(
+        experiment=tracking_group.experiment_trace(),
+        group=tracking_group.group_trace(),
+    )
+    # 分析时按 1 / exposure_sample_rate 加权
+    if tracking_group.exposure_sample_rate is not None:
+        properties["exposure_sample_rate"] = tracking_group.exposure_sample_rate
+
+    tracking_client.track(
+        user_id=user_id or 0,
+        pdid=pdid or "",
+        event_name="user_experiment_group_info",
+        properties=properties,
+    )
+
+
+class _DeadlineMemo(dict):
+    """包一层请求级的 eligibility_memo,没有命中时用 check 判断,结果写回请求级缓存"""
+
+    def __init__(self, shared: Dict, check: Callable[[Any], bool]) -> None:
+        super().__init__()
+        self.shared = shared
+        self.check = check
+
+    def __missing__(self, key: Tuple) -> bool:
+        try:
+            value = self.shared[key]
+        except KeyError:
+            value = self.shared[key] = self.check(key[0])
+
+        self[key] = value
+        return value
+
+
 class ExperimentGroupClient:
     """experiment group client"""
 
-    def __init__(
+    def __init__(  # noqa: PLR0913
         self,
         namespaces_items: List[NamespaceItem],
         lazy_load_namespaces_func: Optional[Callable] = None,
@@ -33,38 +104,157 @@ class ExperimentGroupClient:
         logger: Optional[_Logger] = None,
         lazy_load_expire: int = 10 * ONE_MINUTE,
         get_specified_group_func: Optional[Callable] = None,
+        namespace_source: Optional[_NamespaceSource] = None,
+        lazy_load_negative_expire: int = ONE_MINUTE,
+        request_cache_size: int = REQUEST_CACHE_SIZE,
+        executor: Optional[_Executor] = None,
+        fork_expire_jitter: float = 0.1,
+        namespace_loader: Optional["NamespaceLoader"] = None,
+        call_timeout: Optional[float] = None,
+        breaker_failure_threshold: int = 5,
+        breaker_reset_timeout: float = 30.0,
     ) -> None:
         self.namespaces_items = namespaces_items
-        self.namespaces = {namespace.name: namespace for namespace in namespaces_items}
         self.tracking_client = tracking_client
         self.logger = logger
-        self.lazy_load_namespaces: List[str] = []
         self.lazy_load_expire = lazy_load_expire
-        self._lazy_load_init_ts: Dict[str, int] = {}  # 记录 lazy load 的 namespace 初始化时间,expire 之后重新 load
-        self.lazy_load_namespace_items: Dict[str, NamespaceItem] = {}
+        # 加载失败或不存在的 namespace 在这段时间内不再调用 loader,不超过 namespace 自己的 ttl
+        self.lazy_load_negative_expire = lazy_load_negative_expire
         self.lazy_load_namespace_item_func = lazy_load_namespace_item_func
         self._get_specified_group_func = get_specified_group_func
         self.lazy_load_namespaces_func = lazy_load_namespaces_func
+        self.namespace_source = namespace_source  # 由 source 自己在后台刷新,取的时候不做过期检查
+        self.request_cache_size = request_cache_size  # 一次请求内最多缓存的分组结果数,超过时淘汰最早的
+        # 设置后并发执行多个 namespace 的 lazy load 和整棵树的标签判断,见 concurrency.GeventExecutor/ThreadExecutor
+        self.executor = executor
+        # fork 之后子进程把各个过期时间随机提前最多 ttl * fork_expire_jitter,避免所有 worker 同时重新加载
+        self.fork_expire_jitter = fork_expire_jitter
+        # lazy_load_namespace_item_func 返回 spec(dict/json)时用来构造 namespace,可以带上编译缓存
+        self.namespace_loader = namespace_loader
+        # get_tracking_group 默认的耗时预算(秒),超过时用上一次加载的 namespace、已缓存的标签判断结果或返回 None
+        # 只有设置了 executor 时才能中断正在执行的 hook,否则在每次调用 hook 之前检查
+        self.call_timeout = call_timeout
+        # 每个 hook 一个熔断器,连续超时 breaker_failure_threshold 次后 breaker_reset_timeout 秒内不再调用
+        self.breakers = {
+            hook: CircuitBreaker(hook, breaker_failure_threshold, breaker_reset_timeout)
+            for hook in (Hook.lazy_load, Hook.tag_filter, Hook.specified_group)
+        }
 
         self.validate()
 
+        # 只有写入时加锁,读取直接取当前快照
+        self._registry_lock = threading.Lock()
+        self._registry = NamespaceRegistry.create({namespace.name: namespace for namespace in namespaces_items})
+        # namespace name -> lazy load 的锁,同一个 namespace 同时只有一个调用在加载
+        self._load_locks: Dict[str, Any] = {}
+        _clients.add(self)
+
+    @property
+    def registry(self) -> NamespaceRegistry:
+        """当前的 namespace 快照"""
+        return self._registry
+
+    @property
+    def namespaces(self) -> Mapping[str, NamespaceItem]:
+        return self._registry.namespaces
+
+    @property
+    def lazy_load_directory(self) -> Mapping[str, LazyNamespaceEntry]:
+        return self._registry.lazy_load_directory
+
+    @property
+    def lazy_load_namespaces(self) -> Tuple[str, ...]:
+        return tuple(self._registry.lazy_load_directory)
+
+    @property
+    def lazy_load_namespace_items(self) -> Dict[str, NamespaceItem]:
+        return {
+            name: entry.namespace_item
+            for name, entry in self._registry.lazy_load_directory.items()
+            if entry.namespace_item is not None
+        }
+
+    @property
+    def _lazy_load_init_ts(self) -> Mapping[str, int]:
+        return self._registry.lazy_load_init_ts
+
     def refresh_key_expire_time(self, key: str, timestamp=None):
         """刷新过期时间"""
-        self._lazy_load_init_ts[key] = int(timestamp or time.time())
+        timestamp = int(timestamp or time.time())
+        with self._registry_lock:
+            registry = self._registry
+            changes: Dict[str, Any] = {"lazy_load_init_ts": merged(registry.lazy_load_init_ts, {key: timestamp})}
+            entry = registry.lazy_load_directory.get(key)
+            if entry is not None:
+                changes["lazy_load_directory"] = merged(
+                    registry.lazy_load_directory, {key: entry._replace(expire_at=timestamp + entry.ttl)}
+                )
+            self._registry = registry._replace(**changes)
 
-    def is_key_expire(self, key: str) -> bool:
-        if int(time.time()) - self._lazy_load_init_ts.get(key, 0) > self.lazy_load_expire:
+    def is_key_expire(self, key: str, registry: Optional[NamespaceRegistry] = None) -> bool:
+        registry = registry or self._registry
+        entry = registry.lazy_load_directory.get(key)
+        if entry is not None:
+            return not entry.is_fresh(time.time())
+
+        if int(time.time()) - registry.lazy_load_init_ts.get(key, 0) > self.lazy_load_expire:
             return True
 
         return False
 
-    def load_lazy_namespaces(self):
-        """加载有效的 namespace name 列表"""
+    def load_lazy_namespaces(self) -> NamespaceRegistry:
+        """加载有效的 namespace 目录,返回加载后的快照"""
         cache_key = "lazy_load_namespaces"
-        if self.is_key_expire(cache_key):
-            self.lazy_load_namespaces = self.lazy_load_namespaces_func() if self.lazy_load_namespaces_func else []
+        if not self.is_key_expire(cache_key):
+            return self._registry
+
+        listing = self.lazy_load_namespaces_func() if self.lazy_load_namespaces_func else []
+        with self._registry_lock:
+            registry = self._registry
+            self._registry = registry._replace(
+                lazy_load_directory=build_lazy_directory(listing, registry.lazy_load_directory, self.lazy_load_expire),
+                lazy_load_init_ts=merged(registry.lazy_load_init_ts, {cache_key: int(time.time())}),
+            )
+            return self._registry
+
+    def _update_lazy_entry(self, namespace_name: str, **changes):
+        with self._registry_lock:
+            registry = self._registry
+            entry = registry.lazy_load_directory.get(namespace_name)
+            # 目录已经更新,不再包含该 namespace
+            if entry is None:
+                return
+
+            self._registry = registry._replace(
+                lazy_load_directory=merged(registry.lazy_load_directory, {namespace_name: entry._replace(**changes)})
+            )
+
+    def reinit_after_fork(self) -> None:
+        """在 fork 出来的子进程里调用(已通过 os.register_at_fork 自动注册)
+
+        保留已经加载的 namespace,重建可能被父进程其他线程持有的锁(父进程的 experiment_context 由 Local 自己释放),
+        给过期时间加上随机抖动,并重启 namespace_source/tracking_client 的后台线程。
+        """
+        self._registry_lock = threading.Lock()
+        self._load_locks = {}
+
+        registry = self._registry
+        directory = {}
+        for name, entry in registry.lazy_load_directory.items():
+            directory[name] = entry._replace(expire_at=entry.expire_at - self._fork_jitter(entry.ttl))
+        init_ts = {
+            key: int(ts - self._fork_jitter(self.lazy_load_expire)) for key, ts in registry.lazy_load_init_ts.items()
+        }
+        self._registry = registry._replace(
+            lazy_load_directory=frozen_dict(directory), lazy_load_init_ts=frozen_dict(init_ts)
+        )
 
-            self.refresh_key_expire_time(cache_key)
+        for worker in (self.namespace_source, self.tracking_client, self.executor, *self.breakers.values()):
+            if callable(getattr(worker, "reinit_after_fork", None)):
+                worker.reinit_after_fork()  # type: ignore
+
+    def _fork_jitter(self, ttl: float) -> float:
+        return random.uniform(0, ttl * self.fork_expire_jitter)
 
     def validate(self):
         names = set()
@@ -74,30 +264,328 @@ class ExperimentGroupClient:
 
             names.add(namespace.name)
 
-    def get_namespace_item(self, namespace_name: str) -> NamespaceItem:
+    def _call_hook(self, hook: str, deadline: Optional[float], func: Callable, *args, **kwargs) -> Any:
+        """经过熔断器和 deadline 调用 hook,熔断时抛 CircuitOpenError,超时抛 ExecutorTimeoutError
+
+        熔断器只统计超时,hook 抛出的其他异常原样抛出。
+        没有 executor 时无法中断调用,超时的结果照常返回,但同样计入熔断器。
+        """
+        remaining = None if deadline is None else deadline - time.monotonic()
+        if remaining is not None and remaining <= 0:
+            raise ExecutorTimeoutError(f"{hook}: deadline exceeded")
+
+        breaker = self.breakers[hook]
+        if not breaker.allow():
+            raise CircuitOpenError(f"{hook}: circuit open")
+
+        call = getattr(self.executor, "call", None)
+        start = time.monotonic() if remaining is not None else 0.0
+        if remaining is not None and callable(call):
+            outcome = call(partial(func, *args, **kwargs), timeout=remaining)
+        else:
+            try:
+                outcome = Outcome(value=func(*args, **kwargs))
+            except Exception as e:
+                outcome = Outcome(error=e)
+
+        if isinstance(outcome.error, ExecutorTimeoutError) or (
+            remaining is not None and time.monotonic() - start > remaining
+        ):
+            breaker.record_failure()
+        else:
+            breaker.record_success()
+
+        if outcome.error is not None:
+            raise outcome.error
+
+        return outcome.value
+
+    def get_namespace_item(self, namespace_name: str, deadline: Optional[float] = None) -> NamespaceItem:
+        registry = self._registry
         # 代码里显式定义的实验直接返回
-        if namespace_name in self.namespaces:
-            return self.namespaces[namespace_name]
+        if namespace_name in registry.namespaces:
+            return registry.namespaces[namespace_name]
 
-        self.load_lazy_namespaces()
-        if namespace_name not in self.lazy_load_namespaces:
+        if self.namespace_source:
+            _ns = self.namespace_source.get(namespace_name)
+            if _ns:
+                return _ns
+
+        registry = self.load_lazy_namespaces()
+        entry = registry.lazy_load_directory.get(namespace_name)
+        if entry is None:
             raise ExperimentValidateError(f"Namespace {namespace_name} not found.")
 
         if not self.lazy_load_namespace_item_func:
             raise ExperimentValidateError("lazy_load_namespace_item_func not found")
 
-        # 已经 load 过 并且 没过期
-        if namespace_name in self.lazy_load_namespace_items and not self.is_key_expire(namespace_name):
-            return self.lazy_load_namespace_items[namespace_name]
+        now = time.time()
+        # 已经 load 过 并且 没过期,加载失败的结果在负缓存过期前也不再重试
+        if entry.is_fresh(now):
+            if entry.namespace_item is None:
+                raise ExperimentValidateError(f"Namespace {namespace_name} not found")
+
+            return entry.namespace_item
 
         # 过期了或者没有 load 过,需要重新 load
-        _ns = self.lazy_load_namespace_item_func(namespace_name)
+        return self._load_lazy_namespace_item_once(namespace_name, entry, deadline)
+
+    def _load_lazy_namespace_item_once(
+        self, namespace_name: str, entry: LazyNamespaceEntry, deadline: Optional[float] = None
+    ) -> NamespaceItem:
+        """同一个 namespace 同时只有一个调用在加载
+
+        有上一次加载的 namespace 时其他调用不等待,直接用旧的;还没加载过时等待正在进行的加载(不超过 deadline),
+        拿到锁之后先看是否已经被别的调用加载好了。
+        """
+        with self._registry_lock:
+            lock = self._load_locks.get(namespace_name)
+            if lock is None:
+                lock = self._load_locks[namespace_name] = new_lock()
+
+        if entry.namespace_item is not None:
+            if not lock.acquire(blocking=False):
+                return entry.namespace_item
+        elif deadline is None:
+            lock.acquire()
+        elif not lock.acquire(timeout=max(deadline - time.monotonic(), 0)):
+            raise ExecutorTimeoutError(f"{Hook.lazy_load}: deadline exceeded")
+
+        try:
+            entry = self._registry.lazy_load_directory.get(namespace_name, entry)
+            now = time.time()
+            if entry.is_fresh(now):
+                if entry.namespace_item is None:
+                    raise ExperimentValidateError(f"Namespace {namespace_name} not found")
+
+                return entry.namespace_item
+
+            return self._load_lazy_namespace_item(namespace_name, entry, now, deadline)
+        finally:
+            lock.release()
+
+    def preload_namespaces(self, namespace_names: List[str], deadline: Optional[float] = None) -> None:
+        """设置了 executor 时并发 lazy load 还没加载或已过期的 namespace,加载失败留给之后的 get_namespace_item 处理
+
+        :param deadline: ``time.monotonic()`` 的截止时间,所有 namespace 共用
+        """
+        if self.executor is None or not self.lazy_load_namespace_item_func:
+            return
+
+        registry = self.load_lazy_namespaces()
+        now = time.time()
+        pending = []
+        for namespace_name in namespace_names:
+            entry = registry.lazy_load_directory.get(namespace_name)
+            if namespace_name in registry.namespaces or entry is None or entry.is_fresh(now):
+                continue
+
+            if self.namespace_source and self.namespace_source.get(namespace_name):
+                continue
+
+            pending.append(namespace_name)
+
+        if len(pending) > 1:
+            timeout = None if deadline is None else max(deadline - time.monotonic(), 0)
+            self.executor.map(partial(self.get_namespace_item, deadline=deadline), pending, timeout=timeout)
+
+    def _load_lazy_namespace_item(
+        self, namespace_name: str, entry: LazyNamespaceEntry, now: float, deadline: Optional[float] = None
+    ) -> NamespaceItem:
+        negative_expire_at = now + min(self.lazy_load_negative_expire, entry.ttl)
+        try:
+            _ns = self._call_hook(Hook.lazy_load, deadline, self.lazy_load_namespace_item_func, namespace_name)  # type: ignore
+            if _ns and isinstance(_ns, (dict, str, bytes)):
+                _ns = self._build_namespace_item(_ns)
+        except Exception as e:
+            # 超时和熔断是暂时的,不做负缓存,下一次调用照常重试(熔断期间由熔断器直接拒绝)
+            if not isinstance(e, (ExecutorTimeoutError, CircuitOpenError)):
+                self._update_lazy_entry(
+                    namespace_name,
+                    state=LazyLoadState.failed,
+                    loaded_version=entry.version,
+                    expire_at=negative_expire_at,
+                )
+            # 加载失败时继续使用上一次加载成功的 namespace
+            if entry.namespace_item is None:
+                raise
+
+            if self.logger:
+                self.logger.error(f"lazy load namespace error: namespace_name: {namespace_name}, msg: {e!s}")
+            return entry.namespace_item
+
         if not _ns:
+            self._update_lazy_entry(
+                namespace_name,
+                state=LazyLoadState.missing,
+                namespace_item=None,
+                loaded_version=entry.version,
+                expire_at=negative_expire_at,
+            )
             raise ExperimentValidateError(f"Namespace {namespace_name} not found")
 
-        self.lazy_load_namespace_items[namespace_name] = _ns
-        self.refresh_key_expire_time(namespace_name)
-        return self.lazy_load_namespace_items[namespace_name]
+        self._update_lazy_entry(
+            namespace_name,
+            state=LazyLoadState.loaded,
+            namespace_item=_ns,
+            loaded_version=entry.version,
+            expire_at=now + entry.ttl,
+        )
+        return _ns
+
+    def _build_namespace_item(self, spec: Union[Dict[str, Any], str, bytes]) -> NamespaceItem:
+        if self.namespace_loader is None:
+            from .loader import NamespaceLoader
+
+            self.namespace_loader = NamespaceLoader()
+
+        if isinstance(spec, dict):
+            return self.namespace_loader.load_dict(spec)
+
+        return self.namespace_loader.load_json(spec)
+
+    def _assign(
+        self,
+        namespace_item: NamespaceItem,
+        unit: Union[str, int],
+        params: Dict[str, Any],
+        deadline: Optional[float] = None,
+    ) -> Optional[TrackingGroup]:
+        if self.executor is None and deadline is None:
+            return namespace_item.get_group(unit, **params)
+
+        eligibility_memo = getattr(experiment_context, "eligibility_memo", None)
+        if eligibility_memo is None:
+            eligibility_memo = {}
+
+        if self.executor is not None:
+            self._prefetch_eligibility(namespace_item, params, eligibility_memo, deadline)
+
+        if deadline is not None:
+            # 没有预先判断的实验在分组时逐个判断,每次调用标签前检查 deadline 和熔断器
+            eligibility_memo = _DeadlineMemo(eligibility_memo, partial(self._check_eligible, params, deadline))
+
+        return namespace_item.get_group_memoized(unit, params, eligibility_memo)
+
+    def _check_eligible(self, params: Dict[str, Any], deadline: Optional[float], experiment_item: Any) -> bool:
+        """逐个判断实验,deadline 已过或标签判断熔断时不再调用 tag_filter_func,带标签的实验视为不满足条件"""
+        if not experiment_item.tag_checks(params):
+            return experiment_item.is_eligible(**params)
+
+        try:
+            return self._call_hook(Hook.tag_filter, deadline, experiment_item.is_eligible, **params)
+        except (ExecutorTimeoutError, CircuitOpenError) as e:
+            if self.logger:
+                self.logger.error(f"eligibility check degraded: experiment: {experiment_item.name}, msg: {e!s}")
+            return False
+
+    def _prefetch_eligibility(
+        self,
+        namespace_item: NamespaceItem,
+        params: Dict[str, Any],
+        eligibility_memo: Dict,
+        deadline: Optional[float] = None,
+    ) -> None:
+        """并发判断整棵树里带条件的实验,结果写入 eligibility_memo,分组时直接查表
+
+        嵌套 layer 里的实验不一定会走到,会多做一些判断,换来耗时从累加变成取最大值。
+        executor 支持 map_short_circuit 时并发到每个用户标签,pre_condition 在当前线程判断。
+        超时的实验视为不满足条件;抛异常的不写入,分组时重新判断并抛出。
+        deadline 已过或标签判断熔断时不再调用 tag_filter_func,带标签的实验视为不满足条件。
+        不在时间窗口内的实验分组时不会用到,不做判断。
+        """
+        pending = {}
+        for experiment_item in namespace_item.conditional_experiments(time.time()):
+            key = experiment_item.eligibility_key(params)
+            try:
+                if key in eligibility_memo:
+                    continue
+            except TypeError:  # 参数不可哈希
+                return
+
+            pending[key] = experiment_item
+
+        if self.executor is None or not pending:
+            return
+
+        map_short_circuit = getattr(self.executor, "map_short_circuit", None)
+        if not callable(map_short_circuit) and len(pending) <= 1:
+            return
+
+        breaker = self.breakers[Hook.tag_filter]
+        timeout = None if deadline is None else deadline - time.monotonic()
+        if (timeout is not None and timeout <= 0) or not breaker.allow():
+            eligibility_memo.update((key, False) for key, item in pending.items() if item.tag_checks(params))
+            return
+
+        if callable(map_short_circuit):
+            outcomes = self._check_tags_concurrently(map_short_circuit, list(pending.values()), params, timeout)
+        else:
+            outcomes = self.executor.map(lambda item: item.is_eligible(**params), pending.values(), timeout=timeout)
+
+        timed_out = [key for key, outcome in zip(pending, outcomes) if isinstance(outcome.error, ExecutorTimeoutError)]
+        for key, outcome in zip(pending, outcomes):
+            if outcome.error is None:
+                eligibility_memo[key] = outcome.value
+
+        for key in timed_out:
+            eligibility_memo[key] = False
+            if self.logger:
+                self.logger.error(f"eligibility check timeout: experiment: {key[0].name}")
+
+        if timed_out:
+            breaker.record_failure()
+        else:
+            breaker.record_success()
+
+    @staticmethod
+    def _check_tags_concurrently(
+        map_short_circuit: Callable,
+        experiment_items: List[Any],
+        params: Dict[str, Any],
+        timeout: Optional[float] = None,
+    ) -> List[Outcome]:
+        res: List[Optional[Outcome]] = []
+        groups, indexes = [], []
+        for experiment_item in experiment_items:
+            try:
+                if callable(experiment_item.pre_condition) and not experiment_item.pre_condition(**params):
+                    res.append(Outcome(value=False))
+                    continue
+            except Exception as e:
+                res.append(Outcome(error=e))
+                continue
+
+            checks = experiment_item.tag_checks(params)
+            if not checks:
+                res.append(Outcome(value=True))
+                continue
+
+            indexes.append(len(res))
+            res.append(None)
+            groups.append((checks, experiment_item.tag_stop_value))
+
+        if groups:
+            for index, outcome in zip(indexes, map_short_circuit(groups, timeout=timeout)):
+                res[index] = outcome
+
+        return res  # type: ignore
+
+    @staticmethod
+    def _request_cache_key(
+        namespace_name: str, namespace_item: NamespaceItem, unit: Union[str, int], params: Dict[str, Any]
+    ) -> Optional[Tuple]:
+        """一次请求内分组缓存的 key,只有 pre_condition/标签会读取的参数影响分组结果,参数不可哈希时不缓存"""
+        if not unit:
+            return None
+
+        key = (namespace_name, unit, namespace_item.condition_fingerprint(params))
+        try:
+            hash(key)
+        except TypeError:
+            return None
+
+        return key
 
     def get_tracking_group(
         self,
@@ -107,9 +595,32 @@ class ExperimentGroupClient:
         pdid: str = "",
         track: bool = True,
         cache: bool = True,
+        deadline_timeout: Optional[float] = None,
         **params,
     ) -> Optional[TrackingGroup]:
-        """取分组的全局唯一标识符,带上实验链的信息"""
+        """取分组的全局唯一标识符,带上实验链的信息
+
+        :param deadline_timeout: 这次调用的耗时预算(秒),默认为 call_timeout,超过时降级而不是一直等待外部依赖。
+            不叫 timeout,pre_condition 可能会用到名为 timeout 的参数
+        """
+        deadline = self._deadline(deadline_timeout)
+        return self._get_tracking_group(namespace_name, unit, user_id, pdid, track, cache, deadline, params)
+
+    def _deadline(self, timeout: Optional[float]) -> Optional[float]:
+        timeout = self.call_timeout if timeout is None else timeout
+        return None if timeout is None else time.monotonic() + timeout
+
+    def _get_tracking_group(
+        self,
+        namespace_name: str,
+        unit: Union[str, int],
+        user_id: int,
+        pdid: str,
+        track: bool,
+        cache: bool,
+        deadline: Optional[float],
+        params: Dict[str, Any],
+    ) -> Optional[TrackingGroup]:
         try:
             allow_specify_group = experiment_context.allow_specify_group
         except AttributeError:
@@ -119,7 +630,10 @@ class ExperimentGroupClient:
         except AttributeError:
             cached_group = {}
 
-        namespace_item = self.get_namespace_item(namespace_name)
+        namespace_item = self._get_namespace_item_or_none(namespace_name, deadline)
+        if namespace_item is None:
+            return None
+
         if not unit:
             unit = {"pdid": pdid, "user_id": user_id}.get(namespace_item.unit_type, "")  # type: ignore
 
@@ -127,7 +641,60 @@ class ExperimentGroupClient:
             unit = str(unit).upper()
 
         if unit and allow_specify_group and callable(self._get_specified_group_func):
-            group = self._get_specified_group_func(
+            _tracking_group = self._get_specified_tracking_group(deadline, namespace_name, unit, user_id, pdid, params)
+            if _tracking_group:
+                if self.tracking_client and track:
+                    self._track(_tracking_group, user_id, pdid, unit)
+                return _tracking_group
+
+        params["user_id"], params["pdid"] = user_id, pdid
+        key = self._request_cache_key(namespace_name, namespace_item, unit, params) if cache else None
+        if key is not None and key in cached_group:
+            return cached_group[key]
+
+        tracking_group = self._assign(namespace_item, unit, params, deadline)
+        if not tracking_group:
+            return None
+
+        if key is not None:
+            if len(cached_group) >= self.request_cache_size:
+                del cached_group[next(iter(cached_group))]
+
+            cached_group[key] = tracking_group
+
+        if not track or not any([user_id, pdid]) or not self.tracking_client:
+            return tracking_group
+
+        self._track(tracking_group, user_id, pdid, unit)
+        return tracking_group
+
+    def _get_namespace_item_or_none(self, namespace_name: str, deadline: Optional[float]) -> Optional[NamespaceItem]:
+        """lazy load 超时或熔断,并且没有上一次加载的 namespace 可以降级使用时返回 None"""
+        try:
+            return self.get_namespace_item(namespace_name, deadline)
+        except (ExecutorTimeoutError, CircuitOpenError) as e:
+            if self.logger:
+                self.logger.error(f"get namespace degraded: namespace_name: {namespace_name}, msg: {e!s}")
+            return None
+
+    def _track(self, tracking_group: TrackingGroup, user_id: int, pdid: str, unit: Union[str, int]) -> None:
+        track_exposure(self.tracking_client, tracking_group, user_id, pdid, unit)  # type: ignore
+
+    def _get_specified_tracking_group(
+        self,
+        deadline: Optional[float],
+        namespace_name: str,
+        unit: Union[str, int],
+        user_id: int,
+        pdid: str,
+        params: Dict[str, Any],
+    ) -> Optional[TrackingGroup]:
+        """get_specified_group_func 指定的分组,超时或熔断时不指定分组,按正常流程分组"""
+        try:
+            group = self._call_hook(
+                Hook.specified_group,
+                deadline,
+                self._get_specified_group_func,  # type: ignore
                 experiment_context,
                 namespace_name,
                 unit,
@@ -135,44 +702,15 @@ class ExperimentGroupClient:
                 pdid=pdid,
                 **params,
             )
-            if group:
-                _tracking_group = self.get_tracking_group_by_group_name(namespace_name, group)
-                if _tracking_group:
-                    if self.tracking_client and track:
-                        self.tracking_client.track(
-                            user_id=user_id or 0,
-                            pdid=pdid or "",
-                            event_name="user_experiment_group_info",
-                            properties=dict(
-                                experiment=_tracking_group.experiment_trace(),
-                                group=_tracking_group.group_trace(),
-                            ),
-                        )
-                    return _tracking_group
-
-        key = f"tracking_group{{{namespace_name}}}{{{unit}}}"
-
-        if unit and cache and key in cached_group:
-            return cached_group[key]
-
-        tracking_group = namespace_item.get_group(unit, user_id=user_id, pdid=pdid, **params)
-        if not tracking_group:
+        except (ExecutorTimeoutError, CircuitOpenError) as e:
+            if self.logger:
+                self.logger.error(f"get specified group degraded: namespace_name: {namespace_name}, msg: {e!s}")
             return None
 
-        cached_group[key] = tracking_group
-        if not track or not any([user_id, pdid]) or not self.tracking_client:
-            return tracking_group
+        if not group:
+            return None
 
-        self.tracking_client.track(
-            user_id=user_id or 0,
-            pdid=pdid or "",
-            event_name="user_experiment_group_info",
-            properties=dict(
-                experiment=tracking_group.experiment_trace(),
-                group=tracking_group.group_trace(),
-            ),
-        )
-        return tracking_group
+        return self.get_tracking_group_by_group_name(namespace_name, group)
 
     def get_group(
         self,
@@ -189,6 +727,49 @@ class ExperimentGroupClient:
 
         return tracking_group.last_group
 
+    def get_tracking_groups(
+        self,
+        namespace_names: List[str],
+        unit: Union[str, int] = "",
+        user_id: int = 0,
+        pdid: str = "",
+        track: bool = True,
+        deadline_timeout: Optional[float] = None,
+        **params,
+    ) -> List[Optional[TrackingGroup]]:
+        """一次取多个 namespace 的分组,单个 namespace 出错时返回 None,不影响其他 namespace
+
+        :param deadline_timeout: 所有 namespace 共用的耗时预算(秒),默认为 call_timeout,见 ``get_tracking_group``
+        """
+        deadline = self._deadline(deadline_timeout)
+        self.preload_namespaces(namespace_names, deadline)
+        res: List[Optional[TrackingGroup]] = []
+        for namespace_name in namespace_names:
+            try:
+                res.append(
+                    self._get_tracking_group(namespace_name, unit, user_id, pdid, track, True, deadline, dict(params))
+                )
+            except Exception as e:
+                if self.logger:
+                    self.logger.error(f"get_tracking_groups error: namespace_name: {namespace_name}, msg: {e!s}")
+                res.append(None)
+
+        return res
+
+    def assign_groups(
+        self,
+        namespace_name: str,
+        units: Any,
+        params: Optional[Mapping[str, Any]] = None,
+        trace: bool = False,
+        track: bool = False,
+    ) -> Any:
+        """对一批 unit(pandas Series、Arrow 数组或者 list)分组,默认不上报曝光,见 ``dataframe.assign_groups``"""
+        from .dataframe import assign_groups
+
+        tracking_client = self.tracking_client if track else None
+        return assign_groups(self.get_namespace_item(namespace_name), units, params, trace, tracking_client)
+
     def get_tracking_group_by_group_name(self, namespace_name: str, group_name: str) -> Optional[TrackingGroup]:
         """根据实验组名获取tracking_group"""
         namespace_item = self.get_namespace_item(namespace_name)  # type: NamespaceItem
@@ -202,11 +783,35 @@ class ExperimentGroupClient:
             )
         return None
 
+    def export_plan(self, namespace_names: Optional[List[str]] = None, **kwargs) -> Dict[str, Any]:
+        """导出 namespace 的分组计划,默认导出代码里显式定义的 namespace,参数见 ``plan.export_plan``"""
+        if namespace_names is None:
+            namespace_names = list(self.namespaces)
+
+        return export_plan([self.get_namespace_item(name) for name in namespace_names], **kwargs)
+
     def add_namespace(self, namespace_item: NamespaceItem):
-        if namespace_item.name in self.namespaces:
-            raise ExperimentValidateError("namespace name 冲突")
+        with self._registry_lock:
+            registry = self._registry
+            if namespace_item.name in registry.namespaces:
+                raise ExperimentValidateError("namespace name 冲突")
+
+            self._registry = registry._replace(
+                namespaces=merged(registry.namespaces, {namespace_item.name: namespace_item})
+            )
+
+    def replace_namespaces(self, namespaces_items: List[NamespaceItem]):
+        """整体替换代码里定义的 namespace,读取方要么看到替换前的全部,要么看到替换后的全部"""
+        namespaces: Dict[str, NamespaceItem] = {}
+        for namespace_item in namespaces_items:
+            if namespace_item.name in namespaces:
+                raise ExperimentValidateError("namespace name 冲突")
 
-        self.namespaces[namespace_item.name] = namespace_item
+            namespaces[namespace_item.name] = namespace_item
+
+        with self._registry_lock:
+            self._registry = self._registry._replace(namespaces=frozen_dict(namespaces))
+            self.namespaces_items = list(namespaces_items)
 
     def setup_experiment_context(
         self,
@@ -224,6 +829,8 @@ class ExperimentGroupClient:
         experiment_context.allow_specify_group = allow_specify_group
 
         experiment_context.cached_group = {}  # 在一次请求生命周期内用于缓存分组结果
+        # 在一次请求生命周期内缓存 pre_condition/标签的判断结果,见 ExperimentItem.is_eligible_memoized
+        experiment_context.eligibility_memo = {}
 
         experiment_context.update(kwargs)
 
@@ -256,7 +863,7 @@ class ExperimentGroupClient:
             # 这里需要被 fallback 到 control 组
             if self.logger:
                 self.logger.error(
-                    f"auto_group error: namespace_name: {namespace_name}, msg: {e!s}, params: {json.dumps(params)}",
+                    f"auto_group error: namespace_name: {namespace_name}, msg: {e!s}, params: {_dumps(params)}",
                 )
             yield None
 
@@ -272,7 +879,7 @@ class ExperimentGroupClient:
         except Exception as e:
             if self.logger:
                 self.logger.error(
-                    f"auto_tracking_group error: namespace_name: {namespace_name}, msg: {e!s}, params: {json.dumps(params)}",  # noqa: E501
+                    f"auto_tracking_group error: namespace_name: {namespace_name}, msg: {e!s}, params: {_dumps(params)}",  # noqa: E501
                 )
             yield None
 
@@ -290,7 +897,7 @@ class ExperimentGroupClient:
         except Exception as e:
             if self.logger and experiment_error:
                 self.logger.error(
-                    f"auto_tracking_group error: namespace_name: {namespace_name}, msg: {e!s}, params: {json.dumps(params)}",  # noqa: E501
+                    f"auto_tracking_group error: namespace_name: {namespace_name}, msg: {e!s}, params: {_dumps(params)}",  # noqa: E501
                 )
 
             # 实验错误需要被 fallback 到 control 组
@@ -315,9 +922,25 @@ class ExperimentGroupClient:
             # 这里需要被 fallback 到 control 组
             if self.logger and experiment_error:
                 self.logger.error(
-                    f"auto_group error: namespace_name: {namespace_name}, msg: {e!s}, params: {json.dumps(params)}",
+                    f"auto_group error: namespace_name: {namespace_name}, msg: {e!s}, params: {_dumps(params)}",
                 )
             if experiment_error:
                 yield None
             else:
                 raise e
+
+
+_clients: "weakref.WeakSet[ExperimentGroupClient]" = weakref.WeakSet()
+
+
+def _reinit_clients_after_fork() -> None:
+    for client in list(_clients):
+        try:
+            client.reinit_after_fork()
+        except Exception as e:
+            if client.logger:
+                client.logger.error(f"reinit after fork error: {e!s}")
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reinit_clients_after_fork)
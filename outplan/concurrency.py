@@ -0,0 +1,246 @@
+"""并发执行互相独立的 lazy load / 标签判断调用,I/O 耗时从累加变成取最大值。"""
+
+import sys
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, wait
+from concurrent.futures import ThreadPoolExecutor as _ThreadPool
+from typing import Any, Callable, Dict, Iterable, List, NamedTuple, Optional, Sequence, Tuple
+
+from .exceptions import ExecutorTimeoutError
+from .local import experiment_context
+
+
+class Outcome(NamedTuple):
+    value: Any = None
+    error: Optional[BaseException] = None
+
+
+class SerialExecutor:
+    """依次执行,与不设置 executor 时的行为一致"""
+
+    def call(self, func: Callable[[], Any], timeout: Optional[float] = None) -> Outcome:
+        try:
+            return Outcome(value=func())
+        except Exception as e:
+            return Outcome(error=e)
+
+    def map(self, func: Callable, items: Iterable[Any], timeout: Optional[float] = None) -> List[Outcome]:
+        res = []
+        for item in items:
+            try:
+                res.append(Outcome(value=func(item)))
+            except Exception as e:
+                res.append(Outcome(error=e))
+
+        return res
+
+
+def new_lock() -> Any:
+    """阻塞等待用的锁
+
+    gevent 没有 monkey patch threading 时,在 greenlet 里等 threading.Lock 会卡住整个线程,
+    持有锁的 greenlet 没法继续执行,这种情况下用 gevent 的 Semaphore。
+    """
+    gevent = sys.modules.get("gevent")
+    if gevent is not None:
+        from gevent import getcurrent, monkey
+
+        if not monkey.is_module_patched("threading") and getcurrent().parent is not None:
+            from gevent.lock import Semaphore
+
+            return Semaphore()
+
+    return threading.Lock()
+
+
+def _call_in_context(context: dict, func: Callable, item: Any) -> Any:
+    # 新的 greenlet 看不到调用方的 experiment_context,先复制过来,结束时释放
+    experiment_context.restore(context)
+    try:
+        return func(item)
+    finally:
+        experiment_context.release()
+
+
+def _invoke(check: Callable[[], Any]) -> Any:
+    return check()
+
+
+class ThreadExecutor:
+    """不用 gevent 的服务用有上限的线程池并发执行,超过 timeout 没有完成的调用返回 ExecutorTimeoutError
+
+    线程没法被中断,超时或已经有结果时只能取消还没开始的调用,已经在执行的调用会继续占用线程直到返回。
+    除了 ``map``,还提供 ``map_short_circuit`` 并发判断每个实验的用户标签,见 ``ExperimentItem.tag_checks``。
+
+    Example:
+
+        >>> client = ExperimentGroupClient([...], executor=ThreadExecutor(max_workers=16, timeout=0.3))
+    """
+
+    def __init__(self, max_workers: int = 16, timeout: Optional[float] = 1.0) -> None:
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self._pool = _ThreadPool(max_workers=max_workers, thread_name_prefix="outplan-executor")
+
+    @staticmethod
+    def _remaining(deadline: Optional[float]) -> Optional[float]:
+        return None if deadline is None else max(0.0, deadline - time.monotonic())
+
+    def call(self, func: Callable[[], Any], timeout: Optional[float] = None) -> Outcome:
+        """在线程池里执行一次调用,最多等待 timeout(默认为 self.timeout)"""
+        timeout = self.timeout if timeout is None else timeout
+        future = self._pool.submit(_call_in_context, experiment_context.snapshot(), _invoke, func)
+        wait([future], timeout=timeout)
+        if not future.done():
+            future.cancel()
+            return Outcome(error=ExecutorTimeoutError(f"not finished in {timeout}s"))
+
+        return Outcome(value=future.result()) if future.exception() is None else Outcome(error=future.exception())
+
+    def map(self, func: Callable, items: Iterable[Any], timeout: Optional[float] = None) -> List[Outcome]:
+        items = list(items)
+        if len(items) <= 1:
+            return SerialExecutor().map(func, items)
+
+        timeout = self.timeout if timeout is None else timeout
+        context = experiment_context.snapshot()
+        futures = [self._pool.submit(_call_in_context, context, func, item) for item in items]
+        wait(futures, timeout=timeout)
+
+        res = []
+        for future in futures:
+            if not future.done():
+                future.cancel()
+                res.append(Outcome(error=ExecutorTimeoutError(f"not finished in {timeout}s")))
+            elif future.exception() is not None:
+                res.append(Outcome(error=future.exception()))
+            else:
+                res.append(Outcome(value=future.result()))
+
+        return res
+
+    def map_short_circuit(
+        self, groups: Sequence[Tuple[Sequence[Callable[[], Any]], bool]], timeout: Optional[float] = None
+    ) -> List[Outcome]:
+        """并发执行所有组的判断,所有组共用一个 timeout(默认为 self.timeout)
+
+        :param groups: (判断函数列表, stop_value),某个判断的结果等于 stop_value 时该组的结果就是 stop_value,
+            取消同组还没开始的判断(AND 为 False,OR 为 True);全部判断完仍没有时结果为 not stop_value
+        """
+        if sum(len(checks) for checks, _ in groups) <= 1:
+            return [self._short_circuit_serial(checks, stop_value) for checks, stop_value in groups]
+
+        timeout = self.timeout if timeout is None else timeout
+        context = experiment_context.snapshot()
+        deadline = None if timeout is None else time.monotonic() + timeout
+        res: List[Optional[Outcome]] = [None] * len(groups)
+        remaining = [len(checks) for checks, _ in groups]
+        owners: Dict[Future, int] = {}
+        for index, (checks, stop_value) in enumerate(groups):
+            if not checks:
+                res[index] = Outcome(value=not stop_value)
+            for check in checks:
+                owners[self._pool.submit(_call_in_context, context, _invoke, check)] = index
+
+        pending = set(owners)
+        while pending:
+            done, pending = wait(pending, timeout=self._remaining(deadline), return_when=FIRST_COMPLETED)
+            if not done:
+                break
+
+            for future in done:
+                index = owners[future]
+                if res[index] is not None:
+                    continue
+
+                stop_value = groups[index][1]
+                if future.exception() is not None:
+                    res[index] = Outcome(error=future.exception())
+                elif bool(future.result()) == stop_value:
+                    res[index] = Outcome(value=stop_value)
+                else:
+                    remaining[index] -= 1
+                    if not remaining[index]:
+                        res[index] = Outcome(value=not stop_value)
+
+            # 已经有结果的组不再等待
+            for future in [future for future in pending if res[owners[future]] is not None]:
+                future.cancel()
+                pending.discard(future)
+
+        for future in pending:
+            future.cancel()
+
+        timeout_error = ExecutorTimeoutError(f"not finished in {timeout}s")
+        return [outcome if outcome is not None else Outcome(error=timeout_error) for outcome in res]
+
+    @staticmethod
+    def _short_circuit_serial(checks: Sequence[Callable[[], Any]], stop_value: bool) -> Outcome:
+        try:
+            for check in checks:
+                if bool(check()) == stop_value:
+                    return Outcome(value=stop_value)
+        except Exception as e:
+            return Outcome(error=e)
+
+        return Outcome(value=not stop_value)
+
+    def reinit_after_fork(self) -> None:
+        """fork 之后子进程里没有线程池的线程,重新创建"""
+        self._pool = _ThreadPool(max_workers=self.max_workers, thread_name_prefix="outplan-executor")
+
+    def shutdown(self) -> None:
+        self._pool.shutdown(wait=False)
+
+
+class GeventExecutor:
+    """用有上限的 greenlet pool 并发执行,超过 timeout 没有完成的调用被 kill 并返回 ExecutorTimeoutError
+
+    子 greenlet 里可以读取调用方的 experiment_context(浅拷贝,请求级缓存等对象是共享的)。
+
+    Example:
+
+        >>> client = ExperimentGroupClient([...], executor=GeventExecutor(pool_size=16, timeout=0.3))
+    """
+
+    def __init__(self, pool_size: int = 16, timeout: Optional[float] = 1.0) -> None:
+        try:
+            import gevent
+            import gevent.pool
+        except ImportError:
+            raise ImportError("GeventExecutor requires gevent, install with `pip install outplan[gevent]`")
+
+        self._gevent = gevent
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self._pool = gevent.pool.Pool(pool_size)
+
+    def call(self, func: Callable[[], Any], timeout: Optional[float] = None) -> Outcome:
+        """在 pool 里执行一次调用,超过 timeout(默认为 self.timeout)时 kill"""
+        greenlet = self._pool.spawn(_call_in_context, experiment_context.snapshot(), _invoke, func)
+        return self._collect([greenlet], self.timeout if timeout is None else timeout)[0]
+
+    def map(self, func: Callable, items: Iterable[Any], timeout: Optional[float] = None) -> List[Outcome]:
+        items = list(items)
+        if len(items) <= 1:
+            return SerialExecutor().map(func, items)
+
+        context = experiment_context.snapshot()
+        greenlets = [self._pool.spawn(_call_in_context, context, func, item) for item in items]
+        return self._collect(greenlets, self.timeout if timeout is None else timeout)
+
+    def _collect(self, greenlets: List[Any], timeout: Optional[float]) -> List[Outcome]:
+        self._gevent.joinall(greenlets, timeout=timeout)
+
+        res = []
+        for greenlet in greenlets:
+            if not greenlet.ready():
+                greenlet.kill(block=False)
+                res.append(Outcome(error=ExecutorTimeoutError(f"not finished in {timeout}s")))
+            elif greenlet.successful():
+                res.append(Outcome(value=greenlet.value))
+            else:
+                res.append(Outcome(error=greenlet.exception))
+
+        return res
@@ -12,3 +12,23 @@ class UserTagFilterType:
 
 ONE_MINUTE = 60
 ONE_HOUR = ONE_MINUTE * 60
+
+# 一次请求内最多缓存的分组结果数
+REQUEST_CACHE_SIZE = 1024
+
+
+class LazyLoadState:
+    """lazy load namespace 的加载状态"""
+
+    unloaded = 0
+    loaded = 1
+    missing = 2  # lazy_load_namespace_item_func 没有返回 namespace
+    failed = 3  # lazy_load_namespace_item_func 抛了异常
+
+
+class Hook:
+    """ExperimentGroupClient 调用的外部依赖,每个对应一个熔断器"""
+
+    lazy_load = "lazy_load"  # lazy_load_namespace_item_func
+    tag_filter = "tag_filter"  # 实验的 pre_condition/tag_filter_func,只在设置了 executor 时并发判断
+    specified_group = "specified_group"  # get_specified_group_func
@@ -0,0 +1,213 @@
+"""批量分组:对 pandas Series / Arrow 数组里的 unit 一次算出分组列,用于 notebook 和离线分析。
+
+pandas 和 pyarrow 都是可选依赖,只有传入对应类型时才会用到,结果与输入的类型一致:
+pandas 返回 category 类型的 Series/DataFrame,Arrow 返回 DictionaryArray/Table,list 返回 list/dict。
+"""
+
+import time
+from itertools import repeat
+from typing import Any, Dict, List, Mapping, Optional, Sequence, Tuple
+
+from .experiment import NamespaceItem, TrackingGroup
+
+GROUP = "group"
+GROUP_TRACE = "group_trace"
+EXPERIMENT_TRACE = "experiment_trace"
+
+
+def _kind(values: Any) -> str:
+    module = type(values).__module__.split(".")[0]
+    return module if module in ("pandas", "pyarrow") else "python"
+
+
+def _to_list(values: Any, length: Optional[int] = None) -> List[Any]:
+    """Series/Arrow 数组/numpy 数组/list 转成 list,length 不为空时标量按行复制"""
+    if getattr(values, "ndim", None) == 0:
+        # numpy 标量/0 维数组也有 tolist,先转成 python 标量再按行复制
+        values = values.tolist()
+
+    if hasattr(values, "to_pylist"):
+        return values.to_pylist()
+
+    if hasattr(values, "tolist"):
+        return values.tolist()
+
+    if isinstance(values, (list, tuple)):
+        return list(values)
+
+    if length is None:
+        return list(values)
+
+    return [values] * length
+
+
+def leaf_group_names(namespace_item: NamespaceItem) -> List[str]:
+    """整棵树里最终的分组名(不包括带 layer 的分组),按定义的顺序去重,不同实验里常有同名的分组"""
+    names = []
+    for experiment_item in namespace_item.experiment_items:
+        for group_item in experiment_item.group_items:
+            if group_item.layer_namespaces:
+                for namespace in group_item.layer_namespaces:
+                    names.extend(leaf_group_names(namespace))
+            else:
+                names.append(group_item.name)
+
+    return list(dict.fromkeys(names))
+
+
+def assign_tracking_groups(
+    namespace_item: NamespaceItem,
+    units: Any,
+    params: Optional[Mapping[str, Any]] = None,
+    tracking_client: Any = None,
+) -> List[Optional[TrackingGroup]]:
+    """逐行分组,与 ``client.get_tracking_group`` 的结果一致(不调用 get_specified_group_func)
+
+    unit 和会影响分组的参数(见 ``NamespaceItem.condition_fingerprint``)都相同的行只算一次,
+    pre_condition/标签的判断结果在整批里共用,实验的时间窗口按开始分组时的时间判断。
+
+    :param params: 参数名 -> 列(与 units 等长)或标量
+    :param tracking_client: 不为空时上报曝光,unit 和参数相同的行只上报一次
+    """
+    units = _to_list(units)
+    columns = {name: _to_list(values, len(units)) for name, values in (params or {}).items()}
+    for name, values in columns.items():
+        if len(values) != len(units):
+            raise ValueError(f"param {name} has {len(values)} rows, expected {len(units)}")
+
+    names = tuple(columns)
+    rows = zip(*[columns[name] for name in names]) if names else repeat(())
+    now = time.time()
+    eligibility_memo = {}  # type: Dict[Any, bool]
+    assigned = {}  # type: Dict[Tuple, Optional[TrackingGroup]]
+    res = []  # type: List[Optional[TrackingGroup]]
+    for raw_unit, row_values in zip(units, rows):
+        row = dict(zip(names, row_values))
+        # 与 client.get_tracking_group 的默认参数一致
+        row.setdefault("user_id", 0)
+        row.setdefault("pdid", "")
+        unit = raw_unit or row.get(namespace_item.unit_type, "")
+
+        if namespace_item.auto_upper_unit:
+            unit = str(unit).upper()
+
+        try:
+            key = (unit, namespace_item.condition_fingerprint(row))
+            tracking_group = assigned[key]
+        except KeyError:
+            tracking_group = assigned[key] = _assign(namespace_item, unit, row, eligibility_memo, now, tracking_client)
+        except TypeError:  # 参数不可哈希
+            tracking_group = _assign(namespace_item, unit, row, eligibility_memo, now, tracking_client)
+
+        res.append(tracking_group)
+
+    return res
+
+
+def _assign(namespace_item, unit, row, eligibility_memo, now, tracking_client):
+    # type: (NamespaceItem, Any, Dict[str, Any], Dict[Any, bool], float, Any) -> Optional[TrackingGroup]
+    tracking_group = namespace_item.get_group_memoized(unit, row, eligibility_memo, now)
+    if tracking_group is not None and tracking_client is not None:
+        from .client import track_exposure
+
+        track_exposure(tracking_client, tracking_group, row["user_id"], row["pdid"], unit)
+
+    return tracking_group
+
+
+def _encode(values: Sequence[Optional[str]], categories: Sequence[str] = ()) -> Tuple[List[int], List[str]]:
+    """转成 category 编码,None 为 -1,不在 categories 里的值按出现顺序追加,categories 里重复的值只保留第一个"""
+    categories_list = list(dict.fromkeys(categories))
+    codes_by_value = {value: code for code, value in enumerate(categories_list)}
+    codes = []
+    for value in values:
+        if value is None:
+            codes.append(-1)
+            continue
+
+        code = codes_by_value.get(value)
+        if code is None:
+            code = codes_by_value[value] = len(categories_list)
+            categories_list.append(value)
+
+        codes.append(code)
+
+    return codes, categories_list
+
+
+def assign_groups(
+    namespace_item: NamespaceItem,
+    units: Any,
+    params: Optional[Mapping[str, Any]] = None,
+    trace: bool = False,
+    tracking_client: Any = None,
+) -> Any:
+    """批量分组,返回最后一个分组名的列,不在实验内为空
+
+    Example:
+
+        >>> df["group"] = assign_groups(namespace_item, df.user_id, params={"user_id": df.user_id})
+        >>> df = df.join(assign_groups(namespace_item, df.user_id, trace=True))
+
+    :param units: pandas Series、Arrow 数组或者 list
+    :param params: pre_condition/标签用到的参数,参数名 -> 列或标量
+    :param trace: 同时返回 group_trace 和 experiment_trace,结果为 DataFrame/Table/dict
+    :param tracking_client: 默认不上报曝光,见 ``assign_tracking_groups``
+    """
+    tracking_groups = assign_tracking_groups(namespace_item, units, params, tracking_client)
+    columns = {GROUP: [tracking_group.last_group if tracking_group else None for tracking_group in tracking_groups]}
+    if trace:
+        columns[GROUP_TRACE] = [
+            tracking_group.group_trace() if tracking_group else None for tracking_group in tracking_groups
+        ]
+        columns[EXPERIMENT_TRACE] = [
+            tracking_group.experiment_trace() if tracking_group else None for tracking_group in tracking_groups
+        ]
+
+    kind = _kind(units)
+    if kind == "python":
+        return columns if trace else columns[GROUP]
+
+    encoded = {
+        name: _encode(values, leaf_group_names(namespace_item) if name == GROUP else ())
+        for name, values in columns.items()
+    }
+    if kind == "pandas":
+        return _to_pandas(units, encoded, trace)
+
+    return _to_arrow(encoded, trace)
+
+
+def _to_pandas(units: Any, encoded: Dict[str, Tuple[List[int], List[str]]], trace: bool) -> Any:
+    try:
+        import pandas as pd
+    except ImportError:
+        raise ImportError("pandas output requires pandas, install with `pip install outplan[dataframe]`")
+
+    columns = {
+        name: pd.Series(pd.Categorical.from_codes(codes, categories), index=units.index, name=name)
+        for name, (codes, categories) in encoded.items()
+    }
+    if trace:
+        return pd.DataFrame(columns, index=units.index)
+
+    return columns[GROUP]
+
+
+def _to_arrow(encoded: Dict[str, Tuple[List[int], List[str]]], trace: bool) -> Any:
+    try:
+        import pyarrow as pa
+    except ImportError:
+        raise ImportError("Arrow output requires pyarrow, install with `pip install outplan[arrow]`")
+
+    columns = {
+        name: pa.DictionaryArray.from_arrays(
+            pa.array([code if code >= 0 else None for code in codes], type=pa.int32()),
+            pa.array(categories, type=pa.string()),
+        )
+        for name, (codes, categories) in encoded.items()
+    }
+    if trace:
+        return pa.table(columns)
+
+    return columns[GROUP]
@@ -8,3 +8,19 @@ class ExperimentValidateError(ExperimentBaseError):
 
 class ExperimentGroupNotFindError(ExperimentBaseError):
     pass
+
+
+class AssignmentServerError(ExperimentBaseError):
+    pass
+
+
+class ExecutorTimeoutError(ExperimentBaseError):
+    pass
+
+
+class CircuitOpenError(ExperimentBaseError):
+    pass
+
+
+class SqlCompileError(ExperimentBaseError):
+    pass
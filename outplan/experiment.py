@@ -1,28 +1,126 @@
-import json
+import time
 from collections import namedtuple
-from decimal import Decimal
-from typing import Any, Callable, Dict, List, Optional, Tuple  # noqa
-
-from planout.experiment import DefaultExperiment
-from planout.namespace import SimpleNamespace
-from planout.ops.random import WeightedChoice
+from contextlib import nullcontext
+from functools import partial
+from typing import Any, Callable, Dict, FrozenSet, Iterator, List, Optional, Tuple  # noqa
 
 from .const import GroupResultType, UserTagFilterType
 from .exceptions import ExperimentValidateError
+from .local import experiment_context
+from .plan import (
+    MAX_CONDITIONAL_EXPERIMENTS,
+    allocate_segments,
+    choice_thresholds,
+    decode_segment_table,
+    encode_segment_table,
+    encode_unit,
+    group_salt,
+    salt_hasher,
+    salted_hash,
+    segment_masks,
+    segment_salt,
+)
+
+
+class ResultPath:
+    """一条不可变的分组结果路径,同一个 namespace 下同样的路径只有一个实例,trace 字符串只拼一次
+
+    group_names/experiment_names 与 TrackingGroup 一样从最内层到最外层排列。
+    """
+
+    __slots__ = (
+        "group_names",
+        "experiment_names",
+        "group_extra_params",
+        "exposure_sample_rate",
+        "group_trace",
+        "experiment_trace",
+    )
+
+    def __init__(self, group_names, experiment_names, group_extra_params=None, exposure_sample_rate=None):
+        # type: (Tuple[str, ...], Tuple[str, ...], Any, Optional[float]) -> None
+        self.group_names = group_names
+        self.experiment_names = experiment_names
+        self.group_extra_params = group_extra_params
+        self.exposure_sample_rate = exposure_sample_rate
+        self.group_trace = ".".join(reversed(group_names))
+        self.experiment_trace = ".".join(reversed(experiment_names))
+
+    def extend(self, group_name, experiment_name, exposure_sample_rate=None):
+        # type: (str, str, Optional[float]) -> ResultPath
+        """外面再套一层分组/实验,内层设置了曝光采样率时优先使用内层的"""
+        if self.exposure_sample_rate is not None:
+            exposure_sample_rate = self.exposure_sample_rate
+
+        return ResultPath(
+            (*self.group_names, group_name),
+            (*self.experiment_names, experiment_name),
+            self.group_extra_params,
+            exposure_sample_rate,
+        )
 
 
 class TrackingGroup:
-    """Group object with group trace info"""
+    """Group object with group trace info
+
+    get_group 返回的 TrackingGroup 只引用共享的 ResultPath,第一次访问/修改 group_names、experiment_names 时
+    才复制成自己的列表(copy-on-write),之后的 trace 按列表重新拼接。
+    """
 
     def __init__(self, group_name=None, experiment_name=None, group_extra_params=None):
-        self.group_names = []
-        self.experiment_names = []
+        self._path = None  # type: Optional[ResultPath]
+        self._group_names = []  # type: Optional[List[str]]
+        self._experiment_names = []  # type: Optional[List[str]]
         self.group_extra_params = group_extra_params
+        self.exposure_sample_rate = None  # type: Optional[float]
         if group_name:
-            self.group_names.append(group_name)
+            self._group_names.append(group_name)
 
         if experiment_name:
-            self.experiment_names.append(experiment_name)
+            self._experiment_names.append(experiment_name)
+
+    @classmethod
+    def from_path(cls, path):
+        # type: (ResultPath) -> TrackingGroup
+        tracking_group = cls.__new__(cls)
+        tracking_group._path = path
+        tracking_group._group_names = tracking_group._experiment_names = None
+        tracking_group.group_extra_params = path.group_extra_params
+        tracking_group.exposure_sample_rate = path.exposure_sample_rate
+        return tracking_group
+
+    @property
+    def path(self):
+        # type: () -> Optional[ResultPath]
+        """共享的结果路径,group_names/experiment_names 被复制(可能被修改)之后为 None"""
+        if self._group_names is None and self._experiment_names is None:
+            return self._path
+
+        return None
+
+    @property
+    def group_names(self):
+        # type: () -> List[str]
+        if self._group_names is None:
+            self._group_names = list(self._path.group_names)  # type: ignore
+
+        return self._group_names
+
+    @group_names.setter
+    def group_names(self, value):
+        self._group_names = value
+
+    @property
+    def experiment_names(self):
+        # type: () -> List[str]
+        if self._experiment_names is None:
+            self._experiment_names = list(self._path.experiment_names)  # type: ignore
+
+        return self._experiment_names
+
+    @experiment_names.setter
+    def experiment_names(self, value):
+        self._experiment_names = value
 
     def add_group_name(self, group_name):
         self.group_names.append(group_name)
@@ -32,26 +130,68 @@ class TrackingGroup:
 
     def group_trace(self):
         """分组名链"""
-        return ".".join(reversed(self.group_names))
+        if self._group_names is None:
+            return self._path.group_trace  # type: ignore
+
+        return ".".join(reversed(self._group_names))
 
     def experiment_trace(self):
         """实验链"""
-        return ".".join(reversed(self.experiment_names))
+        if self._experiment_names is None:
+            return self._path.experiment_trace  # type: ignore
+
+        return ".".join(reversed(self._experiment_names))
 
     @property
     def last_group(self):
         """最后一个分组名"""
-        return self.group_names and self.group_names[0]
+        if self._group_names is None:
+            return self._path.group_names[0]  # type: ignore
+
+        return self._group_names and self._group_names[0]
 
     @property
     def last_experiment(self):
         # type: () -> str
         """最后一个实验名"""
-        return self.experiment_names and self.experiment_names[0]
+        if self._experiment_names is None:
+            return self._path.experiment_names[0]  # type: ignore
+
+        return self._experiment_names and self._experiment_names[0]  # type: ignore
+
+
+_UNRESOLVED = object()
+
+
+def read_param_names(func, skip=()):
+    # type: (Callable, Tuple[str, ...]) -> Optional[FrozenSet[str]]
+    """从函数签名推断会读取哪些请求参数,推断不出来时返回 None
+
+    ``**ignore``/``**ignored``/``**_xxx`` 视为不读取,其他 ``**kwargs`` 可能读取任意参数。
+    """
+    import inspect
+
+    try:
+        parameters = inspect.signature(func).parameters.values()
+    except (TypeError, ValueError):
+        return None
+
+    names = set()
+    for parameter in parameters:
+        if parameter.kind == parameter.VAR_KEYWORD:
+            if not parameter.name.startswith(("ignore", "_")):
+                return None
+        elif parameter.kind != parameter.VAR_POSITIONAL and parameter.name not in skip:
+            names.add(parameter.name)
+
+    return frozenset(names)
 
 
 def generate_planout_experiment(experiment_item):
-    # type: (ExperimentItem) -> DefaultExperiment
+    # type: (ExperimentItem) -> Any
+    """生成等价的 planout 实验类,分组不再依赖 planout,用于和 planout 对照校验"""
+    from planout.experiment import DefaultExperiment
+    from planout.ops.random import WeightedChoice
 
     class _PlanoutExperiment(DefaultExperiment):
         def assign(self, params, unit, **kwargs):
@@ -66,7 +206,9 @@ def generate_planout_experiment(experiment_item):
 
 
 def generate_planout_namespace(namespace_item, valid_experiment_items):
-    # type: (NamespaceItem, List[ExperimentItem]) -> SimpleNamespace
+    # type: (NamespaceItem, List[ExperimentItem]) -> Any
+    """生成等价的 planout namespace 类,用于和 planout 对照校验"""
+    from planout.namespace import SimpleNamespace
 
     class _PlanoutNamespace(SimpleNamespace):
         def setup(self):
@@ -96,12 +238,57 @@ def get_namespace_group_names(namespace_item):
     return names
 
 
+class _TreeField:
+    """实验树的字段,构造之后重新赋值时,编译好的查表结构和缓存在下次分组时重新生成
+
+    只定义 __set__,读取时直接取实例的 __dict__,不影响分组时的性能。
+    原地修改列表(比如 ``experiment_items.append``)检测不到,需要重新赋值列表或者调用 ``NamespaceItem.flatten``
+    """
+
+    # 构造之后修改实验树时加一,namespace 分组时发现变化就重新编译
+    version = 0
+
+    def __init__(self, name):
+        # type: (str) -> None
+        self.name = name
+
+    def __set__(self, instance, value):
+        # type: (Any, Any) -> None
+        if self.name in instance.__dict__:
+            _TreeField.version += 1
+
+        instance.__dict__[self.name] = value
+
+
+def _tree_fields(*names):
+    # type: (str) -> Callable[[Any], Any]
+    def decorate(cls):
+        for name in names:
+            setattr(cls, name, _TreeField(name))
+
+        return cls
+
+    return decorate
+
+
+@_tree_fields("name", "bucket", "experiment_items", "exposure_sample_rate")
 class NamespaceItem:
     """一个 namespace 对应一个总体,里面可以有多个实验,
     但如果多个实验影响同一个结果,则多个实验必须处于同一个 namespace
     """
 
-    def __init__(self, name, experiment_items, bucket=10, unit="unit", unit_type="", auto_upper_unit=False):
+    def __init__(  # noqa: PLR0913
+        self,
+        name,
+        experiment_items,
+        bucket=10,
+        unit="unit",
+        unit_type="",
+        auto_upper_unit=False,
+        validate_group_names=True,
+        segment_allocation=None,
+        exposure_sample_rate=None,
+    ):
         if not all([name, experiment_items]):
             raise ValueError("Namespace name and experiment_items required.")
 
@@ -111,10 +298,52 @@ class NamespaceItem:
         self.unit = unit
         self.unit_type = unit_type
         self.auto_upper_unit = auto_upper_unit
-
-        self.validate()
-
-    def validate(self):
+        # 曝光事件的采样率,实验上没有设置时使用,None 表示全部上报
+        self.exposure_sample_rate = exposure_sample_rate
+        # (eligible mask, use_fast_sample) -> segment 表,第一次用到时计算
+        self._segment_tables = {}  # type: Dict[Tuple[int, bool], Tuple[int, ...]]
+        self._segment_signature = self._allocation_signature()
+        self._init_runtime_state()
+
+        self.validate(validate_group_names=validate_group_names)
+        if segment_allocation:
+            self._load_segment_allocation(segment_allocation)
+
+    def _init_runtime_state(self):
+        """不保存到编译缓存里的状态,构造和 unpickle 时生成"""
+        self._segment_hasher = salt_hasher(segment_salt(self.name))
+        self._group_hashers = [salt_hasher(group_salt(self.name, item.name)) for item in self.experiment_items]
+        # 分组 / (分组, 内层路径) -> 共享的 ResultPath,结果路径是有限的,第一次命中时创建
+        self._result_paths = {}  # type: Dict[Any, ResultPath]
+        self._condition_params = _UNRESOLVED  # type: Any
+        self._flat = None  # type: Any
+        self._compiled_version = _TreeField.version
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # hashlib 对象不能 pickle
+        for key in (
+            "_segment_hasher",
+            "_group_hashers",
+            "_result_paths",
+            "_condition_params",
+            "_flat",
+            "_compiled_version",
+        ):
+            del state[key]
+
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._init_runtime_state()
+
+    def validate(self, validate_group_names=True):
+        """校验 namespace
+
+        :param validate_group_names: 是否校验整棵树的 group name 唯一,嵌套的 namespace 可以交给最外层统一校验,
+            外层的 group name 包含了所有嵌套 namespace 的 group name
+        """
         experiment_total_bucket = 0
         experiment_names = set()
         for experiment_item in self.experiment_items:
@@ -128,6 +357,11 @@ class NamespaceItem:
         if experiment_total_bucket > self.bucket:
             raise ExperimentValidateError(f"实验({self.name})总 bucket 数小于 namespace bucket 数")
 
+        _validate_sample_rate(self.name, self.exposure_sample_rate)
+
+        if not validate_group_names:
+            return
+
         # 同一个 namespace 下的 group name 必须唯一
         group_names = get_namespace_group_names(self)
 
@@ -151,90 +385,293 @@ class NamespaceItem:
                     return experiment_item, group_object
         return None
 
-    def get_group(self, unit="", **params):  # noqa: PLR0912
+    @property
+    def condition_params(self):
+        # type: () -> Optional[Tuple[str, ...]]
+        """整棵树的 pre_condition/标签会读取的请求参数,None 表示可能读取任意参数"""
+        if self._condition_params is _UNRESOLVED:
+            names = set()  # type: Any
+            for experiment_item in self.experiment_items:
+                names = _merge_param_names(names, experiment_item.condition_params)
+                for group_item in experiment_item.group_items:
+                    for namespace in group_item.layer_namespaces:
+                        names = _merge_param_names(names, namespace.condition_params)
+
+            self._condition_params = None if names is None else tuple(sorted(names))
+
+        return self._condition_params
+
+    def condition_fingerprint(self, params):
+        # type: (Dict[str, Any]) -> Tuple
+        """请求参数里会影响分组结果的部分,用于缓存分组结果
+
+        除了 pre_condition/标签读取的参数,``use_fast_sample`` 会改变 segment 分配,也算在内
+        """
+        names = self.condition_params
+        if names is None:
+            return tuple(sorted(params.items()))
+
+        return ("use_fast_sample" in params, *[params.get(name) for name in names])
+
+    def segment_table(self, mask, fast=False):
+        # type: (int, bool) -> Tuple[int, ...]
+        """eligible mask 对应的 segment -> 实验下标(-1 为未分配),与 planout SimpleNamespace 的分配一致
+
+        :param mask: 第 i 个实验满足条件则置第 i 位
+        :param fast: 是否用 planout 的 FastSample(请求参数里有 use_fast_sample)
+        """
+        key = (mask, fast)
+        table = self._segment_tables.get(key)
+        if table is None:
+            indexes = [i for i in range(len(self.experiment_items)) if mask & (1 << i)]
+            experiments = [(self.experiment_items[i].name, self.experiment_items[i].bucket) for i in indexes]
+            table = tuple(
+                indexes[value] if value >= 0 else -1
+                for value in allocate_segments(self.name, self.bucket, experiments, fast=fast)
+            )
+            self._segment_tables[key] = table
+
+        return table
+
+    def get_group(self, unit="", **params):
+        return self.get_group_memoized(unit, params, getattr(experiment_context, "eligibility_memo", None))
+
+    def get_group_memoized(self, unit, params, eligibility_memo, now=None):
+        # type: (Any, Dict[str, Any], Optional[Dict], Optional[float]) -> Optional[TrackingGroup]
+        """同 get_group,显式传入 pre_condition/标签判断结果的缓存,见 ``ExperimentItem.is_eligible_memoized``
+
+        :param now: 判断实验时间窗口用的时间戳,为空时用当前时间
+        """
+        flat = self._flat
+        if flat is None or self._compiled_version != _TreeField.version:
+            flat = self.flatten()
+
         if not unit:
             unit = params.get(self.unit_type, "")
+            # unit 为空时嵌套的 namespace 各自按 unit_type 取 unit,逐层分组
+            if not unit:
+                return self._get_group(unit, encode_unit(unit), params, eligibility_memo, now)
+
+        if now is None:
+            now = time.time() if flat.timed else 0.0
 
-        valid_experiment_items = []
+        path = flat.assign(encode_unit(unit), params, eligibility_memo, now)
+        return None if path is None else TrackingGroup.from_path(path)
+
+    def flatten(self):
+        # type: () -> Any
+        """把整棵树编译成扁平的查表结构(见 ``flatten.FlatNamespace``),第一次分组时自动调用
+
+        编译结果缓存在 namespace 上,重新赋值实验树的字段后下次分组时自动重新编译,原地修改列表后需要手动调用。
+        """
+        from .flatten import FlatNamespace
+
+        self._reset_compiled()
+        self._flat = FlatNamespace(self)
+        return self._flat
+
+    def _allocation_signature(self):
+        # type: () -> Tuple
+        """segment 分配依赖的字段,不变时保留已经算好(或从 segment_allocation 加载)的 segment 表"""
+        return (self.name, self.bucket, tuple([(item.name, item.bucket) for item in self.experiment_items]))
+
+    def _reset_compiled(self):
+        # type: () -> None
+        """整棵树按当前的实验/分组重新生成哈希、阈值等缓存"""
+        version = _TreeField.version
+        signature = self._allocation_signature()
+        if signature != self._segment_signature:
+            self._segment_tables = {}
+            self._segment_signature = signature
+
+        self._init_runtime_state()
+        self._compiled_version = version
         for experiment_item in self.experiment_items:
-            if callable(experiment_item.pre_condition):
-                if not experiment_item.pre_condition(**params):
-                    continue
+            experiment_item._reset_compiled()
+            for group_item in experiment_item.group_items:
+                for namespace in group_item.layer_namespaces:
+                    namespace._reset_compiled()
+
+    def conditional_experiments(self, now=None):
+        # type: (Optional[float]) -> Iterator[ExperimentItem]
+        """整棵树里带 pre_condition/标签的实验
+
+        :param now: 不为空时跳过不在时间窗口内的实验(包括它下面的 layer)
+        """
+        for experiment_item in self.experiment_items:
+            if now is not None and experiment_item.has_window and not experiment_item.is_active(now):
+                continue
+
+            if experiment_item.is_conditional:
+                yield experiment_item
+
+            for group_item in experiment_item.group_items:
+                for namespace in group_item.layer_namespaces:
+                    yield from namespace.conditional_experiments(now)
+
+    def _get_group(self, unit, unit_bytes, params, eligibility_memo=None, now=None):
+        # type: (Any, bytes, Dict[str, Any], Optional[Dict], Optional[float]) -> Optional[TrackingGroup]
+        """unit_bytes 和 eligibility_memo 在整棵树里共用,嵌套的 namespace 不再重复编码/查找
 
-            if experiment_item.user_tags and experiment_item.tag_filter_func:
-                res = None
-                # 多个标签为 AND 关系
-                if experiment_item.tag_filter_type == UserTagFilterType.AND:
-                    res = True
-                    for user_tag in experiment_item.user_tags:
-                        _res = experiment_item.tag_filter_func(
-                            experiment_item.name, user_tag.tag_id, user_tag_columns=user_tag.columns, **params
-                        )
-                        if user_tag.not_in:
-                            _res = not _res
-
-                        res &= _res
-                        if not res:
-                            break
-                # 多个标签为 OR 关系
-                elif experiment_item.tag_filter_type == UserTagFilterType.OR:
-                    res = False
-                    for user_tag in experiment_item.user_tags:
-                        _res = experiment_item.tag_filter_func(
-                            experiment_item.name, user_tag.tag_id, user_tag_columns=user_tag.columns, **params
-                        )
-                        if user_tag.not_in:
-                            _res = not _res
-
-                        res |= _res
-                        if res:
-                            break
-
-                if not res:
+        :param now: 判断时间窗口用的时间戳,为空时用当前时间
+        """
+        mask = 0
+        for i, experiment_item in enumerate(self.experiment_items):
+            if experiment_item.has_window:
+                if now is None:
+                    now = time.time()
+                if not experiment_item.is_active(now):
                     continue
 
-            valid_experiment_items.append(experiment_item)
+            if experiment_item.is_eligible_memoized(params, eligibility_memo):
+                mask |= 1 << i
 
-        if not valid_experiment_items:
+        if not mask:
             return None
 
-        planout_namespace_cls = generate_planout_namespace(self, valid_experiment_items)
-        res = planout_namespace_cls(unit=unit, **params)
-        group_item = res.get('group')
-
+        table = self.segment_table(mask, fast="use_fast_sample" in params)
+        index = table[salted_hash(self._segment_hasher, unit_bytes) % self.bucket]
         # 没有通过 bucket 匹配到实验
-        if not group_item:
+        if index < 0:
+            return None
+
+        experiment_item = self.experiment_items[index]
+        group_item = experiment_item.choose_group(salted_hash(self._group_hashers[index], unit_bytes))
+        if group_item is None:
             return None
 
-        group_names, exp_names = [group_item.name], [res.get('experiment_name')]
         if group_item.result_type == GroupResultType.group:
-            return TrackingGroup(
-                group_name=group_item.name,
-                experiment_name=res.get('experiment_name'),
-                group_extra_params=group_item.extra_params,
-            )
+            path = self._result_paths.get(group_item)
+            if path is None:
+                path = self._result_paths.setdefault(
+                    group_item,
+                    ResultPath(
+                        (group_item.name,),
+                        (experiment_item.name,),
+                        group_item.extra_params,
+                        self.exposure_sample_rate_of(experiment_item),
+                    ),
+                )
+
+            return TrackingGroup.from_path(path)
         elif group_item.result_type == GroupResultType.layer:
-            # 直到取到最底层分组
-            while True:
-                _res = group_item.get_group(unit, **params)
-                # 没有通过 bucket 匹配到实验
-                if _res is None:
-                    return None
-                if isinstance(_res, TrackingGroup):
-                    for group_name, exp_name in zip(group_names, exp_names):
-                        _res.add_group_name(group_name)
-                        _res.add_experiment_name(exp_name)
-                    return _res
-                else:
-                    group_names.append(_res.get('group').name)
-                    exp_names.append(_res.get('experiment_name'))
+            _res = group_item.get_layer_group(unit, unit_bytes, params, eligibility_memo, now)
+            # 没有通过 bucket 匹配到实验
+            if _res is None:
+                return None
+
+            return self._wrap_layer_result(experiment_item, group_item, _res)
         else:
             raise NotImplementedError()
 
+    def _wrap_layer_result(self, experiment_item, group_item, tracking_group):
+        # type: (ExperimentItem, GroupItem, TrackingGroup) -> TrackingGroup
+        """内层 namespace 的结果外面套上当前的分组/实验"""
+        inner_path = tracking_group.path
+        if inner_path is None:
+            tracking_group.add_group_name(group_item.name)
+            tracking_group.add_experiment_name(experiment_item.name)
+            if tracking_group.exposure_sample_rate is None:
+                tracking_group.exposure_sample_rate = self.exposure_sample_rate_of(experiment_item)
+            return tracking_group
+
+        key = (group_item, inner_path)
+        path = self._result_paths.get(key)
+        if path is None:
+            path = self._result_paths.setdefault(
+                key,
+                inner_path.extend(group_item.name, experiment_item.name, self.exposure_sample_rate_of(experiment_item)),
+            )
+
+        return TrackingGroup.from_path(path)
+
+    def precompute(self, max_conditional_experiments=MAX_CONDITIONAL_EXPERIMENTS):
+        # type: (int) -> None
+        """提前计算整棵树的 segment 表和分组阈值,保存编译结果前调用,见 ``cache.CompiledNamespaceCache``"""
+        for mask in self._allocation_masks(max_conditional_experiments):
+            self.segment_table(mask)
+
+        for experiment_item in self.experiment_items:
+            experiment_item.precompute(max_conditional_experiments)
+
+    def _allocation_masks(self, max_conditional_experiments):
+        # type: (int) -> List[int]
+        """带条件的实验不超过 max_conditional_experiments 时返回所有组合,否则只返回所有实验都满足条件的组合"""
+        try:
+            return segment_masks(self, max_conditional_experiments)
+        except ExperimentValidateError:
+            return [(1 << len(self.experiment_items)) - 1]
+
+    def exposure_sample_rate_of(self, experiment_item):
+        # type: (ExperimentItem) -> Optional[float]
+        if experiment_item.exposure_sample_rate is not None:
+            return experiment_item.exposure_sample_rate
+
+        return self.exposure_sample_rate
+
+    def _load_segment_allocation(self, segment_allocation):
+        # type: (Dict[str, Any]) -> None
+        experiments = [[item.name, item.bucket] for item in self.experiment_items]
+        if [list(pair) for pair in segment_allocation.get("experiments", [])] != experiments:
+            raise ExperimentValidateError(f"namespace({self.name}) segment_allocation 与实验配置不一致,需要重新生成")
+
+        # namespace name 是 segment 抽样的 salt,改名后分配结果也会变
+        if segment_allocation.get("namespace") != self.name:
+            raise ExperimentValidateError(
+                f"namespace({self.name}) segment_allocation 是 namespace({segment_allocation.get('namespace')}) 的,"
+                "需要重新生成"
+            )
+
+        buckets = [item.bucket for item in self.experiment_items]
+        for mask, data in segment_allocation.get("tables", {}).items():
+            self._segment_tables[(int(mask), False)] = decode_segment_table(data, self.bucket, buckets, int(mask))
+
+    def dump_segment_allocation(self, max_conditional_experiments=MAX_CONDITIONAL_EXPERIMENTS):
+        # type: (int) -> Dict[str, Any]
+        """保存 segment 分配,from_dict 时直接加载,不需要重新抽样
+
+        带条件的实验不超过 max_conditional_experiments 时保存所有组合,否则只保存所有实验都满足条件的组合
+        """
+        masks = self._allocation_masks(max_conditional_experiments)
+        return {
+            "namespace": self.name,
+            "experiments": [[item.name, item.bucket] for item in self.experiment_items],
+            "tables": {str(mask): encode_segment_table(self.segment_table(mask)) for mask in masks},
+        }
+
+    def to_dict(self, segment_allocation=False):
+        # type: (bool) -> Dict[str, Any]
+        """from_dict 的逆操作
+
+        :param segment_allocation: 是否同时保存 segment 分配(包括嵌套的 namespace)
+        """
+        data = {
+            "name": self.name,
+            "bucket": self.bucket,
+            "unit_type": self.unit_type,
+            "auto_upper_unit": self.auto_upper_unit,
+            "experiment_items": [item.to_dict(segment_allocation=segment_allocation) for item in self.experiment_items],
+        }  # type: Dict[str, Any]
+        if self.exposure_sample_rate is not None:
+            data["exposure_sample_rate"] = self.exposure_sample_rate
+
+        if segment_allocation:
+            data["segment_allocation"] = self.dump_segment_allocation()
+
+        return data
+
+    def to_sql(self, dialect="sqlite", **kwargs):
+        """编译成在数仓里直接算分组的 SQL,参数见 ``sql.compile_namespace_sql``"""
+        from .sql import compile_namespace_sql
+
+        return compile_namespace_sql(self, dialect=dialect, **kwargs)
+
     @classmethod
     def from_json(cls, json_namespace, tag_filter_func=None):
         # type: (str, Optional[Callable]) -> NamespaceItem
 
+        import json
+
         if not json_namespace:
             raise ExperimentValidateError("json_namespace required.")
 
@@ -242,27 +679,97 @@ class NamespaceItem:
         return cls.from_dict(namespace_spec, tag_filter_func=tag_filter_func)
 
     @classmethod
-    def from_dict(cls, data, tag_filter_func=None):
-        # type: (Dict[str, Any], Optional[Callable]) -> NamespaceItem
-        return cls(
-            name=data['name'],
-            bucket=int(data.get('bucket', 10)),
-            experiment_items=[ExperimentItem.from_dict(spec, tag_filter_func) for spec in data['experiment_items']],
-            unit_type=data.get('unit_type'),
-            auto_upper_unit=data.get('auto_upper_unit', False),
-        )
+    def from_dict(cls, data, tag_filter_func=None, validate_group_names=True, memo=None):
+        # type: (Dict[str, Any], Optional[Callable], bool, Optional[Any]) -> NamespaceItem
+        """从 dict 构造 namespace
+
+        :param memo: 见 ``loader.SpecMemo``,内容相同的 spec 只构造一次
+        """
+        with memo.loading() if memo is not None else nullcontext():
+            if memo is not None:
+                namespace_item = memo.get(data, validate_group_names)
+                if namespace_item is not None:
+                    return namespace_item
+
+            namespace_item = cls(
+                name=data['name'],
+                bucket=int(data.get('bucket', 10)),
+                experiment_items=[
+                    ExperimentItem.from_dict(spec, tag_filter_func, memo=memo) for spec in data['experiment_items']
+                ],
+                unit_type=data.get('unit_type'),
+                auto_upper_unit=data.get('auto_upper_unit', False),
+                validate_group_names=validate_group_names,
+                segment_allocation=data.get('segment_allocation'),
+                exposure_sample_rate=data.get('exposure_sample_rate'),
+            )
+            if memo is not None:
+                memo.set(data, validate_group_names, namespace_item)
+
+            return namespace_item
 
 
+def _validate_sample_rate(name, sample_rate):
+    # type: (str, Optional[float]) -> None
+    if sample_rate is not None and not 0 < sample_rate <= 1:
+        raise ExperimentValidateError(f"实验({name}) exposure_sample_rate 必须在 (0, 1] 之间")
+
+
+UserTag = namedtuple("UserTag", ["tag_id", "columns", "not_in"])
+
+
+def _merge_param_names(names, other):
+    if names is None or other is None:
+        return None
+
+    return names | set(other)
+
+
+@_tree_fields(
+    "name",
+    "bucket",
+    "group_items",
+    "pre_condition",
+    "user_tags",
+    "tag_filter_func",
+    "declared_condition_params",
+    "exposure_sample_rate",
+    "start_time",
+    "end_time",
+)
 class ExperimentItem:
     """实验类"""
 
-    def __init__(self, name, bucket, group_items, pre_condition=None, user_tags=None, tag_filter_func=None):
+    def __init__(  # noqa: PLR0913
+        self,
+        name,
+        bucket,
+        group_items,
+        pre_condition=None,
+        user_tags=None,
+        tag_filter_func=None,
+        pre_condition_source=None,
+        condition_params=None,
+        exposure_sample_rate=None,
+        start_time=None,
+        end_time=None,
+    ):
         self.name = name
         self.bucket = bucket
         self.group_items = group_items  # type: List[GroupItem]
         self.pre_condition = pre_condition
+        self.pre_condition_source = pre_condition_source  # from_dict 时 pre_condition 的原始字符串
         self.tag_filter_type = UserTagFilterType.AND  # 多个 tag_ids 为 and 关系
         self.tag_filter_func = tag_filter_func
+        self._group_thresholds = None  # type: Optional[List[int]]
+        # 声明 pre_condition/tag_filter_func 会读取的请求参数,不声明时从函数签名推断
+        self.declared_condition_params = condition_params  # type: Optional[List[str]]
+        self._condition_params = _UNRESOLVED  # type: Any
+        self._condition_param_names = ()  # type: Tuple[str, ...]
+        self.exposure_sample_rate = exposure_sample_rate  # 曝光事件的采样率,None 表示使用 namespace 的设置
+        # 实验的时间窗口(unix 时间戳),[start_time, end_time) 之外视为不满足条件,None 表示不限制
+        self.start_time = start_time  # type: Optional[float]
+        self.end_time = end_time  # type: Optional[float]
 
         try:
             self.user_tags = self._parse_user_tag(user_tags)
@@ -271,7 +778,32 @@ class ExperimentItem:
 
         self.validate()
 
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_condition_params"], state["_condition_param_names"]
+        # 函数不一定能 pickle:tag_filter_func 加载时重新设置,pre_condition 从原始字符串重新 eval
+        state["tag_filter_func"] = None
+        if self.pre_condition_source:
+            state["pre_condition"] = None
+
+        return state
+
+    def __setstate__(self, state):
+        if state.get("pre_condition_source"):
+            state["pre_condition"] = eval(state["pre_condition_source"])
+
+        self.__dict__.update(state)
+        self._reset_compiled()
+
+    def _reset_compiled(self):
+        # type: () -> None
+        self._group_thresholds = None
+        self._condition_params = _UNRESOLVED
+        self._condition_param_names = ()
+
     def validate(self):
+        from decimal import Decimal
+
         group_names = set()
         for group_item in self.group_items:
             if group_item.name in group_names:
@@ -282,25 +814,223 @@ class ExperimentItem:
         if sum([Decimal(str(group.weight)) for group in self.group_items]) != 1:
             raise ExperimentValidateError(f"实验({self.name}) 分组的 weight 总数不为 1")
 
+        _validate_sample_rate(self.name, self.exposure_sample_rate)
+
+        if self.start_time is not None and self.end_time is not None and self.start_time >= self.end_time:
+            raise ExperimentValidateError(f"实验({self.name}) start_time 必须早于 end_time")
+
+    @property
+    def has_window(self):
+        # type: () -> bool
+        return self.start_time is not None or self.end_time is not None
+
+    def is_active(self, now):
+        # type: (float) -> bool
+        """now 时是否在实验的时间窗口内"""
+        return (self.start_time is None or self.start_time <= now) and (self.end_time is None or now < self.end_time)
+
+    @property
+    def is_conditional(self):
+        """是否需要根据请求参数判断能否进入该实验"""
+        return callable(self.pre_condition) or bool(self.user_tags and self.tag_filter_func)
+
+    @property
+    def condition_params(self):
+        # type: () -> Optional[FrozenSet[str]]
+        """判断能否进入实验时会读取的请求参数,None 表示可能读取任意参数"""
+        if self._condition_params is not _UNRESOLVED:
+            return self._condition_params
+
+        if self.declared_condition_params is not None:
+            names = frozenset(self.declared_condition_params)  # type: Optional[FrozenSet[str]]
+        else:
+            names = frozenset()
+            if callable(self.pre_condition):
+                names = read_param_names(self.pre_condition)
+
+            if names is not None and self.user_tags and self.tag_filter_func:
+                skip = ("experiment_name", "tag_id", "user_tag_columns")
+                tag_names = read_param_names(self.tag_filter_func, skip=skip)
+                names = None if tag_names is None else names | tag_names
+
+        self._condition_params = names
+        self._condition_param_names = tuple(sorted(names or ()))
+        return names
+
+    def condition_fingerprint(self, params):
+        # type: (Dict[str, Any]) -> Tuple
+        if self.condition_params is None:
+            return tuple(sorted(params.items()))
+
+        return tuple([params.get(name) for name in self._condition_param_names])
+
+    def eligibility_key(self, params):
+        # type: (Dict[str, Any]) -> Tuple
+        """eligibility_memo 的 key,参数不可哈希时查找会抛 TypeError"""
+        return (self, self.condition_fingerprint(params))
+
+    def is_eligible_memoized(self, params, eligibility_memo=None):
+        # type: (Dict[str, Any], Optional[Dict]) -> bool
+        """同 is_eligible,eligibility_memo 不为空时同一个实验、同样的参数只判断一次
+
+        :param eligibility_memo: ``setup_experiment_context`` 创建的请求级缓存
+        """
+        if not self.is_conditional:
+            return True
+
+        if eligibility_memo is None:
+            return self.is_eligible(**params)
+
+        key = self.eligibility_key(params)
+        try:
+            return eligibility_memo[key]
+        except KeyError:
+            pass
+        except TypeError:  # 参数不可哈希
+            return self.is_eligible(**params)
+
+        res = eligibility_memo[key] = self.is_eligible(**params)
+        return res
+
+    def precompute(self, max_conditional_experiments=MAX_CONDITIONAL_EXPERIMENTS):
+        # type: (int) -> None
+        """提前计算分组阈值和嵌套 namespace 的 segment 表"""
+        if self._group_thresholds is None:
+            self._group_thresholds = choice_thresholds([group.weight for group in self.group_items])
+
+        for group_item in self.group_items:
+            for namespace in group_item.layer_namespaces:
+                namespace.precompute(max_conditional_experiments)
+
+    @property
+    def group_thresholds(self):
+        # type: () -> List[int]
+        """每个分组的哈希值上限,见 ``plan.choice_thresholds``"""
+        if self._group_thresholds is None:
+            self._group_thresholds = choice_thresholds([group.weight for group in self.group_items])
+
+        return self._group_thresholds
+
+    def choose_group(self, value):
+        # type: (int) -> Optional[GroupItem]
+        """根据 unit 的哈希值选分组,与 planout WeightedChoice 结果一致"""
+        for group_item, threshold in zip(self.group_items, self.group_thresholds):
+            if value <= threshold:
+                return group_item
+
+        return None
+
+    def is_eligible(self, **params):
+        """请求参数是否满足实验的 pre_condition 和用户标签"""
+        if callable(self.pre_condition):
+            if not self.pre_condition(**params):
+                return False
+
+        if self.user_tags and self.tag_filter_func:
+            res = None
+            # 多个标签为 AND 关系
+            if self.tag_filter_type == UserTagFilterType.AND:
+                res = True
+                for user_tag in self.user_tags:
+                    _res = self.tag_filter_func(self.name, user_tag.tag_id, user_tag_columns=user_tag.columns, **params)
+                    if user_tag.not_in:
+                        _res = not _res
+
+                    res &= _res
+                    if not res:
+                        break
+            # 多个标签为 OR 关系
+            elif self.tag_filter_type == UserTagFilterType.OR:
+                res = False
+                for user_tag in self.user_tags:
+                    _res = self.tag_filter_func(self.name, user_tag.tag_id, user_tag_columns=user_tag.columns, **params)
+                    if user_tag.not_in:
+                        _res = not _res
+
+                    res |= _res
+                    if res:
+                        break
+
+            if not res:
+                return False
+
+        return True
+
+    @property
+    def tag_stop_value(self):
+        # type: () -> bool
+        """某个标签的判断结果等于该值时不用再判断其他标签:AND 为 False,OR 为 True"""
+        return self.tag_filter_type == UserTagFilterType.OR
+
+    def tag_checks(self, params):
+        # type: (Dict[str, Any]) -> List[Callable[[], bool]]
+        """每个用户标签一个判断(已处理 not_in),用于并发判断,见 ``concurrency.ThreadExecutor.map_short_circuit``"""
+        if not (self.user_tags and self.tag_filter_func):
+            return []
+
+        return [partial(self._check_user_tag, user_tag, params) for user_tag in self.user_tags]
+
+    def _check_user_tag(self, user_tag, params):
+        # type: (UserTag, Dict[str, Any]) -> bool
+        res = self.tag_filter_func(self.name, user_tag.tag_id, user_tag_columns=user_tag.columns, **params)
+        return not res if user_tag.not_in else bool(res)
+
     @classmethod
-    def from_dict(cls, data, tag_filter_func=None):
-        # type: (Dict[str, Any], Optional[Callable]) -> ExperimentItem
+    def from_dict(cls, data, tag_filter_func=None, memo=None):
+        # type: (Dict[str, Any], Optional[Callable], Optional[Any]) -> ExperimentItem
         return cls(
             name=data['name'],
             bucket=int(data['bucket']),
-            group_items=[GroupItem.from_dict(spec, tag_filter_func=tag_filter_func) for spec in data['group_items']],
+            group_items=[
+                GroupItem.from_dict(spec, tag_filter_func=tag_filter_func, memo=memo) for spec in data['group_items']
+            ],
             pre_condition=eval(data['pre_condition']) if data.get('pre_condition') else None,
             tag_filter_func=tag_filter_func,
             user_tags=data.get('user_tags', []),
+            pre_condition_source=data.get('pre_condition') or None,
+            condition_params=data.get('condition_params'),
+            exposure_sample_rate=data.get('exposure_sample_rate'),
+            start_time=data.get('start_time'),
+            end_time=data.get('end_time'),
         )
 
+    def to_dict(self, segment_allocation=False):
+        # type: (bool) -> Dict[str, Any]
+        if callable(self.pre_condition) and not self.pre_condition_source:
+            raise ExperimentValidateError(f"实验({self.name}) pre_condition 不是从字符串构造的,无法导出")
+
+        data = {
+            "name": self.name,
+            "bucket": self.bucket,
+            "group_items": [item.to_dict(segment_allocation=segment_allocation) for item in self.group_items],
+            "user_tags": [
+                {"id": user_tag.tag_id, "columns": user_tag.columns, "not_in": user_tag.not_in}
+                for user_tag in self.user_tags
+            ],
+        }  # type: Dict[str, Any]
+        if self.pre_condition_source:
+            data["pre_condition"] = self.pre_condition_source
+
+        if self.declared_condition_params is not None:
+            data["condition_params"] = list(self.declared_condition_params)
+
+        if self.exposure_sample_rate is not None:
+            data["exposure_sample_rate"] = self.exposure_sample_rate
+
+        if self.start_time is not None:
+            data["start_time"] = self.start_time
+
+        if self.end_time is not None:
+            data["end_time"] = self.end_time
+
+        return data
+
     @classmethod
     def _parse_user_tag(cls, user_tags):
         """解析 user_tags 信息
 
         :param user_tags: 实验指定的用户标签
         """
-        UserTag = namedtuple("UserTag", ["tag_id", "columns", "not_in"])
         if not user_tags:
             return []
 
@@ -317,6 +1047,7 @@ class ExperimentItem:
         return res
 
 
+@_tree_fields("name", "weight", "layer_namespaces", "extra_params")
 class GroupItem:
     def __init__(self, name, weight, layer_namespaces=None, extra_params=None):
         self.name = name
@@ -357,6 +1088,19 @@ class GroupItem:
         else:
             raise NotImplementedError()
 
+    def get_layer_group(self, unit, unit_bytes, params, eligibility_memo=None, now=None):
+        # type: (Any, bytes, Dict[str, Any], Optional[Dict], Optional[float]) -> Optional[TrackingGroup]
+        """与 get_group 相同,但复用外层已经编码好的 unit"""
+        for namespace in self.layer_namespaces:
+            if unit:
+                _group = namespace._get_group(unit, unit_bytes, params, eligibility_memo, now)
+            else:
+                _group = namespace.get_group(unit, **params)
+            if _group:
+                return _group
+
+        return None
+
     def get_group_by_name(self, group_name):
         # type: (str) -> Optional[GroupItem]
         if self.result_type == GroupResultType.group:
@@ -369,14 +1113,28 @@ class GroupItem:
                     return _group
         return None
 
+    def to_dict(self, segment_allocation=False):
+        # type: (bool) -> Dict[str, Any]
+        data = {"name": self.name, "weight": self.weight}  # type: Dict[str, Any]
+        if self.layer_namespaces:
+            data["layer_namespaces"] = [
+                namespace.to_dict(segment_allocation=segment_allocation) for namespace in self.layer_namespaces
+            ]
+
+        if self.extra_params is not None:
+            data["extra_params"] = self.extra_params
+
+        return data
+
     @classmethod
-    def from_dict(cls, data, tag_filter_func=None):
-        # type: (Dict[str, Any], Optional[Callable]) -> GroupItem
+    def from_dict(cls, data, tag_filter_func=None, memo=None):
+        # type: (Dict[str, Any], Optional[Callable], Optional[Any]) -> GroupItem
         return cls(
             name=data['name'],
             weight=float(data['weight']),
             layer_namespaces=[
-                NamespaceItem.from_dict(spec, tag_filter_func=tag_filter_func)
+                # 嵌套 namespace 的 group name 由最外层 namespace 一次校验
+                NamespaceItem.from_dict(spec, tag_filter_func=tag_filter_func, validate_group_names=False, memo=memo)
                 for spec in data.get('layer_namespaces', [])
             ],
             extra_params=data.get('extra_params'),
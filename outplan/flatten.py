@@ -0,0 +1,161 @@
+"""把嵌套 layer 的 namespace 树编译成扁平的查表结构,分组时不再逐层构造 TrackingGroup、拼接结果路径。
+
+每个 namespace 编译成一个节点:segment -> 实验条目的表,实验条目是 (分组 hasher, 分组阈值, 结果),
+结果为叶子分组时是从最外层到该分组的完整 ResultPath,为 layer 时是内层节点。每一层的哈希 salt 不同,
+结果依赖每一层各自的哈希,没法合并成一张以单个哈希为 key 的表,所以每层仍然各算一次哈希,
+其余的工作(构造路径、查 segment 表、选分组)都在编译时完成。
+
+带 pre_condition/标签的 namespace 只有 eligible mask 需要在请求时计算,mask 对应的 segment 表第一次用到时生成。
+不在时间窗口内的实验和不满足条件一样,不参与 segment 分配,与从 spec 里删掉该实验的分组结果一致。
+"""
+
+import math
+from bisect import bisect_left, bisect_right
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, Tuple
+
+from .experiment import ResultPath
+from .plan import salted_hash
+
+if TYPE_CHECKING:
+    from .experiment import ExperimentItem, NamespaceItem
+
+# (分组名, 实验名, 曝光采样率),从外层到内层
+_Prefix = Tuple[Tuple[str, str, Optional[float]], ...]
+_Window = Tuple[float, float, int, Tuple[Tuple[int, "ExperimentItem"], ...], Optional[Tuple[Any, ...]]]
+
+
+def _result_path(prefix: _Prefix, extra_params: Any) -> ResultPath:
+    # ResultPath 从最内层到最外层排列,曝光采样率取最内层设置了的
+    inner_first = prefix[::-1]
+    exposure_sample_rate = next((rate for _, _, rate in inner_first if rate is not None), None)
+    return ResultPath(
+        tuple([group_name for group_name, _, _ in inner_first]),
+        tuple([experiment_name for _, experiment_name, _ in inner_first]),
+        extra_params,
+        exposure_sample_rate,
+    )
+
+
+class _ExperimentEntry:
+    __slots__ = ("group_hasher", "thresholds", "outcomes")
+
+    def __init__(self, namespace_item: "NamespaceItem", index: int, prefix: _Prefix) -> None:
+        experiment_item: "ExperimentItem" = namespace_item.experiment_items[index]
+        self.group_hasher = namespace_item._group_hashers[index]
+        self.thresholds = tuple(experiment_item.group_thresholds)
+        rate = namespace_item.exposure_sample_rate_of(experiment_item)
+        outcomes: List[Any] = []
+        for group_item in experiment_item.group_items:
+            group_prefix = (*prefix, (group_item.name, experiment_item.name, rate))
+            if group_item.layer_namespaces:
+                outcomes.append(
+                    tuple([FlatNamespace(namespace, group_prefix) for namespace in group_item.layer_namespaces])
+                )
+            else:
+                outcomes.append(_result_path(group_prefix, group_item.extra_params))
+
+        self.outcomes = tuple(outcomes)
+
+
+class FlatNamespace:
+    """编译好的 namespace 树,``assign`` 的结果与 ``NamespaceItem._get_group`` 一致
+
+    实验设置了时间窗口时,按所有窗口的起止时间把时间轴切成若干区间,提前算好每个区间内生效的实验和 segment 表,
+    请求时先和当前区间的起止时间比较,跨过边界时才重新查找区间,不需要重新加载 spec。
+    """
+
+    __slots__ = (
+        "namespace_item",
+        "segment_hasher",
+        "bucket",
+        "entries",
+        "boundaries",
+        "windows",
+        "timed",
+        "_window",
+        "_tables",
+    )
+
+    def __init__(self, namespace_item: "NamespaceItem", prefix: _Prefix = ()) -> None:
+        self.namespace_item = namespace_item
+        self.segment_hasher = namespace_item._segment_hasher
+        self.bucket = namespace_item.bucket
+        experiment_items = namespace_item.experiment_items
+        self.entries = tuple(_ExperimentEntry(namespace_item, i, prefix) for i in range(len(experiment_items)))
+        # (eligible mask, use_fast_sample) -> segment 对应的实验条目
+        self._tables: Dict[Tuple[int, bool], Tuple[Optional[_ExperimentEntry], ...]] = {}
+
+        times = {t for item in experiment_items for t in (item.start_time, item.end_time) if t is not None}
+        self.boundaries = sorted(times)
+        bounds = [-math.inf, *self.boundaries, math.inf]
+        # 每个区间:(起, 止, 不带条件的生效实验 mask, 带条件的生效实验, 不带条件时的 segment 表)
+        self.windows: List[_Window] = []
+        for start, end in zip(bounds, bounds[1:]):
+            active = [(1 << i, item) for i, item in enumerate(experiment_items) if item.is_active(start)]
+            base_mask = sum([bit for bit, item in active if not item.is_conditional])
+            conditional_items = tuple([(bit, item) for bit, item in active if item.is_conditional])
+            table = self.table(base_mask, False) if base_mask and not conditional_items else None
+            self.windows.append((start, end, base_mask, conditional_items, table))
+
+        self._window = self.windows[0]
+        # 整棵树里有没有设置了时间窗口的实验,没有时分组不需要取当前时间
+        self.timed = bool(self.boundaries) or any(
+            node.timed
+            for entry in self.entries
+            for outcome in entry.outcomes
+            if isinstance(outcome, tuple)
+            for node in outcome
+        )
+
+    def table(self, mask: int, fast: bool) -> Tuple[Optional[_ExperimentEntry], ...]:
+        key = (mask, fast)
+        table = self._tables.get(key)
+        if table is None:
+            segment_table = self.namespace_item.segment_table(mask, fast=fast)
+            table = self._tables.setdefault(
+                key, tuple([self.entries[index] if index >= 0 else None for index in segment_table])
+            )
+
+        return table
+
+    def assign(
+        self, unit_bytes: bytes, params: Dict[str, Any], eligibility_memo: Optional[Dict] = None, now: float = 0.0
+    ) -> Optional[ResultPath]:
+        """分组结果的完整路径,不在实验内返回 None
+
+        :param now: 当前时间戳,整棵树都没有时间窗口时可以不传
+        """
+        window = self._window
+        if not window[0] <= now < window[1]:
+            window = self._window = self.windows[bisect_right(self.boundaries, now)]
+
+        _, _, mask, conditional_items, table = window
+        for bit, experiment_item in conditional_items:
+            if experiment_item.is_eligible_memoized(params, eligibility_memo):
+                mask |= bit
+
+        if not mask:
+            return None
+
+        if table is None or "use_fast_sample" in params:
+            table = self.table(mask, "use_fast_sample" in params)
+
+        entry = table[salted_hash(self.segment_hasher, unit_bytes) % self.bucket]
+        if entry is None:
+            return None
+
+        index = bisect_left(entry.thresholds, salted_hash(entry.group_hasher, unit_bytes))
+        if index == len(entry.outcomes):
+            return None
+
+        outcome = entry.outcomes[index]
+        if isinstance(outcome, ResultPath):
+            return outcome
+
+        # 按顺序在每个 layer 里分组,取第一个命中的
+        for node in outcome:
+            path = node.assign(unit_bytes, params, eligibility_memo, now)
+            if path is not None:
+                return path
+
+        return None
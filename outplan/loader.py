@@ -0,0 +1,177 @@
+"""批量加载 namespace spec,支持 json/jsonl 流式读取,内容相同的 spec 只构造一次。"""
+
+import hashlib
+import json
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import IO, TYPE_CHECKING, Any, Callable, Dict, Generator, Iterable, Iterator, List, Optional, Tuple, Union
+
+from .exceptions import ExperimentValidateError
+from .experiment import NamespaceItem
+
+if TYPE_CHECKING:
+    from .cache import CompiledNamespaceCache
+
+Spec = Dict[str, Any]
+
+# SpecMemo 默认最多保留的 NamespaceItem 数(包括嵌套的 layer namespace)
+DEFAULT_MEMO_SIZE = 1024
+
+
+def _scalar_fields(spec: Spec, nested_key: str) -> Spec:
+    return {key: value for key, value in spec.items() if key != nested_key}
+
+
+class SpecMemo:
+    """按 spec 内容哈希缓存构造好的 NamespaceItem
+
+    哈希自底向上计算,每个节点只序列化自己的标量字段和子节点的哈希,整棵树只需要一遍。
+    超过 max_size 时淘汰最久没有用到的,client 反复重新加载时旧版本的 spec 不会一直留在内存里。
+
+    :param max_size: 为 None 时不限制
+    """
+
+    def __init__(self, max_size: Optional[int] = DEFAULT_MEMO_SIZE) -> None:
+        self.max_size = max_size
+        self.hits = 0
+        self._items: "OrderedDict[Tuple[str, bool], NamespaceItem]" = OrderedDict()
+        self._digests: Dict[int, str] = {}  # id(spec) -> 哈希,只在一次 load 过程中有效
+        self._depth = 0
+
+    def digest(self, spec: Spec) -> str:
+        key = id(spec)
+        if key in self._digests:
+            return self._digests[key]
+
+        node = _scalar_fields(spec, "experiment_items")
+        node["experiment_items"] = [
+            dict(
+                _scalar_fields(experiment_spec, "group_items"),
+                group_items=[
+                    dict(
+                        _scalar_fields(group_spec, "layer_namespaces"),
+                        layer_namespaces=[self.digest(layer) for layer in group_spec.get("layer_namespaces", [])],
+                    )
+                    for group_spec in experiment_spec.get("group_items", [])
+                ],
+            )
+            for experiment_spec in spec.get("experiment_items", [])
+        ]
+        digest = hashlib.sha1(json.dumps(node, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+        self._digests[key] = digest
+        return digest
+
+    def get(self, spec: Spec, validate_group_names: bool) -> Optional[NamespaceItem]:
+        key = (self.digest(spec), validate_group_names)
+        namespace_item = self._items.get(key)
+        if namespace_item is not None:
+            self.hits += 1
+            self._items.move_to_end(key)
+
+        return namespace_item
+
+    def set(self, spec: Spec, validate_group_names: bool, namespace_item: NamespaceItem) -> None:
+        key = (self.digest(spec), validate_group_names)
+        self._items[key] = namespace_item
+        self._items.move_to_end(key)
+        if self.max_size is not None:
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    @contextmanager
+    def loading(self) -> Generator[None, None, None]:
+        """一次完整的 load,可以嵌套,最外层结束时清掉按 id(spec) 缓存的哈希
+
+        spec 释放后 id 可能被复用,哈希不能跨 load 使用
+        """
+        self._depth += 1
+        try:
+            yield
+        finally:
+            self._depth -= 1
+            if not self._depth:
+                self._digests.clear()
+
+    def clear(self) -> None:
+        self._items.clear()
+        self._digests.clear()
+
+
+class NamespaceLoader:
+    """从 dict/json/jsonl 构造 NamespaceItem
+
+    设置了 cache 时先按 spec 内容哈希查找编译好的 namespace,没有时构造后写入缓存。
+
+    Example:
+
+        >>> loader = NamespaceLoader(tag_filter_func=tag_filter)
+        >>> with open("namespaces.jsonl") as f:
+        >>>     client = ExperimentGroupClient(list(loader.iter_jsonl(f)))
+    """
+
+    def __init__(
+        self,
+        tag_filter_func: Optional[Callable] = None,
+        memo: Optional[SpecMemo] = None,
+        cache: Optional["CompiledNamespaceCache"] = None,
+    ) -> None:
+        self.tag_filter_func = tag_filter_func
+        self.memo = memo if memo is not None else SpecMemo()
+        self.cache = cache
+
+    def load_dict(self, spec: Spec) -> NamespaceItem:
+        with self.memo.loading():
+            if self.cache is None:
+                return NamespaceItem.from_dict(spec, tag_filter_func=self.tag_filter_func, memo=self.memo)
+
+            digest = self.memo.digest(spec)
+            namespace_item = self.cache.get(digest, tag_filter_func=self.tag_filter_func)
+            if namespace_item is None:
+                namespace_item = NamespaceItem.from_dict(spec, tag_filter_func=self.tag_filter_func, memo=self.memo)
+                self.cache.set(digest, namespace_item)
+
+            return namespace_item
+
+    def load_json(self, json_namespace: Union[str, bytes]) -> NamespaceItem:
+        if not json_namespace:
+            raise ExperimentValidateError("json_namespace required.")
+
+        return self.load_dict(json.loads(json_namespace))
+
+    def load_many(self, specs: Iterable[Spec]) -> List[NamespaceItem]:
+        return [self.load_dict(spec) for spec in specs]
+
+    def iter_jsonl(self, lines: Iterable[Union[str, bytes]]) -> Iterator[NamespaceItem]:
+        """一行一个 namespace spec,逐行构造,不需要把整个文件读进内存"""
+        for line in lines:
+            if not line.strip():
+                continue
+
+            yield self.load_json(line)
+
+    def load_stream(self, fp: IO) -> List[NamespaceItem]:
+        """读取 json 对象、json 数组或 jsonl"""
+        first_line = ""
+        for first_line in fp:
+            if first_line.strip():
+                break
+
+        stripped = first_line.strip()
+        if not stripped:
+            return []
+
+        try:
+            # jsonl: 第一行本身就是完整的 json 对象
+            spec = json.loads(stripped)
+        except ValueError:
+            data = json.loads(first_line + fp.read())
+            return self.load_many(data if isinstance(data, list) else [data])
+
+        if isinstance(spec, list):
+            return self.load_many(spec) + list(self.iter_jsonl(fp))
+
+        return [self.load_dict(spec), *self.iter_jsonl(fp)]
+
+    def load_file(self, path: str) -> List[NamespaceItem]:
+        with open(path) as f:
+            return self.load_stream(f)
@@ -0,0 +1,375 @@
+"""ExperimentGroupClient 的并发压测工具。
+
+用本地的 loader/tracker 替身在 gevent、多线程或多进程下压测分组逻辑,统计吞吐、延迟分位数、
+loader 调用次数(是否有 reload 风暴),以及压测过程中内存和 experiment_context 存储数的变化。
+
+    $ python -m outplan.loadtest --mode gevent --workers 10000 --requests 10 --namespaces 20
+    $ python -m outplan.loadtest --mode threads --workers 64 --spec-file namespaces.jsonl --lazy-load-expire 1
+"""
+
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from typing import Any, Callable, Dict, List, NamedTuple, Optional
+
+from .client import ExperimentGroupClient
+from .experiment import NamespaceItem
+from .loader import NamespaceLoader
+from .local import experiment_context
+
+MODES = ("gevent", "threads", "processes")
+
+
+class LoadTestConfig(NamedTuple):
+    mode: str = "threads"
+    workers: int = 16  # greenlet/线程数,processes 模式下为进程数
+    requests: int = 100  # 每个 worker 的请求数
+    namespaces: int = 10  # 没有 spec_file 时自动生成的 namespace 数
+    spec_file: Optional[str] = None  # json/jsonl namespace spec
+    lazy: bool = True  # 通过 lazy load 加载 namespace,否则直接传给 client
+    loader_latency: float = 0.001  # loader 替身每次调用耗时(秒)
+    lazy_load_expire: int = 600
+    leak_every: int = 0  # 每 N 个请求有一个不调用 release_context,模拟异常路径,0 表示都释放
+    sample_interval: float = 0.1  # 内存/context 采样间隔(秒)
+
+
+def synthetic_specs(num_namespaces: int) -> List[Dict[str, Any]]:
+    """生成带条件实验和嵌套 layer 的 namespace spec"""
+    specs = []
+    for i in range(num_namespaces):
+        name = f"load_ns_{i}"
+        specs.append(
+            {
+                "name": name,
+                "bucket": 100,
+                "experiment_items": [
+                    {
+                        "name": f"{name}_plain",
+                        "bucket": 50,
+                        "group_items": [
+                            {"name": f"{name}_control", "weight": 0.5},
+                            {"name": f"{name}_treatment", "weight": 0.5},
+                        ],
+                    },
+                    {
+                        "name": f"{name}_cond",
+                        "bucket": 30,
+                        "pre_condition": "lambda user_id, **ignore: user_id % 2 == 0",
+                        "group_items": [
+                            {
+                                "name": f"{name}_layer",
+                                "weight": 1,
+                                "layer_namespaces": [
+                                    {
+                                        "name": f"{name}_inner",
+                                        "bucket": 10,
+                                        "experiment_items": [
+                                            {
+                                                "name": f"{name}_inner_exp",
+                                                "bucket": 10,
+                                                "group_items": [
+                                                    {"name": f"{name}_inner_a", "weight": 0.3},
+                                                    {"name": f"{name}_inner_b", "weight": 0.7},
+                                                ],
+                                            }
+                                        ],
+                                    }
+                                ],
+                            }
+                        ],
+                    },
+                ],
+            }
+        )
+
+    return specs
+
+
+def load_spec_file(path: str) -> List[Dict[str, Any]]:
+    """读取 json 对象、json 数组或 jsonl 格式的 namespace spec"""
+    with open(path) as f:
+        content = f.read()
+
+    try:
+        data = json.loads(content)
+    except ValueError:
+        return [json.loads(line) for line in content.splitlines() if line.strip()]
+
+    return data if isinstance(data, list) else [data]
+
+
+class _Counter:
+    def __init__(self) -> None:
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def incr(self) -> None:
+        with self._lock:
+            self.value += 1
+
+
+class StandInLoader:
+    """lazy_load_namespaces_func/lazy_load_namespace_item_func 的替身,记录调用次数"""
+
+    def __init__(self, specs: List[Dict[str, Any]], latency: float = 0.0, sleep: Callable = time.sleep) -> None:
+        self.specs = {spec["name"]: spec for spec in specs}
+        self.latency = latency
+        self.sleep = sleep
+        self.loader = NamespaceLoader()
+        self.listing_calls = _Counter()
+        self.load_calls = _Counter()
+
+    def listing(self) -> List[str]:
+        self.listing_calls.incr()
+        return list(self.specs)
+
+    def load(self, namespace_name: str) -> Optional[NamespaceItem]:
+        self.load_calls.incr()
+        if self.latency:
+            self.sleep(self.latency)
+
+        spec = self.specs.get(namespace_name)
+        return self.loader.load_dict(spec) if spec else None
+
+
+class StandInTracker:
+    def __init__(self) -> None:
+        self.calls = _Counter()
+
+    def track(self, user_id, pdid, event_name, properties=None) -> None:
+        self.calls.incr()
+
+
+class StandInLogger:
+    def __init__(self) -> None:
+        self.errors = _Counter()
+
+    def error(self, msg: str) -> None:
+        self.errors.incr()
+
+    def info(self, msg: str) -> None:
+        pass
+
+
+def current_rss_kb() -> int:
+    """当前进程的常驻内存,非 linux 时退化为峰值内存"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") // 1024
+    except (OSError, ValueError, IndexError):
+        import resource
+
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def percentile(sorted_values: List[float], pct: float) -> float:
+    if not sorted_values:
+        return 0.0
+
+    index = min(len(sorted_values) - 1, int(round(pct / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+class _Sampler:
+    """后台线程定时采样内存和 experiment_context 存储数"""
+
+    def __init__(self, interval: float) -> None:
+        self.interval = interval
+        self.samples: List[Dict[str, Any]] = []
+        self._stop_event = threading.Event()
+        self._start = time.time()
+        self._thread = threading.Thread(target=self._run, name="outplan-loadtest-sampler", daemon=True)
+
+    def sample(self) -> None:
+        self.samples.append(
+            {
+                "t": round(time.time() - self._start, 3),
+                "rss_kb": current_rss_kb(),
+                "live_contexts": experiment_context.stats()["live"],
+            }
+        )
+
+    def _run(self) -> None:
+        while not self._stop_event.wait(self.interval):
+            self.sample()
+
+    def __enter__(self) -> "_Sampler":
+        self.sample()
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self._stop_event.set()
+        self._thread.join()
+        self.sample()
+
+
+class _Harness:
+    def __init__(self, config: LoadTestConfig, sleep: Callable = time.sleep) -> None:
+        self.config = config
+        specs = load_spec_file(config.spec_file) if config.spec_file else synthetic_specs(config.namespaces)
+        self.namespace_names = [spec["name"] for spec in specs]
+        self.loader = StandInLoader(specs, latency=config.loader_latency, sleep=sleep)
+        self.tracker = StandInTracker()
+        self.logger = StandInLogger()
+        if config.lazy:
+            self.client = ExperimentGroupClient(
+                [],
+                lazy_load_namespaces_func=self.loader.listing,
+                lazy_load_namespace_item_func=self.loader.load,
+                tracking_client=self.tracker,
+                logger=self.logger,
+                lazy_load_expire=config.lazy_load_expire,
+            )
+        else:
+            self.client = ExperimentGroupClient(
+                NamespaceLoader().load_many(specs), tracking_client=self.tracker, logger=self.logger
+            )
+
+        self.latencies: List[float] = []
+
+    def request(self, i: int) -> None:
+        user_id = i % 1000 + 1
+        device_id = f"device-{i}"
+        self.client.setup_experiment_context(user_id=user_id, device_id=device_id)
+        try:
+            start = time.perf_counter()
+            self.client.get_tracking_groups(self.namespace_names, unit=device_id, user_id=user_id, pdid=device_id)
+            self.latencies.append(time.perf_counter() - start)
+        finally:
+            leak_every = self.config.leak_every
+            if not (leak_every and i % leak_every == 0):
+                self.client.release_context()
+
+    def worker(self, worker_index: int) -> None:
+        base = worker_index * self.config.requests
+        for i in range(base, base + self.config.requests):
+            self.request(i)
+
+    def counts(self) -> Dict[str, int]:
+        return {
+            "requests": len(self.latencies),
+            "errors": self.logger.errors.value,
+            "listing_calls": self.loader.listing_calls.value,
+            "loader_calls": self.loader.load_calls.value,
+            "track_calls": self.tracker.calls.value,
+        }
+
+
+def _run_gevent(config: LoadTestConfig) -> "_Harness":
+    import gevent
+    import gevent.pool
+
+    harness = _Harness(config, sleep=gevent.sleep)
+    pool = gevent.pool.Pool(config.workers)
+    pool.map(harness.worker, range(config.workers))
+    return harness
+
+
+def _run_threads(config: LoadTestConfig) -> "_Harness":
+    harness = _Harness(config)
+    threads = [threading.Thread(target=harness.worker, args=(i,)) for i in range(config.workers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return harness
+
+
+_process_harness: Optional[_Harness] = None
+
+
+def _process_worker(worker_index: int) -> Dict[str, Any]:
+    # fork 出来的子进程继承父进程里已经预热的 client
+    harness = _process_harness
+    if harness is None:
+        raise RuntimeError("process worker started without a warmed-up harness")
+    harness.worker(worker_index)
+    return dict(harness.counts(), latencies=harness.latencies, rss_kb=current_rss_kb())
+
+
+def _run_processes(config: LoadTestConfig) -> Dict[str, Any]:
+    import multiprocessing
+
+    global _process_harness  # noqa: PLW0603
+    if "fork" not in multiprocessing.get_all_start_methods():
+        raise ValueError("processes mode requires the fork start method")
+
+    harness = _process_harness = _Harness(config)
+    # 父进程先预热,检验子进程能否直接用继承来的 namespace
+    harness.request(-1)
+    harness.latencies.clear()
+    warm_counts = harness.counts()
+    try:
+        with multiprocessing.get_context("fork").Pool(config.workers) as pool:
+            parts = pool.map(_process_worker, range(config.workers))
+    finally:
+        _process_harness = None
+
+    merged: Dict[str, Any] = {key: sum(part[key] for part in parts) for key in warm_counts}
+    # 子进程的 counter 是从父进程复制的,减掉预热时的调用次数
+    for key in ("listing_calls", "loader_calls", "track_calls", "errors"):
+        merged[key] -= warm_counts[key] * config.workers
+        merged[f"warmup_{key}"] = warm_counts[key]
+    merged["latencies"] = [latency for part in parts for latency in part["latencies"]]
+    merged["child_rss_kb"] = [part["rss_kb"] for part in parts]
+    return merged
+
+
+def run_load_test(config: LoadTestConfig) -> Dict[str, Any]:
+    """执行一次压测,返回报告(dict,可以直接 json.dumps)"""
+    if config.mode not in MODES:
+        raise ValueError(f"mode must be one of {MODES}")
+
+    start = time.perf_counter()
+    with _Sampler(config.sample_interval) as sampler:
+        if config.mode == "processes":
+            res = _run_processes(config)
+            latencies = res.pop("latencies")
+        else:
+            harness = _run_gevent(config) if config.mode == "gevent" else _run_threads(config)
+            res = harness.counts()
+            latencies = harness.latencies
+
+    duration = time.perf_counter() - start
+    latencies = sorted(latencies)
+    res.update(
+        config=config._asdict(),
+        duration=round(duration, 4),
+        throughput=round(len(latencies) / duration, 2) if duration else 0,
+        latency_ms={
+            name: round(percentile(latencies, pct) * 1000, 4)
+            for name, pct in (("p50", 50), ("p95", 95), ("p99", 99), ("max", 100))
+        },
+        samples=sampler.samples,
+        local_stats=experiment_context.stats(),
+    )
+    return res
+
+
+def main(argv: Optional[List[str]] = None) -> Dict[str, Any]:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    defaults = LoadTestConfig()
+    parser.add_argument("--mode", choices=MODES, default=defaults.mode)
+    parser.add_argument("--workers", type=int, default=defaults.workers)
+    parser.add_argument("--requests", type=int, default=defaults.requests)
+    parser.add_argument("--namespaces", type=int, default=defaults.namespaces)
+    parser.add_argument("--spec-file", default=defaults.spec_file)
+    parser.add_argument("--no-lazy", dest="lazy", action="store_false")
+    parser.add_argument("--loader-latency", type=float, default=defaults.loader_latency)
+    parser.add_argument("--lazy-load-expire", type=int, default=defaults.lazy_load_expire)
+    parser.add_argument("--leak-every", type=int, default=defaults.leak_every)
+    parser.add_argument("--sample-interval", type=float, default=defaults.sample_interval)
+    args = parser.parse_args(argv)
+
+    report = run_load_test(LoadTestConfig(**vars(args)))
+    sys.stdout.write(json.dumps(report, indent=2) + "\n")
+    return report
+
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,6 @@
+import os
+import threading
+import weakref
 from os import getpid
 
 try:
@@ -8,6 +11,22 @@ except ImportError:
     except ImportError:
         from _thread import get_ident
 
+try:
+    from greenlet import getcurrent
+except ImportError:
+    getcurrent = None
+
+
+def _get_owner():
+    """存储的归属者,greenlet 结束或线程退出后释放存储"""
+    if getcurrent is not None:
+        current = getcurrent()
+        # 线程的 main greenlet 在线程退出后不一定会被及时回收,用线程对象代替
+        if current.parent is not None:
+            return current
+
+    return threading.current_thread()
+
 
 def greenlet_ident():
     ident = get_ident()
@@ -24,6 +43,14 @@ def greenlet_ident():
 class Local:
     """A fork-safe Greenlet-local object.
 
+    每个 greenlet(没有 greenlet 时为线程)第一次写入时弱引用它,greenlet/线程结束被回收后自动释放对应的存储,
+    忘记 release 也不会泄漏;fork 出来的子进程会释放父进程的存储。
+
+    :param max_size: 存储数上限,超过时先 sweep 释放已经结束的,还在用的存储不淘汰,仍然超过时照常新建并计入 overflow,
+        可以用 ``set_max_size`` 修改
+
+    新建、释放存储和统计计数在锁内进行,弱引用回调可能在任意时刻触发,遍历存储时先在锁内复制一份。
+
     Example:
 
         >>> l = Local()
@@ -41,11 +68,25 @@ class Local:
 
     """
 
-    __slots__ = ("__storage__", "__ident_func__")
-
-    def __init__(self):
+    __slots__ = (
+        "__storage__",
+        "__ident_func__",
+        "__owners__",
+        "__max_size__",
+        "__counters__",
+        "__lock__",
+        "__weakref__",
+    )
+
+    def __init__(self, max_size=None):
         object.__setattr__(self, "__storage__", {})
         object.__setattr__(self, "__ident_func__", greenlet_ident)
+        object.__setattr__(self, "__owners__", {})  # ident -> greenlet/线程的弱引用
+        object.__setattr__(self, "__max_size__", max_size)
+        object.__setattr__(self, "__counters__", {"created": 0, "released": 0, "collected": 0, "overflow": 0})
+        # 可重入:持有锁时触发的弱引用回调会在同一个线程里再次 _pop
+        object.__setattr__(self, "__lock__", threading.RLock())
+        _locals.add(self)
 
     def __iter__(self):
         return iter(self.__storage__.items())
@@ -62,7 +103,40 @@ class Local:
         try:
             storage[ident][name] = value
         except KeyError:
-            storage[ident] = {name: value}
+            self._create(ident, {name: value})
+
+    def _create(self, ident, items):
+        with self.__lock__:
+            max_size = self.__max_size__
+            if max_size is not None and len(self.__storage__) >= max_size:
+                self.sweep()
+                # 淘汰还在用的存储会让正在处理的请求丢掉 context,宁可超过上限
+                if len(self.__storage__) >= max_size:
+                    self.__counters__["overflow"] += 1
+
+            self.__storage__[ident] = items
+            self.__counters__["created"] += 1
+            if self.__ident_func__ is greenlet_ident:
+                self._watch_owner(ident)
+
+    def _watch_owner(self, ident):
+        self_ref = weakref.ref(self)
+
+        def on_owner_collected(_, ident=ident):
+            local = self_ref()
+            if local is not None:
+                local._pop(ident, "collected")
+
+        try:
+            self.__owners__[ident] = weakref.ref(_get_owner(), on_owner_collected)
+        except TypeError:
+            pass
+
+    def _pop(self, ident, reason):
+        with self.__lock__:
+            self.__owners__.pop(ident, None)
+            if self.__storage__.pop(ident, None) is not None:
+                self.__counters__[reason] += 1
 
     def __delattr__(self, name):
         try:
@@ -74,7 +148,67 @@ class Local:
         self.__storage__[self.__ident_func__()].update(items)
 
     def release(self):
-        self.__storage__.pop(self.__ident_func__(), None)
+        self._pop(self.__ident_func__(), "released")
+
+    def release_other_processes(self):
+        """释放不属于当前进程的 context,fork 出来的子进程里父进程的 context 永远不会再被释放"""
+        suffix = f"-{getpid()}"
+        with self.__lock__:
+            idents = list(self.__storage__)
+
+        for ident in idents:
+            if not ident.endswith(suffix):
+                self._pop(ident, "collected")
+
+    def sweep(self):
+        """释放其他进程的存储,以及 greenlet/线程已经结束但还没被回收的存储"""
+        self.release_other_processes()
+        with self.__lock__:
+            owners = list(self.__owners__.items())
+
+        for ident, owner in owners:
+            target = owner()
+            if target is None or getattr(target, "dead", False) or not getattr(target, "is_alive", lambda: True)():
+                self._pop(ident, "collected")
+
+    def set_max_size(self, max_size):
+        """修改存储数上限,None 表示不限制,下次新建存储时生效"""
+        object.__setattr__(self, "__max_size__", max_size)
+
+    def stats(self):
+        """存储数量等统计,live 持续增长说明有泄漏,overflow 增长说明 max_size 偏小或者有泄漏"""
+        with self.__lock__:
+            return dict(self.__counters__, live=len(self.__storage__), max_size=self.__max_size__)
+
+    def _reinit_after_fork(self):
+        # fork 时锁可能被父进程的其他线程持有
+        object.__setattr__(self, "__lock__", threading.RLock())
+        self.release_other_processes()
+
+    def snapshot(self):
+        """当前 greenlet 的所有属性,用于带到新起的 greenlet 里"""
+        return dict(self.__storage__.get(self.__ident_func__(), {}))
+
+    def restore(self, items):
+        """用 snapshot 的结果初始化当前 greenlet 的属性"""
+        ident = self.__ident_func__()
+        if ident in self.__storage__:
+            self.__storage__[ident] = dict(items)
+        else:
+            self._create(ident, dict(items))
+
+
+_locals = weakref.WeakSet()  # type: weakref.WeakSet[Local]
+
+
+def _release_other_processes():
+    for local in list(_locals):
+        local._reinit_after_fork()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_release_other_processes)
 
 
+# 请求级的 context,需要限制存储数时调用 experiment_context.set_max_size
 experiment_context = Local()
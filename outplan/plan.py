@@ -0,0 +1,370 @@
+"""把 NamespaceItem 编译成可移植的分组计划(plan)。
+
+plan 是纯数据(可直接 json.dumps),其他语言的运行时只需要 sha1 + 查表即可得到
+与 ``NamespaceItem.get_group`` 完全一致的分组结果:
+
+1. 按实验顺序计算 eligible mask(第 i 个实验满足 pre_condition/tag 且在 [start_time, end_time) 内则置第 i 位)
+2. ``table = segment_tables[str(mask)]``,找不到则不在任何实验内;请求带 ``use_fast_sample`` 时
+   (planout ``FastSample`` 分配 segment)改用 ``fast_segment_tables``
+3. ``segment = H(segment_salt + unit) % num_segments``,``table[segment] == -1`` 则不在实验内
+4. ``h = H(experiment.salt + unit)``,取第一个 ``h <= group.threshold`` 的分组
+5. 分组有 layers 时按顺序在每个 layer namespace 里重复以上步骤,取第一个命中的结果
+
+其中 ``H(s) = int(sha1(s.encode("ascii")).hexdigest()[:15], 16)``,unit 统一先转成 str。
+"""
+
+import base64
+import hashlib
+import time
+from collections import Counter
+from typing import Any, Callable, Dict, Iterable, List, Optional, Sequence, Tuple  # noqa
+
+from .const import UserTagFilterType
+from .exceptions import ExperimentValidateError
+
+PLAN_FORMAT = "outplan.plan"
+PLAN_VERSION = 1
+
+HASH_HEX_DIGITS = 15
+MAX_HASH = 0xFFFFFFFFFFFFFFF
+LONG_SCALE = float(MAX_HASH)
+
+# 有 pre_condition/tag 或时间窗口的实验会改变 segment 分配,每种组合都要导出一张表
+MAX_CONDITIONAL_EXPERIMENTS = 8
+
+_TAG_FILTER_TYPE_NAMES = {UserTagFilterType.AND: "AND", UserTagFilterType.OR: "OR"}
+
+
+def planout_hash(salt, unit):
+    # type: (str, Any) -> int
+    """与 planout ``PlanOutOpRandom.getHash`` 相同的哈希"""
+    return salted_hash(salt_hasher(salt), encode_unit(unit))
+
+
+def salt_hasher(salt):
+    # type: (str) -> Any
+    """salt 前缀固定,预先算好 sha1 状态,每个 unit 只需要 copy 之后 update 自己的部分"""
+    return hashlib.sha1(salt.encode("ascii"))
+
+
+def encode_unit(unit):
+    # type: (Any) -> bytes
+    return str(unit).encode("ascii")
+
+
+def salted_hash(hasher, unit_bytes):
+    # type: (Any, bytes) -> int
+    """等价于 ``planout_hash``,取 sha1 前 15 个十六进制位,即前 60 bit"""
+    hasher = hasher.copy()
+    hasher.update(unit_bytes)
+    return int.from_bytes(hasher.digest()[:8], "big") >> 4
+
+
+def segment_salt(namespace_name):
+    # type: (str) -> str
+    return f"{namespace_name}.segment."
+
+
+def group_salt(namespace_name, experiment_name):
+    # type: (str, str) -> str
+    return f"{namespace_name}.{experiment_name}.group."
+
+
+# 所有 namespace 共用一个 salt,采样率低的 unit 集合是采样率高的子集,跨 namespace 分析时采样的是同一批 unit
+EXPOSURE_SALT = "outplan.exposure."
+_exposure_hasher = salt_hasher(EXPOSURE_SALT)
+
+
+def exposure_sampled(unit_bytes, sample_rate):
+    # type: (bytes, float) -> bool
+    """曝光事件是否上报,同一个 unit 的结果固定"""
+    if sample_rate >= 1:
+        return True
+
+    return salted_hash(_exposure_hasher, unit_bytes) < sample_rate * LONG_SCALE
+
+
+def sample_segments(namespace_name, available_segments, draws, experiment_name, fast=False):
+    # type: (str, Iterable[int], int, str, bool) -> List[int]
+    """复刻 planout ``Sample``/``FastSample``,从可用 segment 里抽 draws 个"""
+    choices = list(available_segments)
+    hasher = salt_hasher(f"{namespace_name}.sampled_segments.{experiment_name}.")
+    stopping_point = len(choices) - draws
+    for i in range(len(choices) - 1, 0, -1):
+        j = salted_hash(hasher, encode_unit(i)) % (i + 1)
+        choices[i], choices[j] = choices[j], choices[i]
+        if fast and stopping_point == i:
+            return choices[i:]
+
+    return choices[:draws]
+
+
+def allocate_segments(namespace_name, num_segments, experiments, fast=False):
+    # type: (str, int, Sequence[Tuple[str, int]], bool) -> List[int]
+    """复刻 planout ``SimpleNamespace.add_experiment`` 的 segment 分配
+
+    :param experiments: 按顺序加入 namespace 的 (实验名, bucket)
+    :return: 长度为 num_segments 的表,值为实验在 experiments 里的下标,未分配为 -1
+    """
+    # 必须和 planout 一样用 set 维护可用 segment,抽样结果依赖它的迭代顺序
+    available_segments = set(range(num_segments))
+    table = [-1] * num_segments
+    for index, (experiment_name, bucket) in enumerate(experiments):
+        if bucket > len(available_segments):
+            raise ExperimentValidateError(f"实验({experiment_name}) bucket 数超过 namespace 可用 bucket 数")
+
+        for segment in sample_segments(namespace_name, available_segments, bucket, experiment_name, fast=fast):
+            table[segment] = index
+            available_segments.remove(segment)
+
+    return table
+
+
+def encode_segment_table(table):
+    # type: (Sequence[int]) -> str
+    """把 segment 表编码成 base64,每个 segment 一个字节,值为实验下标 + 1,0 表示未分配"""
+    try:
+        return base64.b64encode(bytes(index + 1 for index in table)).decode("ascii")
+    except ValueError:
+        raise ExperimentValidateError("实验数超过 254,segment 表无法编码")
+
+
+def decode_segment_table(data, num_segments, experiment_buckets, mask):
+    # type: (str, int, Sequence[int], int) -> Tuple[int, ...]
+    """解码 ``encode_segment_table`` 的结果,并校验每个实验分到的 segment 数与 bucket 一致"""
+    table = tuple(value - 1 for value in base64.b64decode(data))
+    if len(table) != num_segments:
+        raise ExperimentValidateError(f"segment 表长度 {len(table)} 与 namespace bucket 数 {num_segments} 不一致")
+
+    counts = Counter(table)
+    for index, bucket in enumerate(experiment_buckets):
+        expected = bucket if mask & (1 << index) else 0
+        if counts.pop(index, 0) != expected:
+            raise ExperimentValidateError(f"segment 表中第 {index} 个实验的 segment 数与 bucket 数不一致")
+
+    counts.pop(-1, None)
+    if counts:
+        raise ExperimentValidateError("segment 表中有不存在的实验")
+
+    return table
+
+
+def choice_thresholds(weights):
+    # type: (Sequence[float]) -> List[int]
+    """把 ``WeightedChoice`` 的累计权重换算成哈希值上限
+
+    第一个满足 ``hash <= threshold`` 的分组即为结果,这样其他运行时不需要复现浮点运算。
+    """
+    cum_weights = []
+    cum_sum = 0.0
+    for weight in weights:
+        cum_sum += weight
+        cum_weights.append(cum_sum)
+
+    thresholds = []
+    for cum_weight in cum_weights:
+        # 最大的满足 uniform(h) <= cum_weight 的 h,uniform 对 h 单调不减
+        low, high = -1, MAX_HASH
+        while low < high:
+            mid = (low + high + 1) // 2
+            if 0.0 + (cum_sum - 0.0) * (mid / LONG_SCALE) <= cum_weight:
+                low = mid
+            else:
+                high = mid - 1
+        thresholds.append(low)
+
+    return thresholds
+
+
+def segment_masks(namespace_item, max_conditional_experiments=MAX_CONDITIONAL_EXPERIMENTS):
+    # type: (Any, int) -> List[int]
+    """namespace 所有可能出现的 eligible mask,带条件或时间窗口的实验太多时抛异常"""
+    experiment_items = namespace_item.experiment_items
+    variable = [item.is_conditional or item.has_window for item in experiment_items]
+    conditional_bits = [1 << i for i, is_variable in enumerate(variable) if is_variable]
+    if len(conditional_bits) > max_conditional_experiments:
+        raise ExperimentValidateError(
+            f"namespace({namespace_item.name}) 带条件的实验数超过 {max_conditional_experiments},无法导出"
+        )
+
+    base_mask = sum(1 << i for i, is_variable in enumerate(variable) if not is_variable)
+    masks = []
+    for subset in range(1 << len(conditional_bits)):
+        mask = base_mask
+        for bit_index, bit in enumerate(conditional_bits):
+            if subset & (1 << bit_index):
+                mask |= bit
+
+        if mask:
+            masks.append(mask)
+
+    return masks
+
+
+def _experiment_plan(namespace_item, experiment_item, max_conditional_experiments):
+    thresholds = choice_thresholds([group.weight for group in experiment_item.group_items])
+    plan = {
+        "name": experiment_item.name,
+        "bucket": experiment_item.bucket,
+        "salt": group_salt(namespace_item.name, experiment_item.name),
+        "conditional": experiment_item.is_conditional,
+        "pre_condition": experiment_item.pre_condition_source,
+        "user_tags": [
+            {"id": user_tag.tag_id, "columns": user_tag.columns, "not_in": user_tag.not_in}
+            for user_tag in experiment_item.user_tags
+        ],
+        "tag_filter_type": _TAG_FILTER_TYPE_NAMES.get(experiment_item.tag_filter_type),
+        "groups": [
+            {
+                "name": group_item.name,
+                "weight": group_item.weight,
+                "threshold": threshold,
+                "extra_params": group_item.extra_params,
+                "layers": [
+                    export_namespace_plan(namespace, max_conditional_experiments=max_conditional_experiments)
+                    for namespace in group_item.layer_namespaces
+                ],
+            }
+            for group_item, threshold in zip(experiment_item.group_items, thresholds)
+        ],
+    }  # type: Dict[str, Any]
+    # 只在设置了时间窗口时导出,旧的运行时可以忽略
+    if experiment_item.start_time is not None:
+        plan["start_time"] = experiment_item.start_time
+
+    if experiment_item.end_time is not None:
+        plan["end_time"] = experiment_item.end_time
+
+    return plan
+
+
+def export_namespace_plan(namespace_item, max_conditional_experiments=MAX_CONDITIONAL_EXPERIMENTS):
+    # type: (Any, int) -> Dict[str, Any]
+    """导出单个 namespace(包含嵌套 layer)的分组计划"""
+    experiment_items = namespace_item.experiment_items
+    masks = segment_masks(namespace_item, max_conditional_experiments)
+    segment_tables = {str(mask): list(namespace_item.segment_table(mask)) for mask in masks}
+    fast_segment_tables = {str(mask): list(namespace_item.segment_table(mask, fast=True)) for mask in masks}
+
+    return {
+        "name": namespace_item.name,
+        "unit_type": namespace_item.unit_type,
+        "auto_upper_unit": namespace_item.auto_upper_unit,
+        "num_segments": namespace_item.bucket,
+        "segment_salt": segment_salt(namespace_item.name),
+        "experiments": [
+            _experiment_plan(namespace_item, item, max_conditional_experiments) for item in experiment_items
+        ],
+        "segment_tables": segment_tables,
+        "fast_segment_tables": fast_segment_tables,
+    }
+
+
+def eligible_experiments(namespace_item, **params):
+    # type: (Any, Any) -> List[List[str]]
+    """整棵树里满足条件的带条件实验,以 [namespace name, experiment name] 表示"""
+    res = []
+    for experiment_item in namespace_item.experiment_items:
+        if experiment_item.is_conditional and experiment_item.is_eligible(**params):
+            res.append([namespace_item.name, experiment_item.name])
+
+        for group_item in experiment_item.group_items:
+            for namespace in group_item.layer_namespaces:
+                res.extend(eligible_experiments(namespace, **params))
+
+    return res
+
+
+def generate_test_vectors(namespace_item, units, params_list=None):
+    # type: (Any, Iterable[Any], Optional[List[Dict[str, Any]]]) -> List[Dict[str, Any]]
+    """用 python 的分组逻辑生成 golden test vectors,供其他运行时校验"""
+    vectors = []
+    for unit in units:
+        for params in params_list or [{}]:
+            tracking_group = namespace_item.get_group(unit, **params)
+            vectors.append(
+                {
+                    "namespace": namespace_item.name,
+                    "unit": unit,
+                    "params": params,
+                    "eligible": eligible_experiments(namespace_item, **params),
+                    "experiment_trace": tracking_group.experiment_trace() if tracking_group else None,
+                    "group_trace": tracking_group.group_trace() if tracking_group else None,
+                }
+            )
+
+    return vectors
+
+
+def export_plan(
+    namespace_items, test_units=None, test_params=None, max_conditional_experiments=MAX_CONDITIONAL_EXPERIMENTS
+):
+    # type: (Iterable[Any], Optional[Iterable[Any]], Optional[List[Dict[str, Any]]], int) -> Dict[str, Any]
+    """导出带版本号的分组计划,可选附带 test vectors"""
+    namespace_items = list(namespace_items)
+    plan = {
+        "format": PLAN_FORMAT,
+        "version": PLAN_VERSION,
+        "hash": {"algorithm": "sha1", "hex_digits": HASH_HEX_DIGITS, "max": MAX_HASH},
+        "namespaces": [
+            export_namespace_plan(item, max_conditional_experiments=max_conditional_experiments)
+            for item in namespace_items
+        ],
+    }  # type: Dict[str, Any]
+    if test_units is not None:
+        test_units = list(test_units)
+        plan["test_vectors"] = [
+            vector for item in namespace_items for vector in generate_test_vectors(item, test_units, test_params)
+        ]
+
+    return plan
+
+
+def assign_from_plan(namespace_plan, unit, is_eligible=None, now=None, fast=False):
+    # type: (Dict[str, Any], Any, Optional[Callable[[str, str], bool]], Optional[float], bool) -> Optional[Tuple[List[str], List[str], Any]]
+    """plan 的参考实现,其他运行时按这个逻辑查表即可
+
+    :param is_eligible: (namespace name, experiment name) -> bool,只对带条件的实验调用,默认都满足
+    :param now: 判断时间窗口用的时间戳,为空时用当前时间
+    :param fast: 请求带 ``use_fast_sample`` 时为 True,查 ``fast_segment_tables``
+    :return: (实验链, 分组链, 最后一个分组的 extra_params),不在实验内返回 None
+    """
+    if now is None:
+        now = time.time()
+
+    mask = 0
+    for i, experiment in enumerate(namespace_plan["experiments"]):
+        if experiment.get("start_time", now) > now or experiment.get("end_time", now + 1) <= now:
+            continue
+
+        if (
+            not experiment["conditional"]
+            or is_eligible is None
+            or is_eligible(namespace_plan["name"], experiment["name"])
+        ):
+            mask |= 1 << i
+
+    table = namespace_plan["fast_segment_tables" if fast else "segment_tables"].get(str(mask))
+    if table is None:
+        return None
+
+    index = table[planout_hash(namespace_plan["segment_salt"], unit) % namespace_plan["num_segments"]]
+    if index < 0:
+        return None
+
+    experiment = namespace_plan["experiments"][index]
+    value = planout_hash(experiment["salt"], unit)
+    group = next((group for group in experiment["groups"] if value <= group["threshold"]), None)
+    if group is None:
+        return None
+
+    if not group["layers"]:
+        return [experiment["name"]], [group["name"]], group["extra_params"]
+
+    for layer in group["layers"]:
+        res = assign_from_plan(layer, unit, is_eligible, now, fast)
+        if res:
+            experiment_names, group_names, extra_params = res
+            return [experiment["name"], *experiment_names], [group["name"], *group_names], extra_params
+
+    return None
@@ -0,0 +1,71 @@
+from types import MappingProxyType
+from typing import Any, Dict, Iterable, Mapping, NamedTuple, Optional, Union
+
+from .const import LazyLoadState
+from .experiment import NamespaceItem
+
+
+def frozen_dict(data: Mapping[str, Any]) -> Mapping[str, Any]:
+    return MappingProxyType(dict(data))
+
+
+def merged(data: Mapping[str, Any], updates: Dict[str, Any]) -> Mapping[str, Any]:
+    """返回合并了 updates 的新 mapping,原 mapping 不变"""
+    return MappingProxyType({**data, **updates})
+
+
+class LazyNamespaceEntry(NamedTuple):
+    """lazy load 目录里的一个 namespace"""
+
+    ttl: float  # 加载成功后的有效期(秒)
+    version: Any = None  # 目录里声明的版本,与 loaded_version 不一致时下次访问重新加载
+    state: int = LazyLoadState.unloaded
+    namespace_item: Optional[NamespaceItem] = None
+    loaded_version: Any = None
+    expire_at: float = 0  # 加载结果的过期时间,加载失败/不存在时为负缓存的过期时间
+
+    def is_fresh(self, now: float) -> bool:
+        return self.state != LazyLoadState.unloaded and now < self.expire_at and self.version == self.loaded_version
+
+
+def build_lazy_directory(
+    listing: Union[Iterable[str], Mapping[str, Optional[Dict[str, Any]]]],
+    previous: Mapping[str, LazyNamespaceEntry],
+    default_ttl: float,
+) -> Mapping[str, LazyNamespaceEntry]:
+    """把 lazy_load_namespaces_func 的返回值转换成目录,之前已经加载过的 namespace 保留加载状态
+
+    :param listing: namespace name 列表,或者 {name: {"ttl": 60, "version": "v2"}},ttl/version 都可以省略
+    """
+    items = listing.items() if isinstance(listing, Mapping) else ((name, None) for name in listing)
+    directory = {}
+    for name, _meta in items:
+        meta = _meta or {}
+        ttl, version = meta.get("ttl", default_ttl), meta.get("version")
+        entry = previous.get(name)
+        if entry is None:
+            directory[name] = LazyNamespaceEntry(ttl=ttl, version=version)
+        else:
+            directory[name] = entry._replace(ttl=ttl, version=version)
+
+    return frozen_dict(directory)
+
+
+class NamespaceRegistry(NamedTuple):
+    """ExperimentGroupClient 的 namespace 快照
+
+    快照创建后不再修改,写入方基于当前快照构造新快照再整体替换,
+    读取方每次调用只取一次快照,不需要加锁也不会看到更新了一半的状态。
+    """
+
+    namespaces: Mapping[str, NamespaceItem]  # 代码里显式定义的 namespace
+    lazy_load_directory: Mapping[str, LazyNamespaceEntry]  # lazy load 的 namespace 目录
+    lazy_load_init_ts: Mapping[str, int]  # 记录 lazy load 目录等的初始化时间,expire 之后重新 load
+
+    @classmethod
+    def create(cls, namespaces: Mapping[str, NamespaceItem]) -> "NamespaceRegistry":
+        return cls(
+            namespaces=frozen_dict(namespaces),
+            lazy_load_directory=frozen_dict({}),
+            lazy_load_init_ts=frozen_dict({}),
+        )
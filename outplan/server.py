@@ -0,0 +1,283 @@
+"""本地分组服务,非 python 服务通过 unix socket 或本机 tcp 复用同一个 ExperimentGroupClient 取分组。
+
+协议为按行分隔的 json,一行一个请求,同一个连接上可以连续写多行(pipeline),服务端按顺序逐行返回::
+
+    请求: {"namespaces": ["ns_1", "ns_2"], "unit": "u", "user_id": 1, "pdid": "", "track": false, "params": {}}
+    批量: [{...}, {...}]
+    返回: 每个 namespace 一项 [group_names, experiment_names, extra_params],不在实验内为 null,批量时再套一层列表
+    出错: {"error": "msg"}
+
+group_names/experiment_names 从最外层 namespace 到最内层排列。
+"""
+
+import json
+import os
+import queue
+import socket
+import socketserver
+import threading
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional, Tuple, Union
+
+from .client import ExperimentGroupClient
+from .exceptions import AssignmentServerError
+from .experiment import TrackingGroup
+
+Address = Union[str, Tuple[str, int]]
+
+# pipeline 时每次最多连续写出的请求数,写完一段先读回结果再写下一段
+PIPELINE_DEPTH = 64
+
+_JSON_SEPARATORS = (",", ":")
+
+
+def _dumps(data: Any) -> bytes:
+    return json.dumps(data, separators=_JSON_SEPARATORS).encode("utf-8") + b"\n"
+
+
+def _dump_tracking_group(tracking_group: Optional[TrackingGroup]) -> Optional[List[Any]]:
+    if tracking_group is None:
+        return None
+
+    return [
+        list(reversed(tracking_group.group_names)),
+        list(reversed(tracking_group.experiment_names)),
+        tracking_group.group_extra_params,
+    ]
+
+
+def _load_tracking_group(data: Optional[List[Any]]) -> Optional[TrackingGroup]:
+    if data is None:
+        return None
+
+    group_names, experiment_names, extra_params = data
+    tracking_group = TrackingGroup(group_extra_params=extra_params)
+    for group_name in reversed(group_names):
+        tracking_group.add_group_name(group_name)
+    for experiment_name in reversed(experiment_names):
+        tracking_group.add_experiment_name(experiment_name)
+
+    return tracking_group
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        assignment_server = self.server.assignment_server  # type: ignore
+        for line in self.rfile:
+            if not line.strip():
+                continue
+
+            self.wfile.write(assignment_server.handle_line(line))
+
+
+class _TCPRequestHandler(_RequestHandler):
+    # 返回逐行写出,pipeline 分段时每段最后几行不能等客户端的延迟 ACK
+    disable_nagle_algorithm = True
+
+
+class _TCPServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+if hasattr(socketserver, "ThreadingUnixStreamServer"):
+
+    class _UnixServer(socketserver.ThreadingUnixStreamServer):  # type: ignore
+        daemon_threads = True
+
+
+class AssignmentServer:
+    """分组服务
+
+    Example:
+
+        >>> server = AssignmentServer(client, "/tmp/outplan.sock")
+        >>> server.start()  # 后台线程;也可以直接调用 serve_forever()
+        >>> server.close()
+    """
+
+    def __init__(self, client: ExperimentGroupClient, address: Address) -> None:
+        self.client = client
+        self.address = address
+        self._server: socketserver.BaseServer
+        if isinstance(address, str):
+            if os.path.exists(address):
+                os.unlink(address)
+            self._server = _UnixServer(address, _RequestHandler)
+        else:
+            self._server = _TCPServer(address, _TCPRequestHandler)
+
+        self._server.assignment_server = self  # type: ignore
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def server_address(self) -> Address:
+        return self._server.server_address  # type: ignore
+
+    def assign(self, request: Dict[str, Any]) -> List[Optional[List[Any]]]:
+        tracking_groups = self.client.get_tracking_groups(
+            request["namespaces"],
+            unit=request.get("unit", ""),
+            user_id=request.get("user_id", 0),
+            pdid=request.get("pdid", ""),
+            track=request.get("track", True),
+            **request.get("params", {}),
+        )
+        return [_dump_tracking_group(tracking_group) for tracking_group in tracking_groups]
+
+    def handle_line(self, line: bytes) -> bytes:
+        try:
+            request = json.loads(line)
+            if isinstance(request, list):
+                res: Any = [self.assign(item) for item in request]
+            else:
+                res = self.assign(request)
+        except Exception as e:
+            if self.client.logger:
+                self.client.logger.error(f"assignment server error: msg: {e!s}")
+            res = {"error": str(e)}
+
+        return _dumps(res)
+
+    def serve_forever(self) -> None:
+        self._server.serve_forever()
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self.serve_forever, name="outplan-assignment-server", daemon=True)
+        self._thread.start()
+
+    def close(self) -> None:
+        if self._thread:
+            self._server.shutdown()
+            self._thread.join()
+            self._thread = None
+
+        self._server.server_close()
+        if isinstance(self.address, str) and os.path.exists(self.address):
+            os.unlink(self.address)
+
+
+class AssignmentClient:
+    """AssignmentServer 的客户端,连接放在池里复用
+
+    :param pipeline_depth: pipeline 时最多有多少个请求在等待返回。一次写出所有请求再读的话,
+        服务端的返回填满 socket 缓冲区后会停止读取,双方互相等待
+    """
+
+    def __init__(
+        self,
+        address: Address,
+        pool_size: int = 8,
+        timeout: Optional[float] = 1.0,
+        pipeline_depth: int = PIPELINE_DEPTH,
+    ) -> None:
+        self.address = address
+        self.timeout = timeout
+        self.pipeline_depth = pipeline_depth
+        self._pool: queue.LifoQueue = queue.LifoQueue(maxsize=pool_size)
+
+    def _connect(self):
+        family = socket.AF_UNIX if isinstance(self.address, str) else socket.AF_INET
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(self.address)
+        except Exception:
+            sock.close()
+            raise
+
+        return sock, sock.makefile("rb")
+
+    @staticmethod
+    def _close_connection(conn):
+        sock, rfile = conn
+        rfile.close()
+        sock.close()
+
+    @contextmanager
+    def _connection(self) -> Iterator[Any]:
+        try:
+            conn = self._pool.get_nowait()
+        except queue.Empty:
+            conn = self._connect()
+
+        try:
+            yield conn
+        except Exception:
+            # 连接状态未知(可能还有未读完的返回),不能再放回池里
+            self._close_connection(conn)
+            raise
+
+        try:
+            self._pool.put_nowait(conn)
+        except queue.Full:
+            self._close_connection(conn)
+
+    def _request(self, payloads: List[Any]) -> List[Any]:
+        responses = []
+        with self._connection() as (sock, rfile):
+            for start in range(0, len(payloads), self.pipeline_depth):
+                chunk = payloads[start : start + self.pipeline_depth]
+                sock.sendall(b"".join(_dumps(payload) for payload in chunk))
+                for _ in chunk:
+                    responses.append(self._read_response(rfile))
+
+        return responses
+
+    @staticmethod
+    def _read_response(rfile) -> Any:
+        line = rfile.readline()
+        if not line:
+            raise AssignmentServerError("connection closed by assignment server")
+
+        response = json.loads(line)
+        if isinstance(response, dict):
+            raise AssignmentServerError(response.get("error", "unknown error"))
+
+        return response
+
+    @staticmethod
+    def make_request(
+        namespace_names: List[str],
+        unit: Union[str, int] = "",
+        user_id: int = 0,
+        pdid: str = "",
+        track: bool = True,
+        **params,
+    ) -> Dict[str, Any]:
+        return {
+            "namespaces": namespace_names,
+            "unit": unit,
+            "user_id": user_id,
+            "pdid": pdid,
+            "track": track,
+            "params": params,
+        }
+
+    def get_tracking_groups(self, namespace_names: List[str], *args, **kwargs) -> List[Optional[TrackingGroup]]:
+        """参数同 ``ExperimentGroupClient.get_tracking_groups``"""
+        (response,) = self._request([self.make_request(namespace_names, *args, **kwargs)])
+        return [_load_tracking_group(item) for item in response]
+
+    def get_groups(self, namespace_names: List[str], *args, **kwargs) -> List[Optional[str]]:
+        return [
+            tracking_group.last_group if tracking_group else None
+            for tracking_group in self.get_tracking_groups(namespace_names, *args, **kwargs)
+        ]
+
+    def batch(self, requests: List[Dict[str, Any]]) -> List[List[Optional[TrackingGroup]]]:
+        """多个请求合成一行发送,requests 由 ``make_request`` 构造"""
+        (response,) = self._request([requests])
+        return [[_load_tracking_group(item) for item in items] for items in response]
+
+    def pipeline(self, requests: List[Dict[str, Any]]) -> List[List[Optional[TrackingGroup]]]:
+        """多个请求逐行连续写出,再按顺序读回,每次最多写出 pipeline_depth 个"""
+        return [[_load_tracking_group(item) for item in items] for items in self._request(requests)]
+
+    def close(self) -> None:
+        while True:
+            try:
+                conn = self._pool.get_nowait()
+            except queue.Empty:
+                break
+            self._close_connection(conn)
@@ -0,0 +1,261 @@
+"""本地追加写的曝光日志,作为 ExperimentGroupClient 的 tracking_client,由日志收集程序转发。"""
+
+import json
+import os
+import struct
+import threading
+import time
+from typing import IO, Any, Dict, Iterator, List, NamedTuple, Optional
+
+FORMAT_JSONL = "jsonl"
+FORMAT_BINARY = "binary"
+
+# 二进制记录:magic | 总长度 | 时间戳 | user_id | 后面三个字段的长度 | pdid | event_name | properties(json)
+_MAGIC = 0xA5
+_HEADER = struct.Struct("<BIdqHHI")
+
+
+class ExposureRecord(NamedTuple):
+    ts: float
+    user_id: int
+    pdid: str
+    event_name: str
+    properties: Optional[Dict[str, Any]]
+
+
+def encode_jsonl(record: ExposureRecord) -> bytes:
+    return (json.dumps(record._asdict(), separators=(",", ":"), ensure_ascii=False) + "\n").encode("utf-8")
+
+
+def encode_binary(record: ExposureRecord) -> bytes:
+    pdid = record.pdid.encode("utf-8")
+    event_name = record.event_name.encode("utf-8")
+    properties = b"" if record.properties is None else json.dumps(record.properties, separators=(",", ":")).encode()
+    size = _HEADER.size + len(pdid) + len(event_name) + len(properties)
+    header = _HEADER.pack(_MAGIC, size, record.ts, record.user_id, len(pdid), len(event_name), len(properties))
+    return header + pdid + event_name + properties
+
+
+def _decode_binary(data: bytes) -> Iterator[ExposureRecord]:
+    offset = 0
+    while offset + _HEADER.size <= len(data):
+        magic, size, ts, user_id, pdid_len, event_len, properties_len = _HEADER.unpack_from(data, offset)
+        if magic != _MAGIC or offset + size > len(data):  # 写了一半的记录
+            return
+
+        start = offset + _HEADER.size
+        pdid = data[start : start + pdid_len].decode("utf-8")
+        start += pdid_len
+        event_name = data[start : start + event_len].decode("utf-8")
+        start += event_len
+        properties = json.loads(data[start : start + properties_len]) if properties_len else None
+        yield ExposureRecord(ts, user_id, pdid, event_name, properties)
+        offset += size
+
+
+def read_records(path: str) -> Iterator[ExposureRecord]:
+    """读取一个日志文件,按文件内容判断格式,最后一条写了一半的记录会被忽略"""
+    with open(path, "rb") as f:
+        data = f.read()
+
+    if data[:1] and data[0] != _MAGIC:
+        lines = data.split(b"\n")
+        for index, line in enumerate(lines):
+            if not line:
+                continue
+
+            try:
+                record = ExposureRecord(**json.loads(line))
+            except ValueError:
+                # 只有没写完换行符的最后一行可能是写了一半的记录,其他行解析失败说明文件损坏
+                if index < len(lines) - 1:
+                    raise
+                return
+
+            yield record
+        return
+
+    yield from _decode_binary(data)
+
+
+class FileExposureSink:
+    """把曝光事件追加写到本地文件
+
+    ``track`` 只把事件放进内存缓冲区,后台线程每 flush_interval 秒或攒够 flush_events 条时批量写入并 fsync,
+    请求路径上没有 I/O。文件超过 max_bytes 或者写了 rotate_interval 秒后改名为 ``<path>.<时间戳>.<序号>``,
+    日志收集程序只需要处理改过名的文件。缓冲区超过 max_buffer 条时丢弃新事件并计数。
+
+    path 里可以带 ``{pid}``,fork 出来的 worker 各写各的文件。
+
+    Example:
+
+        >>> sink = FileExposureSink("/var/log/outplan/exposure.{pid}.jsonl")
+        >>> sink.start()
+        >>> client = ExperimentGroupClient([...], tracking_client=sink)
+    """
+
+    def __init__(  # noqa: PLR0913
+        self,
+        path: str,
+        fmt: str = FORMAT_JSONL,
+        flush_interval: float = 1.0,
+        flush_events: int = 1000,
+        max_bytes: int = 64 * 1024 * 1024,
+        rotate_interval: Optional[float] = 3600,
+        max_buffer: int = 100000,
+        fsync: bool = True,
+        logger=None,
+    ) -> None:
+        if fmt not in (FORMAT_JSONL, FORMAT_BINARY):
+            raise ValueError(f"unknown exposure log format: {fmt}")
+
+        self.path_template = path
+        self.fmt = fmt
+        self.flush_interval = flush_interval
+        self.flush_events = flush_events
+        self.max_bytes = max_bytes
+        self.rotate_interval = rotate_interval
+        self.max_buffer = max_buffer
+        self.fsync = fsync
+        self.logger = logger
+        self._encode = encode_jsonl if fmt == FORMAT_JSONL else encode_binary
+        self.batches = 0
+        self.dropped = 0
+        self.rotations = 0
+        self.last_rotated: Optional[str] = None
+        self._init_state()
+
+    def _init_state(self) -> None:
+        self._buffer: List[ExposureRecord] = []
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()  # 后台线程和手动 flush 不同时写文件
+        self._wakeup = threading.Event()
+        self._stop_event = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._file: Optional[IO[bytes]] = None
+        self._opened_at = 0.0
+
+    @property
+    def path(self) -> str:
+        return self.path_template.format(pid=os.getpid())
+
+    def track(self, user_id, pdid, event_name, properties=None) -> None:
+        record = ExposureRecord(time.time(), int(user_id or 0), pdid or "", event_name, properties)
+        with self._lock:
+            if len(self._buffer) >= self.max_buffer:
+                self.dropped += 1
+                return
+
+            self._buffer.append(record)
+            full = len(self._buffer) >= self.flush_events
+
+        if full:
+            self._wakeup.set()
+
+    def flush(self) -> int:
+        """把缓冲区写入文件并 fsync,返回写入的事件数"""
+        with self._lock:
+            records, self._buffer = self._buffer, []
+
+        with self._write_lock:
+            if records:
+                self._write(b"".join([self._encode(record) for record in records]))
+            self._maybe_rotate()
+
+        return len(records)
+
+    def _open(self) -> IO[bytes]:
+        if self._file is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._file = open(self.path, "ab")
+            self._opened_at = time.time()
+
+        return self._file
+
+    def _write(self, data: bytes) -> None:
+        f = self._open()
+        f.write(data)
+        f.flush()
+        if self.fsync:
+            os.fsync(f.fileno())
+
+        self.batches += 1
+
+    def _maybe_rotate(self) -> None:
+        if self._file is None:
+            return
+
+        too_big = self._file.tell() >= self.max_bytes
+        too_old = self.rotate_interval is not None and time.time() - self._opened_at >= self.rotate_interval
+        if too_big or (too_old and self._file.tell()):
+            self._rotate()
+
+    def rotate(self) -> Optional[str]:
+        """关闭当前文件并改名,返回改名后的路径"""
+        with self._write_lock:
+            return self._rotate()
+
+    def _rotate(self) -> Optional[str]:
+        if self._file is None:
+            return None
+
+        self._file.close()
+        self._file = None
+        now = time.time()
+        rotated = f"{self.path}.{time.strftime('%Y%m%d%H%M%S', time.localtime(now))}.{int(now * 1000) % 1000:03d}"
+        rotated = f"{rotated}.{self.rotations}"  # 同一毫秒内切分多次时不覆盖
+        os.replace(self.path, rotated)
+        self.rotations += 1
+        self.last_rotated = rotated
+        return rotated
+
+    def _run(self) -> None:
+        while not self._stop_event.is_set():
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                if self.logger:
+                    self.logger.error(f"exposure sink flush error: path: {self.path}, msg: {e!s}")
+
+    def start(self) -> None:
+        if self._thread and self._thread.is_alive():
+            return
+
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name="outplan-exposure-sink", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        """停止后台线程,写入剩余的事件并关闭文件"""
+        self._stop_event.set()
+        self._wakeup.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+
+        self.flush()
+        with self._write_lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def reinit_after_fork(self) -> None:
+        """子进程丢掉从父进程复制来的缓冲区(父进程会自己写入),重新打开文件,父进程启动过后台线程时重新启动"""
+        was_running = self._thread is not None and not self._stop_event.is_set()
+        if self._file is not None:
+            self._file.close()
+        self._init_state()
+        if was_running:
+            self.start()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "buffered": len(self._buffer),
+            "batches": self.batches,
+            "dropped": self.dropped,
+            "rotations": self.rotations,
+        }
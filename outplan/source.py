@@ -0,0 +1,131 @@
+"""基于本地文件的 namespace 来源,文件变化时在后台线程重新加载。"""
+
+import os
+import threading
+from typing import TYPE_CHECKING, Callable, Dict, List, Optional, Tuple
+
+from .exceptions import ExperimentValidateError
+from .experiment import NamespaceItem
+from .loader import NamespaceLoader
+
+if TYPE_CHECKING:
+    from .cache import CompiledNamespaceCache
+
+SPEC_FILE_SUFFIXES = (".json", ".jsonl")
+
+
+class FileNamespaceSource:
+    """从单个文件(json 对象/数组或 jsonl)或目录下所有 json/jsonl 文件加载 namespace
+
+    后台线程按 poll_interval 检查文件的 mtime 和大小,变化后重新加载并整体替换 ``namespaces``,
+    读取时不加锁,请求路径上也没有任何过期检查。加载失败时保留上一次的结果,文件再次变化前不会重试。
+    设置 cache 后内容没变的 namespace 直接从编译缓存加载,见 ``cache.CompiledNamespaceCache``。
+    推送配置时应先写临时文件再 rename,否则可能读到写了一半的文件(会在下次轮询时重试)。
+
+    Example:
+
+        >>> source = FileNamespaceSource("/etc/outplan/namespaces.jsonl")
+        >>> source.start()
+        >>> client = ExperimentGroupClient([], namespace_source=source)
+    """
+
+    def __init__(
+        self,
+        path: str,
+        tag_filter_func: Optional[Callable] = None,
+        poll_interval: float = 1.0,
+        logger=None,
+        cache: Optional["CompiledNamespaceCache"] = None,
+    ) -> None:
+        self.path = path
+        self.tag_filter_func = tag_filter_func
+        self.poll_interval = poll_interval
+        self.logger = logger
+        self.cache = cache
+        self.namespaces: Dict[str, NamespaceItem] = {}
+        self.reload_count = 0
+        self._fingerprint: Optional[Tuple] = None
+        self._failed_fingerprint: Optional[Tuple] = None
+        self._stop_event = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+        self.reload()
+
+    def spec_files(self) -> List[str]:
+        if not os.path.isdir(self.path):
+            return [self.path]
+
+        return sorted(
+            os.path.join(self.path, name) for name in os.listdir(self.path) if name.endswith(SPEC_FILE_SUFFIXES)
+        )
+
+    def fingerprint(self) -> Tuple:
+        res = []
+        for path in self.spec_files():
+            stat = os.stat(path)
+            res.append((path, stat.st_mtime_ns, stat.st_size))
+
+        return tuple(res)
+
+    def reload(self, force: bool = False) -> bool:
+        """文件有变化时重新加载,返回是否重新加载了"""
+        fingerprint = self.fingerprint()
+        if not force and fingerprint in (self._fingerprint, self._failed_fingerprint):
+            return False
+
+        # 每次重新加载用新的 loader,避免旧版本的 spec 一直留在缓存里
+        loader = NamespaceLoader(tag_filter_func=self.tag_filter_func, cache=self.cache)
+        namespaces: Dict[str, NamespaceItem] = {}
+        try:
+            for path in self.spec_files():
+                for namespace_item in loader.load_file(path):
+                    if namespace_item.name in namespaces:
+                        raise ExperimentValidateError(f"namespace name({namespace_item.name}) 冲突")
+
+                    namespaces[namespace_item.name] = namespace_item
+        except Exception:
+            # 同一份坏文件只解析、报错一次
+            self._failed_fingerprint = fingerprint
+            raise
+
+        self.namespaces = namespaces
+        self._fingerprint = fingerprint
+        self._failed_fingerprint = None
+        self.reload_count += 1
+        if self.logger:
+            self.logger.info(f"namespace source reloaded: path: {self.path}, namespaces: {len(namespaces)}")
+
+        return True
+
+    def get(self, namespace_name: str) -> Optional[NamespaceItem]:
+        return self.namespaces.get(namespace_name)
+
+    def _run(self) -> None:
+        while not self._stop_event.wait(self.poll_interval):
+            try:
+                self.reload()
+            except Exception as e:
+                if self.logger:
+                    self.logger.error(f"namespace source reload error: path: {self.path}, msg: {e!s}")
+
+    def start(self) -> None:
+        if self._thread and self._thread.is_alive():
+            return
+
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name="outplan-namespace-source", daemon=True)
+        self._thread.start()
+
+    def reinit_after_fork(self) -> None:
+        """fork 之后子进程里没有后台线程,父进程启动过的话在子进程里重新启动"""
+        was_running = self._thread is not None and not self._stop_event.is_set()
+        self._stop_event = threading.Event()
+        self._thread = None
+        if was_running:
+            self.start()
+
+    def stop(self) -> None:
+        self._stop_event.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
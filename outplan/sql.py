@@ -0,0 +1,534 @@
+"""把分组计划(见 ``plan.export_namespace_plan``)编译成 SQL 表达式,在数仓里直接对整张表算分组。
+
+与 ``plan.assign_from_plan`` 的步骤一一对应:
+
+- ``H(salt + unit)`` 只取 sha1 十六进制的前 15 位,分组阈值也写成 15 位十六进制字符串,直接比较字符串大小
+- ``H % num_segments`` 优先用方言自带的十六进制转整数,没有时(SQLite)按每一位的值乘以 ``16^k % n`` 求和
+- segment 表编码成定长数字串,``substr`` 取出当前 segment 对应的实验,只用默认的 segment 分配(不支持 ``use_fast_sample``)
+- 带条件的实验按 eligible mask 选 segment 表,pre_condition 尽量翻译成 SQL,翻译不了的(比如标签)需要调用方给出条件
+- 嵌套 layer 用 ``COALESCE`` 取第一个命中的结果
+- 有时间窗口的实验默认按编译时的时间判断是否生效,也可以传入时间戳列按行判断
+"""
+
+import ast
+import sys
+import time
+from typing import Any, Callable, Dict, List, Mapping, NamedTuple, Optional, Sequence, Tuple, Union
+
+from .exceptions import SqlCompileError
+from .plan import HASH_HEX_DIGITS, MAX_CONDITIONAL_EXPERIMENTS, MAX_HASH, export_namespace_plan
+
+OUTPUTS = ("group_name", "group_trace", "experiment_trace")
+
+_HEX_DIGITS = "0123456789abcdef"
+
+
+class SqlDialect(NamedTuple):
+    """各个数据库的函数写法,``{}`` 为参数
+
+    :param sha1_hex: 返回小写十六进制的 sha1
+    :param hex_to_int: 15 位十六进制字符串转整数,为 None 时逐位计算
+    """
+
+    name: str
+    sha1_hex: str
+    position: str
+    text: str
+    concat: str
+    mod: str
+    hex_to_int: Optional[str] = None
+
+
+DIALECTS = {
+    # SQLite 没有 sha1,需要注册:conn.create_function("sha1", 1, lambda s: hashlib.sha1(s.encode()).hexdigest())
+    "sqlite": SqlDialect("sqlite", "sha1({})", "instr({}, {})", "CAST({} AS TEXT)", "({} || {})", "({} % {})"),
+    # 需要 pgcrypto 扩展
+    "postgres": SqlDialect(
+        "postgres",
+        "encode(digest({}, 'sha1'), 'hex')",
+        "strpos({}, {})",
+        "CAST({} AS TEXT)",
+        "({} || {})",
+        "mod({}, {})",
+        "(('x' || lpad({}, 16, '0'))::bit(64)::bigint)",
+    ),
+    "mysql": SqlDialect(
+        "mysql",
+        "SHA1({})",
+        "INSTR({}, {})",
+        "CAST({} AS CHAR)",
+        "CONCAT({}, {})",
+        "MOD({}, {})",
+        "CAST(CONV({}, 16, 10) AS UNSIGNED)",
+    ),
+    "bigquery": SqlDialect(
+        "bigquery",
+        "TO_HEX(SHA1({}))",
+        "STRPOS({}, {})",
+        "CAST({} AS STRING)",
+        "CONCAT({}, {})",
+        "MOD({}, {})",
+        "CAST(CONCAT('0x', {}) AS INT64)",
+    ),
+    "spark": SqlDialect(
+        "spark",
+        "sha1({})",
+        "instr({}, {})",
+        "CAST({} AS STRING)",
+        "concat({}, {})",
+        "pmod({}, {})",
+        "CAST(conv({}, 16, 10) AS BIGINT)",
+    ),
+}
+
+
+def sql_literal(value: Any) -> str:
+    if value is None:
+        return "NULL"
+
+    if isinstance(value, bool):
+        return "TRUE" if value else "FALSE"
+
+    if isinstance(value, (int, float)):
+        return repr(value)
+
+    if isinstance(value, str):
+        return "'{}'".format(value.replace("'", "''"))
+
+    raise SqlCompileError(f"不支持的 SQL 常量: {value!r}")
+
+
+_COMPARE_OPS = {ast.Eq: "=", ast.NotEq: "<>", ast.Lt: "<", ast.LtE: "<=", ast.Gt: ">", ast.GtE: ">="}
+_ARITHMETIC_OPS = {ast.Add: "+", ast.Sub: "-", ast.Mult: "*"}
+
+_NOT_LITERAL = object()
+
+
+def _literal(node: ast.expr) -> Any:
+    """常量节点的值,不是常量时返回 ``_NOT_LITERAL``
+
+    python 3.7 的常量是 ``Num``/``Str``/``NameConstant``,3.8 起统一成 ``Constant``
+    """
+    if isinstance(node, ast.Constant):
+        return node.value
+
+    if sys.version_info < (3, 8):
+        if isinstance(node, ast.Num):
+            return node.n
+
+        if isinstance(node, (ast.Str, ast.Bytes)):
+            return node.s
+
+        if isinstance(node, ast.NameConstant):
+            return node.value
+
+    return _NOT_LITERAL
+
+
+class _ConditionTranslator:
+    """把 ``lambda user_id, **ignore: 10 <= user_id < 15`` 这类 pre_condition 翻译成 SQL 条件
+
+    只支持比较(包括 in/not in/is None)、and/or/not 和加减乘、取模,参数名即列名,可以用 columns 改写。
+    """
+
+    def __init__(self, dialect: SqlDialect, columns: Mapping[str, str]) -> None:
+        self.dialect = dialect
+        self.columns = columns
+        self.arg_defaults: Dict[str, Optional[ast.expr]] = {}
+        self.kwarg: Optional[str] = None
+
+    def translate(self, source: str) -> str:
+        try:
+            node = ast.parse(source.strip(), mode="eval").body
+        except SyntaxError as e:
+            raise SqlCompileError(f"pre_condition 解析失败: {e!s}")
+
+        if not isinstance(node, ast.Lambda):
+            raise SqlCompileError("pre_condition 不是 lambda")
+
+        args = node.args
+        positional = [*getattr(args, "posonlyargs", []), *args.args]
+        defaults = [None] * (len(positional) - len(args.defaults)) + list(args.defaults)
+        self.arg_defaults = {arg.arg: default for arg, default in zip(positional, defaults)}
+        self.arg_defaults.update({arg.arg: default for arg, default in zip(args.kwonlyargs, args.kw_defaults)})
+        self.kwarg = args.kwarg.arg if args.kwarg else None
+        return self._condition(node.body)
+
+    def _condition(self, node: ast.expr) -> str:
+        if isinstance(node, ast.BoolOp):
+            keyword = " AND " if isinstance(node.op, ast.And) else " OR "
+            conditions = [self._condition(value) for value in node.values]  # noqa: PD011
+            return f"({keyword.join(conditions)})"
+
+        if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.Not):
+            return f"(NOT {self._condition(node.operand)})"
+
+        if isinstance(node, ast.Compare):
+            parts = []
+            left = node.left
+            for op, right in zip(node.ops, node.comparators):
+                parts.append(self._compare(left, op, right))
+                left = right
+            return parts[0] if len(parts) == 1 else "({})".format(" AND ".join(parts))
+
+        value = _literal(node)
+        if isinstance(value, bool):
+            return sql_literal(value)
+
+        raise SqlCompileError(f"不支持的条件: {ast.dump(node)}")
+
+    def _compare(self, left: ast.expr, op: ast.cmpop, right: ast.expr) -> str:
+        if isinstance(op, (ast.In, ast.NotIn)):
+            if not isinstance(right, (ast.Tuple, ast.List, ast.Set)) or not right.elts:
+                raise SqlCompileError("in 只支持非空的常量列表")
+
+            values = ", ".join(self._value(elt) for elt in right.elts)
+            keyword = "IN" if isinstance(op, ast.In) else "NOT IN"
+            return f"({self._value(left)} {keyword} ({values}))"
+
+        is_none = _literal(right) is None
+        if is_none and isinstance(op, (ast.Is, ast.Eq)):
+            return f"({self._value(left)} IS NULL)"
+
+        if is_none and isinstance(op, (ast.IsNot, ast.NotEq)):
+            return f"({self._value(left)} IS NOT NULL)"
+
+        sql_op = _COMPARE_OPS.get(type(op))
+        if sql_op is None:
+            raise SqlCompileError(f"不支持的比较: {type(op).__name__}")
+
+        return f"({self._value(left)} {sql_op} {self._value(right)})"
+
+    def _value(self, node: ast.expr) -> str:  # noqa: PLR0911
+        value = _literal(node)
+        if value is not _NOT_LITERAL:
+            return sql_literal(value)
+
+        if isinstance(node, ast.Name):
+            if node.id not in self.arg_defaults:
+                raise SqlCompileError(f"pre_condition 引用了参数以外的变量: {node.id}")
+
+            default = self.arg_defaults[node.id]
+            if default is None:
+                return self._column(node.id)
+
+            return f"COALESCE({self._column(node.id)}, {self._value(default)})"
+
+        if isinstance(node, ast.Subscript):
+            # params["level"]
+            key = node.slice.value if isinstance(node.slice, ast.Index) else node.slice  # type: ignore
+            if self._is_kwarg(node.value) and isinstance(_literal(key), str):
+                return self._column(_literal(key))
+
+        if isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute) and node.func.attr == "get":
+            # params.get("level") / params.get("level", default)
+            args = node.args
+            if self._is_kwarg(node.func.value) and args and _literal(args[0]) is not _NOT_LITERAL and not node.keywords:
+                column = self._column(_literal(args[0]))
+                return column if len(args) == 1 else f"COALESCE({column}, {self._value(args[1])})"
+
+        if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.USub):
+            return f"(-{self._value(node.operand)})"
+
+        if isinstance(node, ast.BinOp):
+            left, right = self._value(node.left), self._value(node.right)
+            if isinstance(node.op, ast.Mod):
+                # 与 python 一致,结果的符号和除数相同
+                mod = self.dialect.mod
+                return mod.format(f"({mod.format(left, right)} + {right})", right)
+
+            sql_op = _ARITHMETIC_OPS.get(type(node.op))
+            if sql_op is not None:
+                return f"({left} {sql_op} {right})"
+
+        raise SqlCompileError(f"不支持的表达式: {ast.dump(node)}")
+
+    def _is_kwarg(self, node: ast.expr) -> bool:
+        return isinstance(node, ast.Name) and node.id == self.kwarg
+
+    def _column(self, name: Any) -> str:
+        if not isinstance(name, str):
+            raise SqlCompileError(f"参数名必须是字符串: {name!r}")
+
+        return self.columns.get(name, name)
+
+
+def pre_condition_sql(source: str, dialect: Union[str, SqlDialect] = "sqlite", columns=None) -> str:
+    """把 pre_condition 的源码翻译成 SQL 条件,不支持时抛 SqlCompileError
+
+    :param columns: 参数名 -> 列名/SQL 表达式,默认参数名即列名
+
+    注意 SQL 里 NULL 参与比较的结果为假,python 里缺参数或者与 None 比较大小会直接报错。
+    """
+    return _ConditionTranslator(_get_dialect(dialect), columns or {}).translate(source)
+
+
+def _get_dialect(dialect: Union[str, SqlDialect]) -> SqlDialect:
+    if isinstance(dialect, SqlDialect):
+        return dialect
+
+    try:
+        return DIALECTS[dialect]
+    except KeyError:
+        raise SqlCompileError(f"不支持的 SQL 方言: {dialect}")
+
+
+class NamespaceSqlCompiler:
+    """把一个 namespace 的分组计划编译成 SQL
+
+    Example:
+
+        >>> compiler = NamespaceSqlCompiler(export_namespace_plan(namespace_item), dialect="bigquery", unit="user_id")
+        >>> compiler.query("dw.users", outputs=["group_name", "experiment_trace"])
+
+    :param unit: unit 的列名或 SQL 表达式,会转成字符串,namespace 设置了 auto_upper_unit 时转大写
+    :param columns: pre_condition 参数名 -> 列名/SQL 表达式
+    :param conditions: (namespace name, experiment name) -> SQL 条件,覆盖 pre_condition 和标签,
+        标签、代码里定义的 pre_condition 等翻译不了的条件必须在这里给出
+    :param now: 判断实验时间窗口用的 unix 时间戳列名/SQL 表达式,为空时按编译时的时间判断,生成的 SQL 里不带时间条件
+    """
+
+    def __init__(
+        self,
+        namespace_plan: Dict[str, Any],
+        dialect: Union[str, SqlDialect] = "sqlite",
+        unit: str = "unit",
+        columns: Optional[Mapping[str, str]] = None,
+        conditions: Optional[Mapping[Tuple[str, str], str]] = None,
+        now: Optional[str] = None,
+    ) -> None:
+        self.plan = namespace_plan
+        self.dialect = _get_dialect(dialect)
+        self.unit = unit
+        self.conditions = conditions or {}
+        self.now = now
+        self._compiled_at = time.time()
+        self._translator = _ConditionTranslator(self.dialect, columns or {})
+        # 构造时就翻译所有条件,翻译不了的直接报错
+        self._condition_sqls: Dict[Tuple[str, str], str] = {}
+        self._collect_conditions(namespace_plan)
+
+        unit_text = self.dialect.text.format(unit)
+        self.unit_text = f"UPPER({unit_text})" if namespace_plan.get("auto_upper_unit") else unit_text
+
+    def hash_hex(self, salt: str) -> str:
+        """``H(salt + unit)`` 的十六进制表示"""
+        hashed = self.dialect.sha1_hex.format(self.dialect.concat.format(sql_literal(salt), self.unit_text))
+        return f"substr({hashed}, 1, {HASH_HEX_DIGITS})"
+
+    def salts(self) -> List[str]:
+        """整棵树用到的所有 salt"""
+        res: List[str] = []
+
+        def collect(namespace_plan):
+            res.append(namespace_plan["segment_salt"])
+            for experiment in namespace_plan["experiments"]:
+                res.append(experiment["salt"])
+                for group in experiment["groups"]:
+                    for layer in group["layers"]:
+                        collect(layer)
+
+        collect(self.plan)
+        return res
+
+    def expression(self, output: str = "group_name", hash_columns: Optional[Mapping[str, str]] = None) -> str:
+        """分组结果的 SQL 表达式,不在实验内为 NULL
+
+        :param output: group_name(最后一个分组名)、group_trace 或 experiment_trace
+        :param hash_columns: salt -> 已经算好 ``hash_hex`` 的列,不传时在表达式里直接计算,
+            同一个 salt 可能出现多次,数据库不一定会合并
+        """
+        if output not in OUTPUTS:
+            raise SqlCompileError(f"不支持的输出: {output},可选 {OUTPUTS}")
+
+        hash_ref: Callable[[str], str] = self.hash_hex if hash_columns is None else hash_columns.__getitem__
+
+        return self._namespace_sql(self.plan, hash_ref, output, (), ())
+
+    def query(
+        self, table: str, outputs: Sequence[str] = ("group_name",), columns: Optional[Sequence[str]] = None
+    ) -> str:
+        """对整张表算分组的查询,每个 salt 的哈希在子查询里只算一次
+
+        :param table: 表名或者子查询
+        :param columns: 结果里保留的列,默认只保留 unit
+        """
+        salts = list(dict.fromkeys(self.salts()))
+        hash_columns = {salt: f"_outplan_h{i}" for i, salt in enumerate(salts)}
+        inner = ", ".join(["_outplan_src.*"] + [f"{self.hash_hex(salt)} AS {hash_columns[salt]}" for salt in salts])
+        selected = list(columns) if columns is not None else [self.unit]
+        selected += [f"{self.expression(output, hash_columns)} AS {output}" for output in outputs]
+        return f"SELECT {', '.join(selected)} FROM (SELECT {inner} FROM {table} AS _outplan_src) AS _outplan_units"
+
+    def _namespace_sql(
+        self,
+        namespace_plan: Dict[str, Any],
+        hash_ref: Callable[[str], str],
+        output: str,
+        group_names: Tuple[str, ...],
+        experiment_names: Tuple[str, ...],
+    ) -> str:
+        experiments = namespace_plan["experiments"]
+        width = len(str(len(experiments)))
+        segment_index = self._segment(hash_ref(namespace_plan["segment_salt"]), namespace_plan["num_segments"])
+        position = f"{segment_index} * {width} + 1" if width > 1 else f"{segment_index} + 1"
+
+        def lookup(table):
+            encoded = "".join(str(index + 1).zfill(width) for index in table)
+            return f"substr('{encoded}', {position}, {width})"
+
+        tables = namespace_plan["segment_tables"]
+        mask = self._mask_sql(namespace_plan)
+        if isinstance(mask, int):
+            # 没有需要按行判断的实验,只用一张表
+            if str(mask) not in tables:
+                return "NULL"
+
+            selected = lookup(tables[str(mask)])
+        else:
+            whens = " ".join(f"WHEN {key} THEN {lookup(table)}" for key, table in tables.items())
+            selected = f"CASE {mask} {whens} END"
+
+        branches = []
+        for index, experiment in enumerate(experiments):
+            experiment_sql = self._experiment_sql(
+                namespace_plan, experiment, hash_ref, output, group_names, experiment_names
+            )
+            branches.append(f"WHEN '{str(index + 1).zfill(width)}' THEN {experiment_sql}")
+
+        return f"(CASE {selected} {' '.join(branches)} END)"
+
+    def _experiment_sql(self, namespace_plan, experiment, hash_ref, output, group_names, experiment_names):
+        experiment_names = (*experiment_names, experiment["name"])
+        value = hash_ref(experiment["salt"])
+        whens = []
+        for group in experiment["groups"]:
+            names = (*group_names, group["name"])
+            if group["layers"]:
+                layers = [
+                    self._namespace_sql(layer, hash_ref, output, names, experiment_names) for layer in group["layers"]
+                ]
+                result = layers[0] if len(layers) == 1 else f"COALESCE({', '.join(layers)})"
+            elif output == "group_name":
+                result = sql_literal(group["name"])
+            elif output == "group_trace":
+                result = sql_literal(".".join(names))
+            else:
+                result = sql_literal(".".join(experiment_names))
+
+            if group["threshold"] >= MAX_HASH:
+                whens.append(f"ELSE {result}")
+                break
+
+            threshold = format(group["threshold"], f"0{HASH_HEX_DIGITS}x") if group["threshold"] >= 0 else ""
+            whens.append(f"WHEN {value} <= '{threshold}' THEN {result}")
+
+        if len(whens) == 1 and whens[0].startswith("ELSE "):
+            return whens[0][len("ELSE ") :]
+
+        return f"(CASE {' '.join(whens)} END)"
+
+    def _segment(self, hex_sql: str, num_segments: int) -> str:
+        """``int(hex, 16) % num_segments``"""
+        if self.dialect.hex_to_int is not None:
+            return self.dialect.mod.format(self.dialect.hex_to_int.format(hex_sql), num_segments)
+
+        # 逐位计算,每一位的值乘以 16^k % n,和不会超过 15 * 15 * n
+        terms = []
+        for i in range(HASH_HEX_DIGITS):
+            weight = pow(16, HASH_HEX_DIGITS - 1 - i, num_segments)
+            if weight:
+                digit = self.dialect.position.format(f"'{_HEX_DIGITS}'", f"substr({hex_sql}, {i + 1}, 1)")
+                terms.append(f"({digit} - 1) * {weight}")
+
+        if not terms:
+            return "0"
+
+        return self.dialect.mod.format(f"({' + '.join(terms)})", num_segments)
+
+    def _mask_sql(self, namespace_plan: Dict[str, Any]) -> Union[int, str]:
+        """eligible mask 的 SQL 表达式,不需要按行判断时返回常量"""
+        base = 0
+        terms = []
+        for i, experiment in enumerate(namespace_plan["experiments"]):
+            conditions = []
+            if "start_time" in experiment or "end_time" in experiment:
+                window = self._window_sql(experiment)
+                if window is False:
+                    continue
+
+                if window is not True:
+                    conditions.append(window)
+
+            if experiment["conditional"]:
+                conditions.append(self._condition_sqls[(namespace_plan["name"], experiment["name"])])
+
+            if conditions:
+                terms.append(f"CASE WHEN {' AND '.join(conditions)} THEN {1 << i} ELSE 0 END")
+            else:
+                base |= 1 << i
+
+        if not terms:
+            return base
+
+        return "({})".format(" + ".join([str(base), *terms]))
+
+    def _window_sql(self, experiment: Dict[str, Any]) -> Union[bool, str]:
+        """实验在时间窗口内的 SQL 条件,没有传 now 时按编译时的时间直接算出结果"""
+        start_time = experiment.get("start_time")
+        end_time = experiment.get("end_time")
+        if self.now is None:
+            now = self._compiled_at
+            return (start_time is None or start_time <= now) and (end_time is None or now < end_time)
+
+        conditions = []
+        if start_time is not None:
+            conditions.append(f"{self.now} >= {sql_literal(start_time)}")
+
+        if end_time is not None:
+            conditions.append(f"{self.now} < {sql_literal(end_time)}")
+
+        return "({})".format(" AND ".join(conditions))
+
+    def _collect_conditions(self, namespace_plan: Dict[str, Any]) -> None:
+        for experiment in namespace_plan["experiments"]:
+            if experiment["conditional"]:
+                key = (namespace_plan["name"], experiment["name"])
+                self._condition_sqls[key] = self.condition_sql(namespace_plan["name"], experiment)
+
+            for group in experiment["groups"]:
+                for layer in group["layers"]:
+                    self._collect_conditions(layer)
+
+    def condition_sql(self, namespace_name: str, experiment: Dict[str, Any]) -> str:
+        """带条件的实验能否进入的 SQL 条件"""
+        condition = self.conditions.get((namespace_name, experiment["name"]))
+        if condition is not None:
+            return f"({condition})"
+
+        if experiment["user_tags"]:
+            raise SqlCompileError(f"实验({experiment['name']})的标签需要通过 conditions 给出 SQL 条件")
+
+        if not experiment["pre_condition"]:
+            raise SqlCompileError(
+                f"实验({experiment['name']})的 pre_condition 没有源码,需要通过 conditions 给出 SQL 条件"
+            )
+
+        try:
+            return self._translator.translate(experiment["pre_condition"])
+        except SqlCompileError as e:
+            raise SqlCompileError(f"实验({experiment['name']}) pre_condition 无法翻译成 SQL: {e!s}")
+
+
+def compile_namespace_sql(
+    namespace_item,
+    dialect: Union[str, SqlDialect] = "sqlite",
+    unit: str = "unit",
+    columns: Optional[Mapping[str, str]] = None,
+    conditions: Optional[Mapping[Tuple[str, str], str]] = None,
+    max_conditional_experiments: int = MAX_CONDITIONAL_EXPERIMENTS,
+    now: Optional[str] = None,
+) -> NamespaceSqlCompiler:
+    """NamespaceItem 导出分组计划后编译,参数见 ``NamespaceSqlCompiler``"""
+    plan = export_namespace_plan(namespace_item, max_conditional_experiments=max_conditional_experiments)
+    return NamespaceSqlCompiler(plan, dialect=dialect, unit=unit, columns=columns, conditions=conditions, now=now)
@@ -0,0 +1,226 @@
+# ruff: noqa: PLR2004
+import threading
+import time
+from collections import defaultdict
+
+from outplan.breaker import CircuitBreaker
+from outplan.client import ExperimentGroupClient
+from outplan.concurrency import ThreadExecutor
+from outplan.const import Hook
+from outplan.experiment import ExperimentItem, GroupItem, NamespaceItem
+
+from .test_client import simple_namespace
+
+
+def test_circuit_breaker_states():
+    breaker = CircuitBreaker("hook", failure_threshold=2, reset_timeout=0.05)
+    breaker.record_failure()
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.open
+    assert not breaker.allow()
+
+    # 半开时只放行一个试探调用,失败后重新打开
+    time.sleep(0.06)
+    assert breaker.allow()
+    assert not breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.open
+
+    time.sleep(0.06)
+    assert breaker.allow()
+    breaker.record_success()
+    assert breaker.state == CircuitBreaker.closed
+    assert breaker.stats()["rejected"] == 2
+
+
+def test_deadline_falls_back_to_last_known_namespace():
+    calls = defaultdict(int)
+    slow = threading.Event()
+    release = threading.Event()
+
+    def lazy_load_it(namespace):
+        calls[namespace] += 1
+        if slow.is_set():
+            release.wait(5)
+        return simple_namespace(namespace)
+
+    executor = ThreadExecutor(max_workers=8)
+    c = ExperimentGroupClient(
+        [],
+        lazy_load_namespaces_func=lambda: {"known": {"ttl": 0}, "cold": None},
+        lazy_load_namespace_item_func=lazy_load_it,
+        executor=executor,
+        call_timeout=0.05,
+        breaker_failure_threshold=3,
+        breaker_reset_timeout=0.2,
+    )
+    try:
+        assert c.get_group("known", unit="u", track=False) == "a"
+
+        slow.set()
+        # 没有加载过的返回 None,超时不做负缓存
+        assert c.get_group("cold", unit="u", track=False) is None
+        assert c.lazy_load_directory["cold"].namespace_item is None
+        for _ in range(5):
+            start = time.time()
+            # 重新加载超时,继续用上一次加载的 namespace
+            assert c.get_group("known", unit="u", track=False) == "a"
+            assert time.time() - start < 0.5
+
+        # 连续超时 3 次后熔断,不再调用 loader
+        assert c.breakers[Hook.lazy_load].state == CircuitBreaker.open
+        assert calls == {"known": 3, "cold": 1}
+        # 熔断期间同样降级为 None,不会变成 namespace 不存在
+        assert c.get_group("cold", unit="u", track=False) is None
+
+        # 熔断恢复后马上可以加载
+        slow.clear()
+        release.set()
+        time.sleep(0.25)
+        assert c.get_group("cold", unit="u", track=False) == "a"
+        assert calls["cold"] == 2
+    finally:
+        release.set()
+        executor.shutdown()
+
+
+def test_deadline_on_specified_group_and_tags():
+    release = threading.Event()
+    tag_calls = []
+
+    def slow_specified_group(context, namespace_name, unit, **params):
+        release.wait(5)
+        return "vip"
+
+    def slow_tag_filter(experiment_name, tag_id, **ignore):
+        tag_calls.append(tag_id)
+        release.wait(5)
+        return True
+
+    namespace = NamespaceItem(
+        name="slow_hooks",
+        bucket=2,
+        experiment_items=[
+            ExperimentItem(
+                name="tagged",
+                bucket=1,
+                group_items=[GroupItem("vip", 1)],
+                user_tags=[{"id": 1, "columns": []}, {"id": 2, "columns": []}],
+                tag_filter_func=slow_tag_filter,
+            ),
+            ExperimentItem(name="plain", bucket=1, group_items=[GroupItem("normal", 1)]),
+        ],
+    )
+    executor = ThreadExecutor(max_workers=16)
+    c = ExperimentGroupClient(
+        [namespace],
+        get_specified_group_func=slow_specified_group,
+        executor=executor,
+        breaker_failure_threshold=2,
+    )
+    try:
+
+        def get_group(unit):
+            c.setup_experiment_context(user_id=1, allow_specify_group=True)
+            try:
+                start = time.time()
+                group = c.get_group("slow_hooks", unit=unit, track=False, deadline_timeout=0.1)
+                assert time.time() - start < 0.5
+                return group
+            finally:
+                c.release_context()
+
+        # 指定分组和标签判断都超时:不指定分组,带标签的实验视为不满足条件
+        groups = {get_group(f"u{i}") for i in range(4)}
+        assert groups <= {"normal", None}
+        assert c.breakers[Hook.specified_group].state == CircuitBreaker.open
+        assert c.breakers[Hook.tag_filter].state == CircuitBreaker.open
+
+        # 熔断后不再调用 tag_filter_func
+        assert tag_calls
+        calls = len(tag_calls)
+        get_group("u5")
+        assert len(tag_calls) == calls
+    finally:
+        release.set()
+        executor.shutdown()
+
+
+def test_tracking_groups_share_one_deadline():
+    release = threading.Event()
+
+    def lazy_load_it(namespace):
+        release.wait(5)
+        return simple_namespace(namespace)
+
+    executor = ThreadExecutor(max_workers=8, timeout=5)
+    names = ["ns_a", "ns_b", "ns_c"]
+    c = ExperimentGroupClient(
+        [],
+        lazy_load_namespaces_func=lambda: names,
+        lazy_load_namespace_item_func=lazy_load_it,
+        executor=executor,
+        call_timeout=0.1,
+        breaker_failure_threshold=100,
+    )
+    try:
+        # 预加载和每个 namespace 的分组共用一个预算,而不是每个 namespace 各等一次 call_timeout
+        start = time.time()
+        assert c.get_tracking_groups(names, unit="u", track=False) == [None, None, None]
+        assert time.time() - start < 0.3
+    finally:
+        release.set()
+        executor.shutdown()
+
+
+def test_serial_tag_checks_respect_deadline():
+    tag_calls = []
+
+    def slow_tag_filter(experiment_name, tag_id, **ignore):
+        tag_calls.append(tag_id)
+        time.sleep(0.03)
+        return True
+
+    namespace = NamespaceItem(
+        name="serial_tags",
+        bucket=1,
+        experiment_items=[
+            ExperimentItem(
+                name="tagged",
+                bucket=1,
+                group_items=[GroupItem("vip", 1)],
+                user_tags=[{"id": 1, "columns": []}],
+                tag_filter_func=slow_tag_filter,
+            ),
+        ],
+    )
+    # 没有 executor 时无法中断 hook,但每次调用前检查 deadline 和熔断器
+    c = ExperimentGroupClient([namespace], call_timeout=0.01, breaker_failure_threshold=2)
+    assert c.get_group("serial_tags", unit="u", track=False, deadline_timeout=0) is None
+    assert tag_calls == []
+
+    assert [c.get_group("serial_tags", unit="u", track=False) for _ in range(2)] == ["vip", "vip"]
+    assert c.breakers[Hook.tag_filter].state == CircuitBreaker.open
+    assert c.get_group("serial_tags", unit="u", track=False) is None
+    assert len(tag_calls) == 2
+
+
+def test_timeout_is_passed_to_pre_condition():
+    namespace = NamespaceItem(
+        name="timeout_param",
+        bucket=1,
+        experiment_items=[
+            ExperimentItem(
+                name="long",
+                bucket=1,
+                group_items=[GroupItem("long_a", 1)],
+                pre_condition=lambda timeout=None, **ignore: timeout == "long",
+            ),
+        ],
+    )
+    c = ExperimentGroupClient([namespace], call_timeout=1)
+    assert c.get_group("timeout_param", unit="u", track=False, timeout="long") == "long_a"
+    assert c.get_group("timeout_param", unit="u", track=False, timeout="short") is None
+    groups = c.get_tracking_groups(["timeout_param"], unit="u", track=False, timeout="long")
+    assert [group.last_group for group in groups] == ["long_a"]
@@ -0,0 +1,79 @@
+# ruff: noqa: PLR2004
+import copy
+import os
+import tempfile
+
+from outplan.cache import CompiledNamespaceCache
+from outplan.client import ExperimentGroupClient
+from outplan.experiment import NamespaceItem
+from outplan.loader import NamespaceLoader
+
+from .test_experiment import namespace_spec_dict, tag_filter, test_tag_namespace_spec_dict
+from .test_loader import same_group
+
+
+def test_compiled_cache_round_trip():
+    cache = CompiledNamespaceCache(tempfile.mkdtemp())
+    specs = [namespace_spec_dict, test_tag_namespace_spec_dict]
+
+    cold = NamespaceLoader(tag_filter_func=tag_filter, cache=cache).load_many(specs)
+    assert (cache.hits, cache.misses) == (0, 2)
+
+    warm = NamespaceLoader(tag_filter_func=tag_filter, cache=cache).load_many(specs)
+    assert (cache.hits, cache.misses) == (2, 2)
+    assert warm[0] is not cold[0]
+    # segment 表已经算好,不需要重新抽样
+    assert warm[0]._segment_tables
+
+    expected = NamespaceItem.from_dict(namespace_spec_dict)
+    for i in range(300):
+        unit, user_id = f"unit-{i}", i % 30
+        assert same_group(warm[0].get_group(unit, user_id=user_id), expected.get_group(unit, user_id=user_id))
+
+    # tag_filter_func 加载后重新设置
+    group = warm[1].get_group(10, device_id=10)
+    assert (group.experiment_trace(), group.group_trace()) == ("t1.nn1e", "g1.ngg")
+
+
+def test_compiled_cache_invalidation(monkeypatch):
+    directory = tempfile.mkdtemp()
+    cache = CompiledNamespaceCache(directory)
+    loader = NamespaceLoader(cache=cache)
+    loader.load_dict(namespace_spec_dict)
+
+    # spec 变化
+    changed = copy.deepcopy(namespace_spec_dict)
+    changed["experiment_items"][1]["group_items"][0]["name"] = "h_ctl_3"
+    assert loader.load_dict(changed).get_group_by_name("h_ctl_3") is not None
+    assert (cache.hits, cache.misses) == (0, 2)
+
+    # 损坏的文件当作没有缓存,重新写入
+    digest = loader.memo.digest(namespace_spec_dict)
+    with open(cache.path(digest), "wb") as f:
+        f.write(b"broken")
+    assert cache.get(digest) is None
+    assert not os.path.exists(cache.path(digest))
+    loader.load_dict(namespace_spec_dict)
+    assert cache.get(digest) is not None
+
+    # outplan 版本变化后不再命中,旧文件可以清理掉
+    monkeypatch.setattr("outplan.cache.__version__", "999.0.0")
+    assert cache.get(digest) is None
+    assert cache.prune() == 2
+    assert os.listdir(directory) == []
+
+
+def test_client_lazy_load_spec_through_cache():
+    cache = CompiledNamespaceCache(tempfile.mkdtemp())
+
+    def make_client():
+        return ExperimentGroupClient(
+            [],
+            lazy_load_namespaces_func=lambda: ["namespace_2"],
+            lazy_load_namespace_item_func=lambda name: copy.deepcopy(namespace_spec_dict),
+            namespace_loader=NamespaceLoader(cache=cache),
+        )
+
+    assert make_client().get_group("namespace_2", unit="add", user_id=15, track=False) == "h_ctl_2"
+    assert make_client().get_group("namespace_2", unit="add", user_id=15, track=False) == "h_ctl_2"
+    assert (cache.hits, cache.misses) == (1, 1)
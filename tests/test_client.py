@@ -0,0 +1,325 @@
+# ruff: noqa: PLR2004
+import threading
+from collections import defaultdict
+
+import pytest
+
+from outplan.client import ExperimentGroupClient
+from outplan.const import LazyLoadState
+from outplan.exceptions import ExperimentValidateError
+from outplan.experiment import ExperimentItem, GroupItem, NamespaceItem
+from outplan.local import experiment_context
+
+from .test_experiment import HomepageNamespace
+
+
+def simple_namespace(name, group_name="a"):
+    return NamespaceItem(
+        name=name,
+        experiment_items=[ExperimentItem(name=f"{name}_exp", bucket=10, group_items=[GroupItem(group_name, 1)])],
+    )
+
+
+def test_registry_snapshot_is_immutable():
+    c = ExperimentGroupClient([simple_namespace("ns_a")])
+    snapshot = c.registry
+
+    c.add_namespace(simple_namespace("ns_b"))
+    assert list(snapshot.namespaces) == ["ns_a"]
+    assert sorted(c.namespaces) == ["ns_a", "ns_b"]
+
+    with pytest.raises(TypeError):
+        snapshot.namespaces["ns_c"] = simple_namespace("ns_c")
+
+    with pytest.raises(ExperimentValidateError):
+        c.add_namespace(simple_namespace("ns_a"))
+
+    with pytest.raises(ExperimentValidateError):
+        c.replace_namespaces([simple_namespace("ns_x"), simple_namespace("ns_x")])
+
+    c.replace_namespaces([simple_namespace("ns_c")])
+    assert list(c.namespaces) == ["ns_c"]
+    assert c.get_group("ns_c", unit="u", track=False) == "a"
+    with pytest.raises(ExperimentValidateError):
+        c.get_group("ns_a", unit="u", track=False)
+
+
+def test_registry_consistent_under_concurrent_swaps():
+    set_a = [simple_namespace(f"a{i}", group_name="a") for i in range(5)]
+    set_b = [simple_namespace(f"b{i}", group_name="b") for i in range(5)]
+    names_a, names_b = {ns.name for ns in set_a}, {ns.name for ns in set_b}
+    c = ExperimentGroupClient(set_a)
+    stop = threading.Event()
+    errors = []
+
+    def writer():
+        i = 0
+        while not stop.is_set():
+            c.replace_namespaces(set_b if i % 2 == 0 else set_a)
+            i += 1
+
+    def reader():
+        for _ in range(2000):
+            names = set(c.registry.namespaces)
+            if names not in (names_a, names_b):
+                errors.append(names)
+
+    threads = [threading.Thread(target=writer)] + [threading.Thread(target=reader) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads[1:]:
+        t.join()
+    stop.set()
+    threads[0].join()
+
+    assert not errors
+
+
+class FakeClock:
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+
+def test_lazy_directory_negative_cache(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr("outplan.client.time", clock)
+    calls = defaultdict(int)
+
+    def lazy_load_it(namespace):
+        calls[namespace] += 1
+        if namespace == "broken":
+            raise RuntimeError("loader down")
+        if namespace == "missing":
+            return None
+        return simple_namespace(namespace)
+
+    c = ExperimentGroupClient(
+        [],
+        lazy_load_namespaces_func=lambda: ["ok", "missing", "broken"],
+        lazy_load_namespace_item_func=lazy_load_it,
+        lazy_load_expire=600,
+        lazy_load_negative_expire=30,
+    )
+    assert c.lazy_load_namespaces == ()
+    for _ in range(5):
+        with pytest.raises(ExperimentValidateError):
+            c.get_namespace_item("missing")
+        with pytest.raises(ExperimentValidateError):
+            c.get_namespace_item("typo")
+        assert c.get_namespace_item("ok").name == "ok"
+    assert calls == {"missing": 1, "ok": 1}
+    assert c.lazy_load_directory["missing"].state == LazyLoadState.missing
+
+    with pytest.raises(RuntimeError):
+        c.get_namespace_item("broken")
+    with pytest.raises(ExperimentValidateError):
+        c.get_namespace_item("broken")
+    assert calls["broken"] == 1
+
+    # 负缓存过期后重试,正常的 namespace 还没过期
+    clock.now += 31
+    with pytest.raises(ExperimentValidateError):
+        c.get_namespace_item("missing")
+    assert c.get_namespace_item("ok").name == "ok"
+    assert calls == {"missing": 2, "ok": 1, "broken": 1}
+
+
+def test_lazy_directory_ttl_and_version(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr("outplan.client.time", clock)
+    calls = defaultdict(int)
+    listing = {"a": {"ttl": 10, "version": 1}, "b": None}
+    fail = set()
+
+    def lazy_load_it(namespace):
+        calls[namespace] += 1
+        if namespace in fail:
+            raise RuntimeError("loader down")
+        return simple_namespace(namespace)
+
+    c = ExperimentGroupClient(
+        [],
+        lazy_load_namespaces_func=lambda: dict(listing),
+        lazy_load_namespace_item_func=lazy_load_it,
+        lazy_load_expire=5,
+    )
+    c.get_namespace_item("a")
+    c.get_namespace_item("b")
+    clock.now += 6
+    c.get_namespace_item("a")
+    c.get_namespace_item("b")
+    assert calls == {"a": 1, "b": 2}
+
+    # 目录里的版本变化后马上重新加载
+    listing["a"] = {"ttl": 10, "version": 2}
+    clock.now += 6
+    c.get_namespace_item("a")
+    assert calls["a"] == 2
+    assert c.lazy_load_directory["a"].loaded_version == 2
+
+    # 加载失败时继续使用旧的 namespace
+    fail.add("a")
+    clock.now += 11
+    first = c.get_namespace_item("a")
+    second = c.get_namespace_item("a")
+    assert first is second
+    assert calls["a"] == 3
+    assert c.lazy_load_directory["a"].state == LazyLoadState.failed
+
+
+def test_request_cache_key_uses_condition_params():
+    namespace = NamespaceItem(
+        name="cond_ns",
+        experiment_items=[
+            ExperimentItem(
+                name="vip",
+                bucket=10,
+                group_items=[GroupItem("vip_a", 1)],
+                pre_condition=lambda level, **ignore: level == "vip",
+            ),
+        ],
+    )
+    c = ExperimentGroupClient([namespace, simple_namespace("plain")], request_cache_size=2)
+    assert namespace.condition_params == ("level",)
+    assert c.namespaces["plain"].condition_params == ()
+
+    c.setup_experiment_context(user_id=1)
+    try:
+        assert c.get_group("cond_ns", unit="u", track=False, level="vip") == "vip_a"
+        # 参数不同,不能命中上一次的缓存
+        assert c.get_group("cond_ns", unit="u", track=False, level="normal") is None
+
+        # 与条件无关的参数不影响缓存,不可哈希的参数直接跳过缓存
+        first = c.get_tracking_group("cond_ns", unit="u", track=False, level="vip", page=1)
+        assert c.get_tracking_group("cond_ns", unit="u", track=False, level="vip", page=2) is first
+        assert c.get_group("plain", unit="u", track=False, tags=["x"]) == "a"
+
+        c.get_group("plain", unit="v", track=False)
+        assert len(experiment_context.cached_group) == 2
+    finally:
+        c.release_context()
+
+    # use_fast_sample 改变 segment 分配,不能命中不带它的缓存
+    c = ExperimentGroupClient([HomepageNamespace])
+    units = [f"unit-{i}" for i in range(100)]
+    expected = []
+    for params in ({}, {"use_fast_sample": True}):
+        groups = [HomepageNamespace.get_group(unit, user_id=1, **params) for unit in units]
+        expected.append([group and group.last_group for group in groups])
+    assert expected[0] != expected[1]
+    c.setup_experiment_context(user_id=1)
+    try:
+        for params, groups in zip(({}, {"use_fast_sample": True}), expected):
+            groups_in_request = [
+                c.get_group("namespace_1", unit=unit, track=False, user_id=1, **params) for unit in units
+            ]
+            assert groups_in_request == groups
+    finally:
+        c.release_context()
+
+    # 签名里有 **kwargs 时推断不出来,所有参数都算
+    opaque = ExperimentItem(
+        name="opaque", bucket=1, group_items=[GroupItem("o", 1)], pre_condition=lambda **params: True
+    )
+    assert opaque.condition_params is None
+    declared = ExperimentItem.from_dict(
+        {
+            "name": "declared",
+            "bucket": 1,
+            "group_items": [{"name": "d", "weight": 1}],
+            "pre_condition": "lambda **params: params['level'] == 'vip'",
+            "condition_params": ["level"],
+        }
+    )
+    assert declared.condition_params == {"level"}
+    assert declared.to_dict()["condition_params"] == ["level"]
+
+
+def test_eligibility_memo_per_request():
+    calls = defaultdict(int)
+
+    def is_vip(level, **ignore):
+        calls[level] += 1
+        return level == "vip"
+
+    shared_layer = NamespaceItem(
+        name="shared_layer",
+        experiment_items=[
+            ExperimentItem(name="vip", bucket=10, group_items=[GroupItem("vip_a", 1)], pre_condition=is_vip),
+        ],
+    )
+
+    def outer(name):
+        return NamespaceItem(
+            name=name,
+            experiment_items=[
+                ExperimentItem(
+                    name=f"{name}_exp",
+                    bucket=10,
+                    group_items=[GroupItem(f"{name}_layer", 1, layer_namespaces=[shared_layer])],
+                ),
+            ],
+            validate_group_names=False,
+        )
+
+    c = ExperimentGroupClient([outer("outer_1"), outer("outer_2")])
+    c.setup_experiment_context(user_id=1)
+    try:
+        for _ in range(3):
+            for name in ("outer_1", "outer_2"):
+                assert c.get_group(name, unit="u", track=False, cache=False, level="vip") == "vip_a"
+                assert c.get_group(name, unit="u", track=False, cache=False, level="normal") is None
+
+        assert calls == {"vip": 1, "normal": 1}
+    finally:
+        c.release_context()
+
+    assert not hasattr(experiment_context, "eligibility_memo")
+    c.get_group("outer_1", unit="u", track=False, level="vip")
+    c.get_group("outer_1", unit="u", track=False, level="vip")
+    assert calls["vip"] == 3
+
+
+def test_exposure_sampling_is_deterministic_per_unit():
+    events = []
+
+    class Tracker:
+        def track(self, user_id, pdid, event_name, properties=None):
+            events.append((pdid, properties))
+
+    namespace = NamespaceItem(
+        name="hot_ns",
+        exposure_sample_rate=0.1,
+        experiment_items=[
+            ExperimentItem(name="hot_exp", bucket=5, group_items=[GroupItem("hot_a", 1)]),
+            ExperimentItem(name="warm_exp", bucket=5, group_items=[GroupItem("warm_a", 1)], exposure_sample_rate=0.5),
+        ],
+    )
+    c = ExperimentGroupClient([namespace], tracking_client=Tracker())
+    units = [f"device-{i}" for i in range(4000)]
+    for _ in range(2):
+        for unit in units:
+            c.get_group("hot_ns", unit=unit, pdid=unit)
+
+    assigned = {unit: c.get_group("hot_ns", unit=unit, track=False) for unit in units}
+    sampled = {pdid for pdid, _ in events}
+    # 同一个 unit 每次的采样结果相同,事件里带上采样率
+    assert len(events) == 2 * len(sampled)
+    for pdid, properties in events:
+        expected = 0.1 if assigned[pdid] == "hot_a" else 0.5
+        assert properties["exposure_sample_rate"] == expected
+
+    for group, rate in (("hot_a", 0.1), ("warm_a", 0.5)):
+        total = sum(1 for unit in units if assigned[unit] == group)
+        hits = sum(1 for unit in sampled if assigned[unit] == group)
+        assert abs(hits / total - rate) < 0.05
+
+    spec = namespace.to_dict()
+    assert spec["exposure_sample_rate"] == 0.1
+    assert spec["experiment_items"][1]["exposure_sample_rate"] == 0.5
+    assert NamespaceItem.from_dict(spec).exposure_sample_rate_of(namespace.experiment_items[0]) == 0.1
+    with pytest.raises(ExperimentValidateError):
+        ExperimentItem(name="bad", bucket=1, group_items=[GroupItem("b", 1)], exposure_sample_rate=0)
@@ -0,0 +1,93 @@
+# ruff: noqa: PLR2004
+import time
+
+import pytest
+
+from outplan.client import ExperimentGroupClient
+from outplan.concurrency import SerialExecutor
+from outplan.exceptions import ExecutorTimeoutError
+from outplan.experiment import ExperimentItem, GroupItem, NamespaceItem
+from outplan.local import experiment_context
+
+from .test_client import simple_namespace
+
+gevent = pytest.importorskip("gevent")
+
+from outplan.concurrency import GeventExecutor  # noqa: E402
+
+
+def test_gevent_executor_map():
+    executor = GeventExecutor(pool_size=4, timeout=0.2)
+
+    def work(seconds):
+        gevent.sleep(seconds)
+        if seconds < 0:
+            raise ValueError("negative")
+        return seconds
+
+    outcomes = executor.map(work, [0.05, 0.05, 1, -1])
+    assert [outcome.value for outcome in outcomes[:2]] == [0.05, 0.05]
+    assert isinstance(outcomes[2].error, ExecutorTimeoutError)
+    assert isinstance(outcomes[3].error, ValueError)
+    assert SerialExecutor().map(lambda x: 1 / x, [1, 0])[1].error is not None
+    assert isinstance(executor.call(lambda: work(1), timeout=0.05).error, ExecutorTimeoutError)
+
+
+def test_concurrent_lazy_load():
+    def lazy_load_it(namespace):
+        gevent.sleep(0.1)
+        return simple_namespace(namespace)
+
+    names = [f"ns_{i}" for i in range(5)]
+    c = ExperimentGroupClient(
+        [],
+        lazy_load_namespaces_func=lambda: names,
+        lazy_load_namespace_item_func=lazy_load_it,
+        executor=GeventExecutor(pool_size=8, timeout=1),
+    )
+    start = time.time()
+    groups = c.get_tracking_groups([*names, "not_exists"], unit="u", track=False)
+    assert time.time() - start < 0.3
+    assert [group.last_group if group else None for group in groups] == ["a"] * 5 + [None]
+
+
+def test_concurrent_eligibility_with_context():
+    def slow_condition(seconds, result):
+        def pre_condition(**ignore):
+            gevent.sleep(seconds)
+            # 子 greenlet 里也能读到请求的 context
+            return experiment_context.user_id == 1 and result
+
+        return pre_condition
+
+    namespace = NamespaceItem(
+        name="slow_tags",
+        bucket=4,
+        experiment_items=[
+            ExperimentItem(
+                name=f"exp_{i}",
+                bucket=1,
+                group_items=[GroupItem(f"g_{i}", 1)],
+                pre_condition=slow_condition(0.1 if i else 5, i == 3),
+            )
+            for i in range(4)
+        ],
+    )
+    logs = []
+
+    class Logger:
+        error = info = logs.append
+
+    c = ExperimentGroupClient([namespace], executor=GeventExecutor(timeout=0.3), logger=Logger())
+    c.setup_experiment_context(user_id=1)
+    try:
+        start = time.time()
+        c.get_group("slow_tags", unit="u", track=False)
+        assert time.time() - start < 0.6
+
+        # 只有 exp_3 满足条件,exp_0 超时视为不满足,之后的请求直接用缓存的判断结果
+        groups = {c.get_group("slow_tags", unit=f"u{i}", track=False) for i in range(50)}
+        assert groups == {"g_3", None}
+        assert len(logs) == 1
+    finally:
+        c.release_context()
@@ -0,0 +1,153 @@
+# ruff: noqa: PLR2004
+from collections import Counter
+
+import pytest
+
+from outplan.client import ExperimentGroupClient
+from outplan.dataframe import _encode, assign_groups, leaf_group_names
+from outplan.experiment import ExperimentItem, GroupItem, NamespaceItem
+
+from .test_experiment import AutoUpperUnitNamespace, HomepageNamespace
+
+
+class Tracker:
+    def __init__(self):
+        self.events = []
+
+    def track(self, user_id, pdid, event_name, properties=None):
+        self.events.append((user_id, properties["group"]))
+
+
+class Scalar:
+    """numpy 标量的替身"""
+
+    ndim = 0
+
+    def __init__(self, value):
+        self.value = value
+
+    def tolist(self):
+        return self.value
+
+
+def expected(client, namespace_name, unit, **params):
+    tracking_group = client.get_tracking_group(namespace_name, unit=unit, track=False, cache=False, **params)
+    if tracking_group is None:
+        return (None, None, None)
+
+    return (tracking_group.last_group, tracking_group.group_trace(), tracking_group.experiment_trace())
+
+
+def test_assign_groups_matches_client():
+    calls = Counter()
+
+    def is_vip(level, **ignore):
+        calls[level] += 1
+        return level == "vip"
+
+    namespace = NamespaceItem(
+        name="batch",
+        bucket=10,
+        experiment_items=[
+            ExperimentItem(
+                name="vip",
+                bucket=5,
+                group_items=[GroupItem("vip_a", 0.5), GroupItem("vip_b", 0.5)],
+                pre_condition=is_vip,
+            ),
+            ExperimentItem(name="all", bucket=5, group_items=[GroupItem("all_a", 1)]),
+        ],
+    )
+    tracker = Tracker()
+    c = ExperimentGroupClient([namespace, HomepageNamespace, AutoUpperUnitNamespace], tracking_client=tracker)
+    units = [f"u{i % 50}" for i in range(300)]
+    levels = ["vip" if i % 3 else "normal" for i in range(300)]
+
+    groups = c.assign_groups("batch", units, params={"level": levels})
+    # pre_condition 在整批里每种参数只判断一次,默认不上报
+    assert calls == {"vip": 1, "normal": 1}
+    assert tracker.events == []
+    assert groups == [expected(c, "batch", unit, level=level)[0] for unit, level in zip(units, levels)]
+
+    user_ids = [i % 30 for i in range(300)]
+    columns = c.assign_groups("namespace_1", units, params={"user_id": user_ids}, trace=True)
+    assert list(zip(columns["group"], columns["group_trace"], columns["experiment_trace"])) == [
+        expected(c, "namespace_1", unit, user_id=user_id) for unit, user_id in zip(units, user_ids)
+    ]
+
+    # unit 为空时按 unit_type 取参数,auto_upper_unit 与 client 一致
+    pdids = [f"pdid-{i}-x" for i in range(50)]
+    assert c.assign_groups("auto_upper_namespace1", [""] * 50, params={"pdid": pdids}) == [
+        expected(c, "auto_upper_namespace1", "", pdid=pdid)[0] for pdid in pdids
+    ]
+
+    # 上报时 unit 和参数相同的行只上报一次
+    c.assign_groups("batch", units[:100], params={"level": "vip", "user_id": 7}, track=True)
+    assert len(tracker.events) == 50
+    assert {user_id for user_id, _ in tracker.events} == {7}
+
+
+def test_assign_groups_default_params():
+    c = ExperimentGroupClient([HomepageNamespace])
+    units = [f"u{i}" for i in range(100)]
+    # 不传参数时 pre_condition 拿到的 user_id/pdid 与 client 的默认值一致
+    assert c.assign_groups("namespace_1", units) == [expected(c, "namespace_1", unit)[0] for unit in units]
+    assert c.assign_groups("namespace_1", units, params={"user_id": Scalar(12)}) == [
+        expected(c, "namespace_1", unit, user_id=12)[0] for unit in units
+    ]
+
+
+def test_assign_groups_pandas():
+    pd = pytest.importorskip("pandas")
+
+    c = ExperimentGroupClient([HomepageNamespace])
+    frame = pd.DataFrame(
+        {"unit": [f"u{i}" for i in range(200)], "user_id": [i % 30 for i in range(200)]}, index=range(5, 205)
+    )
+    frame["group"] = c.assign_groups("namespace_1", frame.unit, params={"user_id": frame.user_id})
+    assert frame.group.dtype == "category"
+    assert frame.group.tolist() == [
+        expected(c, "namespace_1", unit, user_id=user_id)[0] for unit, user_id in zip(frame.unit, frame.user_id)
+    ]
+
+    traces = c.assign_groups("namespace_1", frame.unit, params={"user_id": frame.user_id}, trace=True)
+    assert list(traces.columns) == ["group", "group_trace", "experiment_trace"]
+    assert (traces.index == frame.index).all()
+
+
+def test_assign_groups_arrow():
+    pa = pytest.importorskip("pyarrow")
+
+    c = ExperimentGroupClient([HomepageNamespace])
+    units = pa.array([f"u{i}" for i in range(200)])
+    user_ids = pa.array([i % 30 for i in range(200)])
+    groups = c.assign_groups("namespace_1", units, params={"user_id": user_ids})
+    assert pa.types.is_dictionary(groups.type)
+    assert groups.to_pylist() == [expected(c, "namespace_1", f"u{i}", user_id=i % 30)[0] for i in range(200)]
+
+    table = c.assign_groups("namespace_1", units, params={"user_id": user_ids}, trace=True)
+    assert table.column_names == ["group", "group_trace", "experiment_trace"]
+
+
+def test_encode_with_shared_group_names():
+    # 不同实验里同名的分组很常见,category 里只出现一次
+    namespace = NamespaceItem(
+        name="shared_names",
+        bucket=10,
+        validate_group_names=False,
+        experiment_items=[
+            ExperimentItem(name=name, bucket=5, group_items=[GroupItem("control", 0.5), GroupItem("treatment", 0.5)])
+            for name in ("exp_a", "exp_b")
+        ],
+    )
+    assert leaf_group_names(namespace) == ["control", "treatment"]
+
+    values = ["control", "treatment", "x", None, "x", "control"]
+    codes, categories = _encode(values, [*leaf_group_names(namespace), "control"])
+    assert categories == ["control", "treatment", "x"]
+    assert [categories[code] if code >= 0 else None for code in codes] == values
+
+    groups = assign_groups(namespace, [f"u{i}" for i in range(100)])
+    codes, categories = _encode(groups, leaf_group_names(namespace))
+    assert len(set(categories)) == len(categories)
+    assert [categories[code] if code >= 0 else None for code in codes] == groups
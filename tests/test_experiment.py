@@ -1,14 +1,17 @@
 # ruff: noqa: PLR2004,E501
+import json
 import random
 import string
 import time
 from collections import defaultdict
+from unittest import mock
 
 import pytest
 
 from outplan.client import ExperimentGroupClient
+from outplan.const import GroupResultType
 from outplan.exceptions import ExperimentValidateError
-from outplan.experiment import ExperimentItem, GroupItem, NamespaceItem
+from outplan.experiment import ExperimentItem, GroupItem, NamespaceItem, generate_planout_namespace
 from outplan.local import experiment_context
 
 HomepageNamespace = NamespaceItem(
@@ -904,3 +907,94 @@ def test_auto_upper_unit_namespace():
             )
         )
     assert not all(res)
+
+
+def test_get_group_matches_planout():
+    big_namespace = NamespaceItem(
+        name="big_bucket",
+        bucket=2000,
+        experiment_items=[
+            ExperimentItem(name="ramp", bucket=700, group_items=[GroupItem(name="ramp_a", weight=1)]),
+            ExperimentItem(
+                name="cond",
+                bucket=600,
+                group_items=[GroupItem(name="cond_a", weight=0.3), GroupItem(name="cond_b", weight=0.7)],
+                pre_condition=lambda user_id, **ignore: user_id % 2 == 0,
+            ),
+            ExperimentItem(name="tail", bucket=500, group_items=[GroupItem(name="tail_a", weight=1)]),
+        ],
+    )
+
+    for namespace_item in (big_namespace, HomepageNamespace):
+        for i in range(300):
+            params = {"user_id": i % 30}
+            if i % 3 == 0:
+                params["use_fast_sample"] = True
+
+            valid = [item for item in namespace_item.experiment_items if item.is_eligible(**params)]
+            res = generate_planout_namespace(namespace_item, valid)(unit=f"u-{i}", **params) if valid else None
+            expected = res and res.get("group")
+            tracking_group = namespace_item.get_group(f"u-{i}", **params)
+            if expected is None:
+                assert tracking_group is None
+            elif expected.result_type == GroupResultType.group:
+                assert tracking_group.experiment_names == [res.get("experiment_name")]
+                assert tracking_group.group_names == [expected.name]
+            elif tracking_group is not None:
+                assert tracking_group.experiment_names[-1] == res.get("experiment_name")
+                assert tracking_group.group_names[-1] == expected.name
+
+
+def test_namespace_to_dict_with_segment_allocation():
+    namespace_item = NamespaceItem.from_dict(namespace_spec_dict)
+    data = json.loads(json.dumps(namespace_item.to_dict(segment_allocation=True)))
+    assert "segment_allocation" in data
+    assert "segment_allocation" not in namespace_item.to_dict()
+
+    loaded = NamespaceItem.from_dict(data)
+    assert loaded.to_dict() == namespace_item.to_dict()
+    for key, table in namespace_item._segment_tables.items():
+        assert loaded._segment_tables[key] == table
+
+    # 不需要重新抽样
+    with mock.patch("outplan.experiment.allocate_segments", side_effect=AssertionError):
+        for i in range(100):
+            expected = namespace_item.get_group(f"u-{i}", user_id=i % 30)
+            res = loaded.get_group(f"u-{i}", user_id=i % 30)
+            assert (res and (res.experiment_trace(), res.group_trace())) == (
+                expected and (expected.experiment_trace(), expected.group_trace())
+            )
+
+    # namespace 改名后 salt 不同,保存的分配不能再用
+    renamed = dict(data, name="namespace_renamed")
+    with pytest.raises(ExperimentValidateError):
+        NamespaceItem.from_dict(renamed)
+
+    # 实验配置变了,保存的分配不能再用
+    data["experiment_items"][0]["bucket"] = 8
+    with pytest.raises(ExperimentValidateError):
+        NamespaceItem.from_dict(data)
+
+    with pytest.raises(ExperimentValidateError):
+        HomepageNamespace.to_dict()
+
+
+def test_tracking_group_shares_result_path():
+    first = HomepageNamespace.get_group("add", user_id=15)
+    second = HomepageNamespace.get_group("add", user_id=15)
+    assert first is not second
+    assert first.path is second.path
+    assert first.group_trace() == "collect.c8-a0.clt_p8_2_a1"
+    assert first.experiment_trace() == "homepage_exp.clt_p8.clt_p8_2"
+    assert first.last_group == "clt_p8_2_a1"
+    assert first.last_experiment == "clt_p8_2"
+    assert first.group_extra_params == "extra params"
+
+    # 修改时复制,不影响共享的路径和其他结果
+    first.add_group_name("outer")
+    first.add_experiment_name("outer_exp")
+    assert first.path is None
+    assert first.group_trace() == "outer.collect.c8-a0.clt_p8_2_a1"
+    assert first.experiment_names == ["clt_p8_2", "clt_p8", "homepage_exp", "outer_exp"]
+    assert second.group_trace() == "collect.c8-a0.clt_p8_2_a1"
+    assert HomepageNamespace.get_group("add", user_id=15).group_names == ["clt_p8_2_a1", "c8-a0", "collect"]
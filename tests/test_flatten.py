@@ -0,0 +1,161 @@
+# ruff: noqa: PLR2004
+import pytest
+
+from outplan.exceptions import ExperimentValidateError
+from outplan.experiment import ExperimentItem, GroupItem, NamespaceItem
+from outplan.plan import assign_from_plan, encode_unit, export_namespace_plan
+
+from .test_experiment import HomepageNamespace, TestTagNamespace
+
+
+def deep_namespace(depth, prefix="d"):
+    def group(name, weight):
+        layers = [deep_namespace(depth - 1, f"{prefix}{name}")] if depth > 1 else None
+        return GroupItem(f"{prefix}{name}", weight, layer_namespaces=layers, extra_params={"name": f"{prefix}{name}"})
+
+    return NamespaceItem(
+        name=f"ns_{prefix}",
+        bucket=20,
+        validate_group_names=False,
+        exposure_sample_rate=0.5 if depth % 2 else None,
+        experiment_items=[
+            ExperimentItem(name=f"e_{prefix}", bucket=15, group_items=[group("a", 0.3), group("b", 0.7)]),
+            ExperimentItem(name=f"f_{prefix}", bucket=3, group_items=[group("c", 1)], exposure_sample_rate=0.2),
+        ],
+    )
+
+
+def level_by_level(namespace_item, unit, **params):
+    return namespace_item._get_group(unit, encode_unit(unit), params)
+
+
+def test_flattened_tree_matches_level_by_level():
+    namespace_item = deep_namespace(4)
+    for namespace, params_list in [
+        (namespace_item, [{}, {"use_fast_sample": True}]),
+        # 带 pre_condition/标签的 namespace 请求时计算 mask
+        (HomepageNamespace, [{"user_id": user_id} for user_id in (1, 5, 12, 17, 25)]),
+        (TestTagNamespace, [{"device_id": device_id} for device_id in (1, 2)]),
+    ]:
+        for i in range(400):
+            for params in params_list:
+                expected = level_by_level(namespace, f"unit-{i}", **params)
+                tracking_group = namespace.get_group(f"unit-{i}", **params)
+                if expected is None:
+                    assert tracking_group is None
+                    continue
+
+                assert tracking_group.group_trace() == expected.group_trace()
+                assert tracking_group.experiment_trace() == expected.experiment_trace()
+                assert tracking_group.group_extra_params == expected.group_extra_params
+                assert tracking_group.exposure_sample_rate == expected.exposure_sample_rate
+
+    # 叶子分组的完整路径在编译时生成,同一个结果共用一个 ResultPath
+    tracking_groups = [namespace_item.get_group(f"unit-{i}") for i in range(400)]
+    paths = {tracking_group.path for tracking_group in tracking_groups if tracking_group}
+    assert None not in paths
+    assert len(paths) == len({(path.group_trace, path.experiment_trace) for path in paths})
+
+
+EVEN_USER = "lambda user_id, **ignore: user_id % 2 == 0"
+
+
+def windowed_namespace(windows, name="windowed"):
+    """windows: 实验名 -> (start_time, end_time)"""
+    return NamespaceItem(
+        name=name,
+        bucket=20,
+        experiment_items=[
+            ExperimentItem(
+                name=experiment_name,
+                bucket=6,
+                group_items=[GroupItem(f"{experiment_name}_a", 0.5), GroupItem(f"{experiment_name}_b", 0.5)],
+                pre_condition=eval(EVEN_USER) if experiment_name == "even" else None,
+                pre_condition_source=EVEN_USER if experiment_name == "even" else None,
+                start_time=start_time,
+                end_time=end_time,
+            )
+            for experiment_name, (start_time, end_time) in windows.items()
+        ],
+    )
+
+
+def test_time_windowed_experiments():
+    windows = {"always": (None, None), "promo": (100, 200), "even": (150, None)}
+    namespace_item = windowed_namespace(windows)
+    plan = export_namespace_plan(namespace_item)
+    for now in (0, 99.5, 100, 150, 199.9, 200, 1000, 120):
+        # 不在时间窗口内的实验与从 spec 里删掉一致
+        removed = windowed_namespace(
+            {item.name: (None, None) for item in namespace_item.experiment_items if item.is_active(now)}
+        )
+        for i in range(200):
+            unit, user_id = f"unit-{i}", i % 7
+            expected = removed.get_group(unit, user_id=user_id)
+            for tracking_group in (
+                namespace_item.get_group_memoized(unit, {"user_id": user_id}, None, now),
+                namespace_item._get_group(unit, encode_unit(unit), {"user_id": user_id}, None, now),
+            ):
+                assert (tracking_group and tracking_group.group_trace()) == (expected and expected.group_trace())
+
+            res = assign_from_plan(plan, unit, lambda ns, name, user_id=user_id: user_id % 2 == 0, now=now)
+            assert (res and res[1]) == (expected and [expected.last_group])
+
+    # 不在窗口内的带条件实验不做判断
+    assert [item.name for item in namespace_item.conditional_experiments(120)] == []
+    assert [item.name for item in namespace_item.conditional_experiments(160)] == ["even"]
+
+    assert NamespaceItem.from_dict(namespace_item.to_dict()).to_dict() == namespace_item.to_dict()
+    assert "start_time" not in namespace_item.experiment_items[0].to_dict()
+    with pytest.raises(ExperimentValidateError):
+        ExperimentItem("bad", 1, [GroupItem("bad_a", 1)], start_time=200, end_time=100)
+
+
+def edited_namespace(bucket=10, weights=(0.3, 0.7), extra_params=None, pre_condition=None, layer=None):
+    return NamespaceItem(
+        name="edited",
+        bucket=20,
+        validate_group_names=False,
+        experiment_items=[
+            ExperimentItem(
+                name="e",
+                bucket=bucket,
+                group_items=[
+                    GroupItem("a", weights[0], extra_params=extra_params),
+                    GroupItem("b", weights[1], layer_namespaces=layer),
+                ],
+                pre_condition=pre_condition,
+            ),
+            ExperimentItem(name="f", bucket=5, group_items=[GroupItem("c", 1)]),
+        ],
+    )
+
+
+def test_edits_after_first_assignment():
+    def groups(namespace_item):
+        res = []
+        for i in range(300):
+            tracking_group = namespace_item.get_group(f"unit-{i}", user_id=i % 4)
+            res.append(tracking_group and (tracking_group.group_trace(), tracking_group.group_extra_params))
+
+        return res
+
+    namespace_item = edited_namespace()
+    assert groups(namespace_item) == groups(edited_namespace())
+
+    # 重新赋值字段后,下次分组按修改后的实验树重新编译
+    experiment_item = namespace_item.experiment_items[0]
+    experiment_item.bucket = 15
+    experiment_item.group_items[0].weight, experiment_item.group_items[1].weight = 0.6, 0.4
+    experiment_item.group_items[0].extra_params = {"v": 2}
+    experiment_item.pre_condition = lambda user_id, **ignore: user_id > 1
+    assert groups(namespace_item) == groups(
+        edited_namespace(15, (0.6, 0.4), {"v": 2}, lambda user_id, **ignore: user_id > 1)
+    )
+
+    experiment_item.group_items[1].layer_namespaces = [deep_namespace(2)]
+    expected = groups(
+        edited_namespace(15, (0.6, 0.4), {"v": 2}, lambda user_id, **ignore: user_id > 1, [deep_namespace(2)])
+    )
+    assert groups(namespace_item) == expected
+    assert any(group and group[0].startswith("b.") for group in expected)
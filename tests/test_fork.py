@@ -0,0 +1,88 @@
+# ruff: noqa: PLR2004
+import json
+import os
+
+import pytest
+
+from outplan.client import ExperimentGroupClient
+from outplan.local import experiment_context
+
+from .test_client import simple_namespace
+
+pytestmark = pytest.mark.skipif(not hasattr(os, "fork"), reason="requires os.fork")
+
+
+class Worker:
+    def __init__(self):
+        self.restarts = 0
+
+    def reinit_after_fork(self):
+        self.restarts += 1
+
+    def track(self, **kwargs):
+        pass
+
+
+def run_in_child(func):
+    """在子进程里执行 func,返回它的 json 结果"""
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        try:
+            data = json.dumps(func())
+        except BaseException as e:
+            data = json.dumps({"error": repr(e)})
+        with os.fdopen(write_fd, "w") as f:
+            f.write(data)
+        os._exit(0)
+
+    os.close(write_fd)
+    with os.fdopen(read_fd) as f:
+        data = f.read()
+    os.waitpid(pid, 0)
+    return json.loads(data)
+
+
+def test_client_after_fork():
+    loaded = []
+
+    def lazy_load_it(namespace):
+        loaded.append(namespace)
+        return simple_namespace(namespace)
+
+    worker = Worker()
+    c = ExperimentGroupClient(
+        [],
+        lazy_load_namespaces_func=lambda: ["lazy_ns"],
+        lazy_load_namespace_item_func=lazy_load_it,
+        tracking_client=worker,
+        lazy_load_expire=1000,
+        fork_expire_jitter=0.5,
+    )
+    assert c.get_group("lazy_ns", unit="u", track=False) == "a"
+    expire_at = c.lazy_load_directory["lazy_ns"].expire_at
+    c.setup_experiment_context(user_id=1)
+    try:
+        # 父进程的锁被占用时 fork,子进程里也能正常更新
+        with c._registry_lock:
+            res = run_in_child(
+                lambda: {
+                    "context": list(experiment_context),
+                    "group": c.get_group("lazy_ns", unit="u", track=False),
+                    "loaded": loaded,
+                    "restarts": worker.restarts,
+                    "expire_shift": expire_at - c.lazy_load_directory["lazy_ns"].expire_at,
+                    "refreshed": c.refresh_key_expire_time("lazy_ns") is None,
+                }
+            )
+    finally:
+        c.release_context()
+
+    assert res["context"] == []
+    assert res["group"] == "a"
+    assert res["loaded"] == ["lazy_ns"]  # 子进程直接用父进程已经加载的 namespace
+    assert res["restarts"] == 1
+    assert 0 <= res["expire_shift"] <= 500
+    assert res["refreshed"]
+    assert worker.restarts == 0
@@ -0,0 +1,39 @@
+# ruff: noqa: PLR2004,E501
+import subprocess
+import sys
+
+# 冷启动导入的预算(微秒),留足余量,只为发现重新引入的重量级依赖
+IMPORT_BUDGET_US = 150_000
+
+
+def run_python(code, *options):
+    return subprocess.run([sys.executable, *options, "-c", code], capture_output=True, text=True, check=True)
+
+
+def test_import_does_not_load_planout():
+    code = "\n".join(
+        [
+            "import sys",
+            "import outplan",
+            "assert outplan.__version__",
+            "assert 'outplan.experiment' not in sys.modules",
+            "from outplan import ExperimentGroupClient, ExperimentItem, GroupItem, NamespaceItem",
+            "ns = NamespaceItem(name='n', experiment_items=[ExperimentItem(name='e', bucket=10, group_items=[GroupItem('a', 1)])])",
+            "assert ExperimentGroupClient([ns]).get_group('n', unit='u', track=False) == 'a'",
+            "heavy = {'planout', 'json'} & set(sys.modules)",
+            # 3.7 上 typing_extensions 的 Protocol 会导入 inspect
+            "heavy |= {'inspect'} & set(sys.modules) if sys.version_info >= (3, 8) else set()",
+            "assert not heavy, heavy",
+        ]
+    )
+    run_python(code)
+
+
+def test_import_time_budget():
+    result = run_python("import outplan.client", "-X", "importtime")
+    cumulative = 0
+    for line in result.stderr.splitlines():
+        parts = line.split("|")
+        if len(parts) == 3 and parts[2].strip() == "outplan.client":
+            cumulative = int(parts[1])
+    assert 0 < cumulative < IMPORT_BUDGET_US
@@ -0,0 +1,131 @@
+# ruff: noqa: PLR2004
+import copy
+import io
+import json
+
+import pytest
+
+from outplan.exceptions import ExperimentValidateError
+from outplan.experiment import NamespaceItem
+from outplan.loader import NamespaceLoader, SpecMemo
+
+from .test_experiment import (
+    auto_upper_namespace_spec_dict,
+    namespace_spec_dict,
+    tag_filter,
+    test_tag_namespace_spec_dict,
+)
+
+
+def shared_layer_spec(name):
+    return {
+        "name": name,
+        "experiment_items": [
+            {
+                "name": f"{name}_exp",
+                "bucket": 10,
+                "group_items": [
+                    {"name": f"{name}_g", "weight": 1, "layer_namespaces": [copy.deepcopy(namespace_spec_dict)]},
+                ],
+            }
+        ],
+    }
+
+
+def same_group(group_a, group_b):
+    if group_a is None or group_b is None:
+        return group_a is group_b
+
+    return (group_a.experiment_trace(), group_a.group_trace()) == (group_b.experiment_trace(), group_b.group_trace())
+
+
+def test_load_jsonl_memoizes_shared_layers():
+    lines = [json.dumps(shared_layer_spec(f"shared_{i}")) for i in range(3)]
+    lines.append("")
+    lines.append(json.dumps(namespace_spec_dict))
+
+    loader = NamespaceLoader()
+    items = list(loader.iter_jsonl(io.StringIO("\n".join(lines))))
+    assert [item.name for item in items] == ["shared_0", "shared_1", "shared_2", "namespace_2"]
+
+    # 三个 namespace 共用同一个嵌套的 namespace_2 对象
+    layers = [item.experiment_items[0].group_items[0].layer_namespaces[0] for item in items[:3]]
+    assert layers[0] is layers[1] is layers[2]
+    assert loader.memo.hits >= 2
+
+    expected = NamespaceItem.from_dict(namespace_spec_dict)
+    for i in range(200):
+        unit, user_id = f"unit-{i}", i % 30
+        group = items[0].get_group(unit, user_id=user_id)
+        assert same_group(items[3].get_group(unit, user_id=user_id), expected.get_group(unit, user_id=user_id))
+        if group:
+            assert group.group_names[-1] == "shared_0_g"
+
+
+def test_load_stream_formats():
+    loader = NamespaceLoader(tag_filter_func=tag_filter)
+    specs = [namespace_spec_dict, auto_upper_namespace_spec_dict, test_tag_namespace_spec_dict]
+
+    pretty = loader.load_stream(io.StringIO(json.dumps(specs, indent=2)))
+    one_line = loader.load_stream(io.StringIO(json.dumps(specs)))
+    single = loader.load_stream(io.StringIO(json.dumps(namespace_spec_dict, indent=2)))
+    assert [item.name for item in pretty] == [item.name for item in one_line] == [spec["name"] for spec in specs]
+    assert [item.name for item in single] == ["namespace_2"]
+    assert loader.load_stream(io.StringIO("\n\n")) == []
+
+    group = pretty[2].get_group(10, device_id=10)
+    assert (group.experiment_trace(), group.group_trace()) == ("t1.nn1e", "g1.ngg")
+
+
+def test_nested_group_names_validated_once():
+    spec = copy.deepcopy(namespace_spec_dict)
+    # 嵌套 namespace 里的 group name 与外层重复
+    layer = spec["experiment_items"][0]["group_items"][0]["layer_namespaces"][0]
+    layer["experiment_items"][0]["group_items"][0]["name"] = "h_ctl_2"
+
+    with pytest.raises(ExperimentValidateError):
+        NamespaceItem.from_dict(spec)
+
+    with pytest.raises(ExperimentValidateError):
+        NamespaceLoader().load_dict(spec)
+
+    # 单独构造嵌套 namespace 时依然会校验
+    nested = copy.deepcopy(layer)
+    nested["experiment_items"][0]["group_items"][1]["name"] = "h_ctl_2"
+    with pytest.raises(ExperimentValidateError):
+        NamespaceItem.from_dict(nested)
+
+
+def test_spec_memo_evicts_least_recently_used():
+    loader = NamespaceLoader(memo=SpecMemo(max_size=2))
+    specs = [
+        {
+            "name": f"memo_{i}",
+            "experiment_items": [{"name": "e", "bucket": 5, "group_items": [{"name": "g", "weight": 1}]}],
+        }
+        for i in range(3)
+    ]
+    first = loader.load_dict(specs[0])
+    loader.load_dict(specs[1])
+    # 用到过的 spec 不会先被淘汰
+    assert loader.load_dict(specs[0]) is first
+    loader.load_dict(specs[2])
+    assert len(loader.memo._items) == 2
+    assert loader.load_dict(specs[0]) is first
+    assert loader.load_dict(specs[1]) is not None
+    assert loader.memo.hits == 2
+
+
+def test_spec_memo_digests_do_not_outlive_from_dict():
+    memo = SpecMemo()
+    spec = {
+        "name": "memo_a",
+        "experiment_items": [{"name": "e", "bucket": 5, "group_items": [{"name": "g", "weight": 1}]}],
+    }
+    first = NamespaceItem.from_dict(spec, memo=memo)
+    # 同一个 id 换了内容,相当于 spec 释放后 id 被另一个 spec 复用
+    spec["name"] = "memo_b"
+    second = NamespaceItem.from_dict(spec, memo=memo)
+    assert (first.name, second.name) == ("memo_a", "memo_b")
+    assert NamespaceItem.from_dict(dict(spec), memo=memo) is second
+    assert not memo._digests
@@ -0,0 +1,51 @@
+# ruff: noqa: PLR2004
+import json
+import os
+import tempfile
+
+import pytest
+
+from outplan.loadtest import LoadTestConfig, main, run_load_test, synthetic_specs
+
+
+@pytest.mark.parametrize("mode", ["gevent", "threads", "processes"])
+def test_run_load_test(mode):
+    if mode == "processes" and not hasattr(os, "fork"):
+        pytest.skip("requires os.fork")
+
+    report = run_load_test(
+        LoadTestConfig(mode=mode, workers=3, requests=20, namespaces=2, loader_latency=0, sample_interval=0.01)
+    )
+    assert report["requests"] == 60
+    assert report["errors"] == 0
+    assert report["track_calls"] > 0
+    assert report["latency_ms"]["p50"] <= report["latency_ms"]["p99"] <= report["latency_ms"]["max"]
+    assert report["samples"][-1]["live_contexts"] == 0
+    if mode == "processes":
+        # 子进程直接用父进程预热好的 namespace
+        assert report["loader_calls"] == 0
+        assert report["warmup_loader_calls"] == 2
+    else:
+        assert report["listing_calls"] >= 1
+        assert report["loader_calls"] >= 2
+
+
+def test_load_test_leaks_and_spec_file(capsys):
+    path = os.path.join(tempfile.mkdtemp(), "namespaces.jsonl")
+    with open(path, "w") as f:
+        f.writelines(json.dumps(spec) + "\n" for spec in synthetic_specs(2))
+
+    report = main(["--mode", "threads", "--workers", "1", "--requests", "10", "--spec-file", path, "--leak-every", "5"])
+    assert json.loads(capsys.readouterr().out)["requests"] == 10
+    # 没有 release 的 context 在同一个线程里会被下一次 setup 覆盖,线程退出后被回收
+    assert report["samples"][-1]["live_contexts"] == 0
+
+
+@pytest.mark.parametrize("mode", ["gevent", "threads"])
+def test_lazy_load_single_flight(mode):
+    # 并发请求同一个还没加载的 namespace 时只调用一次 loader
+    report = run_load_test(
+        LoadTestConfig(mode=mode, workers=4, requests=5, namespaces=3, loader_latency=0.05, sample_interval=0.01)
+    )
+    assert report["errors"] == 0
+    assert report["loader_calls"] == 3
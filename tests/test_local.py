@@ -1,10 +1,11 @@
 # ruff: noqa: PLR2004,E501
+import gc
 import threading
 from multiprocessing import Pool
 
 import gevent
 
-from outplan.local import Local, greenlet_ident
+from outplan.local import Local, experiment_context, greenlet_ident
 
 
 class ThreadUnit(threading.Thread):
@@ -78,3 +79,105 @@ def test_get_greenlet_ident():
     gevent.joinall(gs)
 
     assert len(set(ids)) == N_THREADS
+
+
+def test_local_released_when_owner_collected():
+    leaky = Local()
+
+    def handler(n):
+        leaky.a = n
+        # 没有调用 release
+
+    gevent.joinall([gevent.spawn(handler, i) for i in range(10)])
+    gc.collect()
+    # gevent 内部可能还引用着最后一个 greenlet,sweep 时按已结束处理
+    assert leaky.stats()["live"] <= 1
+    leaky.sweep()
+    assert leaky.stats()["live"] == 0
+    assert leaky.stats()["collected"] == 10
+
+    threads = [ThreadUnit(leaky, i) for i in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    leaky.sweep()
+    assert leaky.stats()["live"] == 0
+
+
+def test_local_max_size_and_sweep():
+    bounded = Local(max_size=3)
+    bounded.a = "main"
+
+    def handler(n):
+        bounded.a = n
+        gevent.sleep(0.05)
+
+    # greenlet 都还活着,超过上限时不淘汰,只计数
+    gs = [gevent.spawn(handler, i) for i in range(4)]
+    gevent.sleep(0.01)
+    stats = bounded.stats()
+    assert stats["live"] == 5
+    assert stats["overflow"] == 2
+    assert bounded.a == "main"
+
+    # 结束的 greenlet 在下次新建存储时释放
+    gevent.joinall(gs)
+    gevent.spawn(handler, 5).join()
+    stats = bounded.stats()
+    assert (stats["live"], stats["overflow"], stats["collected"]) == (2, 2, 4)
+    bounded.sweep()
+    bounded.release()
+    assert bounded.stats()["live"] == 0
+
+
+def test_local_sweep_while_threads_write():
+    shared = Local(max_size=8)
+    errors = []
+    stop = threading.Event()
+
+    def sweeper():
+        while not stop.is_set():
+            try:
+                shared.sweep()
+                shared.release_other_processes()
+                shared.stats()
+            except Exception as e:
+                errors.append(e)
+
+    def writer(n):
+        for i in range(200):
+            shared.a = (n, i)
+            if i % 3 == 0:
+                shared.release()
+
+    sweeper_thread = threading.Thread(target=sweeper)
+    sweeper_thread.start()
+    writers = [threading.Thread(target=writer, args=(n,)) for n in range(8)]
+    for thread in writers:
+        thread.start()
+    for thread in writers:
+        thread.join()
+    stop.set()
+    sweeper_thread.join()
+    assert errors == []
+
+    shared.sweep()
+    stats = shared.stats()
+    assert stats["live"] == 0
+    assert stats["created"] == stats["released"] + stats["collected"]
+
+    # 模块级的 experiment_context 也可以设置上限
+    experiment_context.set_max_size(1)
+    try:
+        experiment_context.a = 1
+        thread = ThreadUnit(experiment_context, 2)
+        thread.start()
+        thread.join()
+        stats = experiment_context.stats()
+        assert (stats["max_size"], stats["live"], stats["overflow"]) == (1, 2, 1)
+        assert experiment_context.a == 1
+    finally:
+        experiment_context.set_max_size(None)
+        experiment_context.release()
+        experiment_context.sweep()
@@ -0,0 +1,157 @@
+# ruff: noqa: PLR2004
+import hashlib
+import json
+import os
+
+import pytest
+
+from outplan.client import ExperimentGroupClient
+from outplan.exceptions import ExperimentValidateError
+from outplan.experiment import ExperimentItem, GroupItem, NamespaceItem
+from outplan.plan import (
+    PLAN_VERSION,
+    assign_from_plan,
+    choice_thresholds,
+    encode_unit,
+    export_plan,
+    exposure_sampled,
+    planout_hash,
+    salt_hasher,
+    salted_hash,
+)
+
+from .test_experiment import HomepageNamespace, auto_upper_namespace_spec_dict, namespace_spec_dict
+
+GOLDEN_PLAN_PATH = os.path.join(os.path.dirname(__file__), "fixtures", "plan_v1.json")
+
+
+def load_golden_plan():
+    with open(GOLDEN_PLAN_PATH) as f:
+        return json.load(f)
+
+
+def test_export_plan_matches_golden_file():
+    # golden 文件就是其他运行时的测试用例,导出结果变化意味着分组结果变化
+    golden = load_golden_plan()
+    items = [NamespaceItem.from_dict(namespace_spec_dict), NamespaceItem.from_dict(auto_upper_namespace_spec_dict)]
+    plan = json.loads(json.dumps(export_plan(items)))
+
+    assert plan["version"] == golden["version"] == PLAN_VERSION
+    assert plan["namespaces"] == golden["namespaces"]
+
+
+def test_golden_vectors():
+    golden = load_golden_plan()
+    items = {
+        item.name: item
+        for item in [
+            NamespaceItem.from_dict(namespace_spec_dict),
+            NamespaceItem.from_dict(auto_upper_namespace_spec_dict),
+        ]
+    }
+    plans = {plan["name"]: plan for plan in golden["namespaces"]}
+
+    for vector in golden["test_vectors"]:
+        tracking_group = items[vector["namespace"]].get_group(vector["unit"], **vector["params"])
+        assert (vector["experiment_trace"], vector["group_trace"]) == (
+            (tracking_group.experiment_trace(), tracking_group.group_trace()) if tracking_group else (None, None)
+        )
+
+        eligible = {tuple(pair) for pair in vector["eligible"]}
+        res = assign_from_plan(
+            plans[vector["namespace"]], vector["unit"], lambda namespace, exp: (namespace, exp) in eligible
+        )
+        if res is None:
+            assert vector["group_trace"] is None
+        else:
+            assert (".".join(res[0]), ".".join(res[1])) == (vector["experiment_trace"], vector["group_trace"])
+
+
+def test_assign_from_plan_matches_get_group():
+    plan = export_plan([HomepageNamespace])["namespaces"][0]
+    conditions = {}
+
+    def collect(namespace_item):
+        for experiment_item in namespace_item.experiment_items:
+            conditions[(namespace_item.name, experiment_item.name)] = experiment_item
+            for group_item in experiment_item.group_items:
+                for namespace in group_item.layer_namespaces:
+                    collect(namespace)
+
+    collect(HomepageNamespace)
+
+    for i in range(500):
+        unit, user_id = f"unit-{i}", i % 30
+        expected = HomepageNamespace.get_group(unit, user_id=user_id)
+        res = assign_from_plan(
+            plan, unit, lambda namespace, exp: conditions[(namespace, exp)].is_eligible(user_id=user_id)
+        )
+        if expected is None:
+            assert res is None
+        else:
+            assert (".".join(res[0]), ".".join(res[1])) == (expected.experiment_trace(), expected.group_trace())
+            assert res[2] == expected.group_extra_params
+
+        # use_fast_sample 的 segment 分配不同,查 fast_segment_tables
+        expected = HomepageNamespace.get_group(unit, user_id=user_id, use_fast_sample=True)
+        res = assign_from_plan(
+            plan, unit, lambda namespace, exp: conditions[(namespace, exp)].is_eligible(user_id=user_id), fast=True
+        )
+        assert (res and (".".join(res[0]), ".".join(res[1]))) == (
+            expected and (expected.experiment_trace(), expected.group_trace())
+        )
+
+
+def test_choice_thresholds():
+    assert choice_thresholds([1]) == [0xFFFFFFFFFFFFFFF]
+    # weight 为 0 的分组只有 hash 为 0 时才会命中,与 planout 一致
+    assert choice_thresholds([0, 1])[0] == 0
+    thresholds = choice_thresholds([0.2, 0.8])
+    assert thresholds[0] < thresholds[1] == 0xFFFFFFFFFFFFFFF
+    assert planout_hash("namespace_1.segment.", "abc") == 0xAE0F376D5DBDD0A
+
+
+def test_salted_hash_matches_planout_hash():
+    hasher = salt_hasher("namespace_1.homepage_exp.group.")
+    for unit in ["", "abc", "ABC-12345", 12345, 0]:
+        expected = int(hashlib.sha1(f"namespace_1.homepage_exp.group.{unit}".encode("ascii")).hexdigest()[:15], 16)
+        assert (
+            salted_hash(hasher, encode_unit(unit)) == planout_hash("namespace_1.homepage_exp.group.", unit) == expected
+        )
+
+
+def test_exposure_sampled_is_nested():
+    units = [encode_unit(f"unit-{i}") for i in range(2000)]
+    low = {unit for unit in units if exposure_sampled(unit, 0.1)}
+    high = {unit for unit in units if exposure_sampled(unit, 0.5)}
+    # 采样率低的 unit 集合是采样率高的子集
+    assert low < high
+    assert abs(len(low) / len(units) - 0.1) < 0.03
+    assert all(exposure_sampled(unit, 1) for unit in units)
+
+
+def test_export_plan_limits_conditional_experiments():
+    namespace = NamespaceItem(
+        name="many_conditions",
+        bucket=100,
+        experiment_items=[
+            ExperimentItem(
+                name=f"exp_{i}",
+                bucket=1,
+                group_items=[GroupItem(name=f"g_{i}", weight=1)],
+                pre_condition=lambda **ignore: True,
+            )
+            for i in range(3)
+        ],
+    )
+    assert len(export_plan([namespace])["namespaces"][0]["segment_tables"]) == 7
+
+    with pytest.raises(ExperimentValidateError):
+        export_plan([namespace], max_conditional_experiments=2)
+
+
+def test_client_export_plan():
+    c = ExperimentGroupClient([HomepageNamespace])
+    plan = c.export_plan(test_units=["a", "b"], test_params=[{"user_id": 1}])
+    assert [namespace["name"] for namespace in plan["namespaces"]] == ["namespace_1"]
+    assert len(plan["test_vectors"]) == 2
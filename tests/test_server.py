@@ -0,0 +1,104 @@
+# ruff: noqa: PLR2004
+import os
+import tempfile
+from collections import defaultdict
+
+import pytest
+
+from outplan.client import ExperimentGroupClient
+from outplan.exceptions import AssignmentServerError
+from outplan.experiment import NamespaceItem
+from outplan.server import AssignmentClient, AssignmentServer
+
+from .test_experiment import HomepageNamespace, client, namespace_spec_dict
+
+
+def trace(tracking_group):
+    return tracking_group.experiment_trace(), tracking_group.group_trace()
+
+
+@pytest.fixture
+def tcp_server():
+    server = AssignmentServer(client, ("127.0.0.1", 0))
+    server.start()
+    yield server
+    server.close()
+
+
+def test_assignment_server_tcp(tcp_server):
+    c = AssignmentClient(tcp_server.server_address, pool_size=2)
+
+    groups = c.get_tracking_groups(["namespace_1", "namespace_2", "not_exists"], unit="12345", user_id=1, track=False)
+    assert trace(groups[0]) == trace(client.get_tracking_group("namespace_1", unit="12345", user_id=1, track=False))
+    assert trace(groups[1]) == ("homepage_exp_2.clt_p9_2", "collect_2.c9-a1-2")
+    assert groups[2] is None
+
+    group = c.get_tracking_groups(["namespace_1"], unit="add", user_id=15, track=False)[0]
+    assert trace(group) == ("homepage_exp.clt_p8.clt_p8_2", "collect.c8-a0.clt_p8_2_a1")
+    assert group.last_group == "clt_p8_2_a1"
+    assert group.group_extra_params == "extra params"
+
+    assert c.get_groups(["namespace_1"], unit="12345", user_id=1, track=False) == ["c9-a0"]
+
+    requests = [c.make_request(["namespace_1"], unit=f"unit-{i}", user_id=i % 30, track=False) for i in range(50)]
+    expected = [HomepageNamespace.get_group(request["unit"], user_id=request["user_id"]) for request in requests]
+    for res in (c.batch(requests), c.pipeline(requests)):
+        assert [trace(items[0]) if items[0] else None for items in res] == [
+            trace(group) if group else None for group in expected
+        ]
+
+    # 连接被复用
+    assert c._pool.qsize() == 1
+
+    with pytest.raises(AssignmentServerError):
+        c.batch([{"unit": "no namespaces"}])
+
+    c.close()
+    assert c._pool.qsize() == 0
+
+
+def test_large_pipeline():
+    address = os.path.join(tempfile.mkdtemp(), "outplan.sock")
+    server = AssignmentServer(client, address)
+    server.start()
+    try:
+        c = AssignmentClient(address, timeout=5, pipeline_depth=16)
+        # 请求和返回的总量都远大于 socket 缓冲区,一次写完再读会互相等待
+        requests = [
+            c.make_request(["namespace_1"] * 20, unit=f"unit-{i}", user_id=i % 30, track=False, padding="x" * 1024)
+            for i in range(1000)
+        ]
+        res = c.pipeline(requests)
+        assert [trace(items[-1]) if items[-1] else None for items in res] == [
+            trace(group) if group else None
+            for group in (HomepageNamespace.get_group(f"unit-{i}", user_id=i % 30) for i in range(1000))
+        ]
+        c.close()
+    finally:
+        server.close()
+
+
+def test_assignment_server_unix_lazy_load():
+    lazy_load_cnt = defaultdict(int)
+
+    def lazy_load_it(namespace):
+        lazy_load_cnt[namespace] += 1
+        return NamespaceItem.from_dict(namespace_spec_dict)
+
+    lazy_client = ExperimentGroupClient(
+        [], lazy_load_namespaces_func=lambda: ["namespace_2"], lazy_load_namespace_item_func=lazy_load_it
+    )
+    address = os.path.join(tempfile.mkdtemp(), "outplan.sock")
+    server = AssignmentServer(lazy_client, address)
+    server.start()
+    try:
+        c = AssignmentClient(address)
+        for _ in range(3):
+            assert c.get_groups(["namespace_2"], unit="12345", user_id=1, track=False) == ["c9-a1-2"]
+
+        assert lazy_load_cnt["namespace_2"] == 1
+        c.close()
+    finally:
+        server.close()
+
+    assert not os.path.exists(address)
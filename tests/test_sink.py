@@ -0,0 +1,105 @@
+# ruff: noqa: PLR2004
+import glob
+import os
+import tempfile
+import time
+
+import pytest
+
+from outplan.client import ExperimentGroupClient
+from outplan.sink import FORMAT_BINARY, FORMAT_JSONL, FileExposureSink, read_records
+
+from .test_client import simple_namespace
+
+
+@pytest.mark.parametrize("fmt", [FORMAT_JSONL, FORMAT_BINARY])
+def test_exposure_sink_writes_client_events(fmt):
+    path = os.path.join(tempfile.mkdtemp(), "exposure.{pid}.log")
+    sink = FileExposureSink(path, fmt=fmt, flush_interval=0.01, flush_events=10)
+    c = ExperimentGroupClient([simple_namespace("sink_ns")], tracking_client=sink)
+    sink.start()
+    try:
+        for i in range(25):
+            c.get_group("sink_ns", unit=f"u{i}", user_id=i + 1, pdid=f"设备-{i}")
+    finally:
+        sink.stop()
+
+    records = list(read_records(sink.path))
+    assert [record.user_id for record in records] == list(range(1, 26))
+    assert records[0].pdid == "设备-0"
+    assert records[0].event_name == "user_experiment_group_info"
+    assert records[0].properties == {"experiment": "sink_ns_exp", "group": "a"}
+    assert sink.stats()["dropped"] == 0
+
+
+def test_exposure_sink_rotation_and_partial_record():
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, "exposure.bin")
+    sink = FileExposureSink(path, fmt=FORMAT_BINARY, max_bytes=200, rotate_interval=None)
+    for i in range(10):
+        sink.track(i, f"d{i}", "event", {"i": i})
+        sink.flush()
+
+    # 按大小切分,每个改名后的文件都是完整的记录
+    assert sink.rotations >= 2
+    rotated = sorted(glob.glob(path + ".*"), key=lambda name: int(name.rsplit(".", 1)[1]))
+    assert len(rotated) == sink.rotations
+    records = [record for name in rotated for record in read_records(name)]
+    if os.path.exists(path):
+        records += list(read_records(path))
+    assert [record.properties["i"] for record in records] == list(range(10))
+
+    # 写了一半的记录被忽略
+    complete = len(list(read_records(rotated[0])))
+    with open(rotated[0], "rb") as f:
+        data = f.read()
+    with open(rotated[0], "wb") as f:
+        f.write(data[:-3])
+    assert len(list(read_records(rotated[0]))) == complete - 1
+
+    # 按时间切分,空文件不切
+    sink = FileExposureSink(os.path.join(directory, "timed.jsonl"), rotate_interval=0.05)
+    sink.track(1, "d", "event")
+    sink.flush()
+    time.sleep(0.06)
+    sink.flush()
+    assert sink.rotations == 1
+    sink.flush()
+    assert sink.rotations == 1
+    sink.stop()
+
+
+def test_exposure_sink_buffer_limit():
+    sink = FileExposureSink(os.path.join(tempfile.mkdtemp(), "exposure.jsonl"), max_buffer=3)
+    for i in range(5):
+        sink.track(i, "", "event")
+    assert sink.stats()["dropped"] == 2
+    assert sink.flush() == 3
+    sink.stop()
+
+
+def test_exposure_sink_partial_jsonl_and_manual_rotate():
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, "exposure.jsonl")
+    sink = FileExposureSink(path, flush_interval=0.001, rotate_interval=None)
+    sink.start()
+    # 手动切分和后台写入同时进行
+    for i in range(300):
+        sink.track(i, "d", "event", {"i": i})
+        if i % 50 == 0:
+            sink.rotate()
+    sink.stop()
+
+    names = sorted(glob.glob(path + ".*"), key=lambda name: int(name.rsplit(".", 1)[1]))
+    if os.path.exists(path):
+        names.append(path)
+    records = [record for name in names for record in read_records(name)]
+    assert sorted(record.properties["i"] for record in records) == list(range(300))
+
+    # 刚好在 properties 之后截断,最后一行仍以 } 结尾
+    with open(names[-1], "rb") as f:
+        data = f.read()
+    complete = len(list(read_records(names[-1])))
+    with open(names[-1], "wb") as f:
+        f.write(data[: data.rindex(b"}}") + 1])
+    assert len(list(read_records(names[-1]))) == complete - 1
@@ -0,0 +1,105 @@
+# ruff: noqa: PLR2004
+import copy
+import json
+import os
+import tempfile
+import time
+
+from outplan.client import ExperimentGroupClient
+from outplan.source import FileNamespaceSource
+
+from .test_experiment import auto_upper_namespace_spec_dict, namespace_spec_dict
+from .test_fork import run_in_child
+
+
+def write_spec(path, specs, mtime):
+    # 和线上推送配置一样先写临时文件再 rename,避免读到写了一半的文件
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        for spec in specs:
+            f.write(json.dumps(spec) + "\n")
+
+    os.utime(tmp_path, (mtime, mtime))
+    os.replace(tmp_path, path)
+
+
+def wait_for(predicate, timeout=3.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.01)
+    return False
+
+
+class Logger:
+    def __init__(self):
+        self.errors = []
+
+    def info(self, msg):
+        pass
+
+    def error(self, msg):
+        self.errors.append(msg)
+
+
+def test_file_namespace_source_hot_reload():
+    path = os.path.join(tempfile.mkdtemp(), "namespaces.jsonl")
+    write_spec(path, [namespace_spec_dict], mtime=1000)
+
+    logger = Logger()
+    source = FileNamespaceSource(path, poll_interval=0.01, logger=logger)
+    c = ExperimentGroupClient([], namespace_source=source)
+    c.release_context()
+    assert c.get_group("namespace_2", unit="add", user_id=15, track=False) == "h_ctl_2"
+    assert source.reload() is False
+
+    source.start()
+    try:
+        renamed = copy.deepcopy(namespace_spec_dict)
+        renamed["experiment_items"][1]["group_items"][0]["name"] = "h_ctl_3"
+        write_spec(path, [renamed, auto_upper_namespace_spec_dict], mtime=2000)
+        assert wait_for(lambda: source.reload_count == 2)
+        assert c.get_group("namespace_2", unit="add", user_id=15, track=False) == "h_ctl_3"
+        assert c.get_group("auto_upper_namespace2", unit="abc", track=False) is not None
+
+        # 写坏的文件不影响已加载的 namespace,文件不变时只报错一次
+        with open(path + ".tmp", "w") as f:
+            f.write("{broken")
+        os.utime(path + ".tmp", (3000, 3000))
+        os.replace(path + ".tmp", path)
+        time.sleep(0.1)
+        assert source.reload_count == 2
+        assert len(logger.errors) == 1
+        assert c.get_group("namespace_2", unit="add", user_id=15, track=False) == "h_ctl_3"
+
+        write_spec(path, [namespace_spec_dict], mtime=4000)
+        assert wait_for(lambda: source.reload_count == 3)
+        assert c.get_group("namespace_2", unit="add", user_id=15, track=False) == "h_ctl_2"
+
+        # fork 之后子进程里重新启动后台线程
+        if hasattr(os, "fork"):
+            old_thread = source._thread
+            res = run_in_child(
+                lambda: {"restarted": source._thread is not old_thread, "alive": source._thread.is_alive()}
+            )
+            assert res == {"restarted": True, "alive": True}
+            assert source._thread is old_thread
+    finally:
+        source.stop()
+
+
+def test_file_namespace_source_directory():
+    directory = tempfile.mkdtemp()
+    write_spec(os.path.join(directory, "a.jsonl"), [namespace_spec_dict], mtime=1000)
+    with open(os.path.join(directory, "b.json"), "w") as f:
+        json.dump([auto_upper_namespace_spec_dict], f, indent=2)
+    with open(os.path.join(directory, "ignored.txt"), "w") as f:
+        f.write("not a spec")
+
+    source = FileNamespaceSource(directory)
+    assert sorted(source.namespaces) == ["auto_upper_namespace2", "namespace_2"]
+
+    os.remove(os.path.join(directory, "b.json"))
+    assert source.reload() is True
+    assert sorted(source.namespaces) == ["namespace_2"]
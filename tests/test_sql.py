@@ -0,0 +1,126 @@
+# ruff: noqa: PLR2004
+import hashlib
+import sqlite3
+
+import pytest
+
+from outplan.exceptions import SqlCompileError
+from outplan.experiment import ExperimentItem, GroupItem, NamespaceItem
+from outplan.sql import DIALECTS, pre_condition_sql
+
+from .test_experiment import (
+    HomepageNamespace,
+    auto_upper_namespace_spec_dict,
+    namespace_spec_dict,
+    tag_filter,
+    test_tag_namespace_spec_dict,
+)
+from .test_flatten import windowed_namespace
+
+
+def connect(rows):
+    conn = sqlite3.connect(":memory:")
+    conn.create_function("sha1", 1, lambda s: hashlib.sha1(s.encode("ascii")).hexdigest())
+    conn.create_function("hex_to_int", 1, lambda s: int(s, 16))
+    conn.execute("CREATE TABLE units (unit, user_id INTEGER, device_id INTEGER)")
+    conn.executemany("INSERT INTO units VALUES (?, ?, ?)", rows)
+    return conn
+
+
+def expected_traces(namespace_item, unit, **params):
+    tracking_group = namespace_item.get_group(unit, **params)
+    if tracking_group is None:
+        return (None, None, None)
+
+    return (tracking_group.last_group, tracking_group.group_trace(), tracking_group.experiment_trace())
+
+
+OUTPUTS = ["group_name", "group_trace", "experiment_trace"]
+
+
+@pytest.mark.parametrize("hex_to_int", [False, True])
+def test_sql_matches_get_group(hex_to_int):
+    namespace_item = NamespaceItem.from_dict(namespace_spec_dict)
+    # 有十六进制转整数函数的方言直接取模,否则逐位计算
+    dialect = DIALECTS["sqlite"]._replace(hex_to_int="hex_to_int({})" if hex_to_int else None)
+    rows = [(f"unit-{i}", i % 30, 0) for i in range(600)] + [(i, 5, 0) for i in range(1, 100)]
+    conn = connect(rows)
+
+    query = namespace_item.to_sql(dialect).query("units", outputs=OUTPUTS, columns=["unit", "user_id"])
+    results = conn.execute(query).fetchall()
+    assert len(results) == len(rows)
+    assert len({row[2] for row in results}) > 5
+    for unit, user_id, *traces in results:
+        assert tuple(traces) == expected_traces(namespace_item, unit, user_id=user_id)
+
+
+def test_sql_expression_with_conditions_and_upper_unit():
+    # 标签没法翻译,由调用方给出 SQL 条件
+    namespace_item = NamespaceItem.from_dict(test_tag_namespace_spec_dict, tag_filter_func=tag_filter)
+    with pytest.raises(SqlCompileError):
+        namespace_item.to_sql()
+
+    conditions = {("nn1", "nn1e"): "device_id % 2 = 0", ("nn2", "nn2e"): "device_id % 2 = 0"}
+    expression = namespace_item.to_sql(conditions=conditions).expression("group_trace")
+    conn = connect([(f"u{i}", 1, i % 3) for i in range(200)])
+    for unit, device_id, group_trace in conn.execute(f"SELECT unit, device_id, {expression} FROM units"):
+        assert group_trace == expected_traces(namespace_item, unit, device_id=device_id)[1]
+
+    namespace_item = NamespaceItem.from_dict(auto_upper_namespace_spec_dict)
+    conn = connect([(f"pdid-{i}-x", 0, 0) for i in range(200)])
+    expression = namespace_item.to_sql(unit="unit").expression()
+    for unit, group_name in conn.execute(f"SELECT unit, {expression} FROM units"):
+        assert group_name == expected_traces(namespace_item, unit.upper())[0]
+
+
+def test_sql_time_windows():
+    namespace_item = windowed_namespace({"always": (None, None), "promo": (100, 200), "even": (150, None)})
+    # 时间戳列按行判断窗口,device_id 列存时间戳
+    rows = [(f"u{i}", i % 7, (0, 120, 160, 250)[i % 4]) for i in range(400)]
+    expression = namespace_item.to_sql(now="device_id").expression("group_trace")
+    for unit, user_id, now, group_trace in connect(rows).execute(
+        f"SELECT unit, user_id, device_id, {expression} FROM units"
+    ):
+        expected = namespace_item.get_group_memoized(unit, {"user_id": user_id}, None, now)
+        assert group_trace == (expected and expected.group_trace())
+
+    # 不传时按编译时的时间判断,SQL 里不带时间条件
+    compiler = namespace_item.to_sql()
+    assert ">= 150" in expression and ">= 150" not in compiler.expression()
+    for unit, user_id, group_name in connect(rows).execute(f"SELECT unit, user_id, {compiler.expression()} FROM units"):
+        assert group_name == expected_traces(namespace_item, unit, user_id=user_id)[0]
+
+
+def test_pre_condition_sql():
+    assert pre_condition_sql("lambda user_id, **ignore: 10 <= user_id < 15") == "((10 <= user_id) AND (user_id < 15))"
+    assert (
+        pre_condition_sql("lambda level=None, **params: level in ('vip', 'svip') and params.get('city') is not None")
+        == "((COALESCE(level, NULL) IN ('vip', 'svip')) AND (city IS NOT NULL))"
+    )
+    assert (
+        pre_condition_sql("lambda **params: not params['uid'] % 2 == 1", "bigquery", columns={"uid": "t.user_id"})
+        == "(NOT (MOD((MOD(t.user_id, 2) + 2), 2) = 1))"
+    )
+
+    for source in ["lambda user_id, **ignore: user_id", "lambda **ignore: len(ignore) > 1", "lambda x: x < LIMIT"]:
+        with pytest.raises(SqlCompileError):
+            pre_condition_sql(source)
+
+    # 代码里定义的 pre_condition 没有源码
+    with pytest.raises(SqlCompileError):
+        HomepageNamespace.to_sql()
+
+
+def test_sql_compiles_for_all_dialects():
+    namespace_item = NamespaceItem(
+        name="dialects",
+        bucket=100,
+        experiment_items=[
+            ExperimentItem(name="e", bucket=60, group_items=[GroupItem("a", 0.3), GroupItem("b", 0.7)]),
+        ],
+    )
+    for name, dialect in DIALECTS.items():
+        query = namespace_item.to_sql(name, unit="user_id").query("users")
+        assert dialect.sha1_hex.split("(")[0] in query
+        # 有十六进制转整数函数时不需要逐位计算
+        assert (dialect.position.split("(")[0] in query) == (dialect.hex_to_int is None)
@@ -0,0 +1,83 @@
+# ruff: noqa: PLR2004
+import threading
+import time
+
+from outplan.client import ExperimentGroupClient
+from outplan.concurrency import ThreadExecutor
+from outplan.const import UserTagFilterType
+from outplan.exceptions import ExecutorTimeoutError
+from outplan.experiment import ExperimentItem, GroupItem, NamespaceItem
+from outplan.local import experiment_context
+
+
+def test_thread_executor_map_short_circuit():
+    executor = ThreadExecutor(max_workers=3, timeout=0.3)
+    calls = []
+    release = threading.Event()
+
+    def check(name, result, seconds=0.0):
+        def run():
+            calls.append(name)
+            release.wait(seconds)
+            if isinstance(result, Exception):
+                raise result
+            return result
+
+        return run
+
+    try:
+        start = time.time()
+        outcomes = executor.map_short_circuit(
+            [
+                # AND:有一个 False 就结束,不等还在执行的判断
+                ([check("and_slow", True, 5), check("and_false", False), check("and_queued", True)], False),
+                ([check("or_true", True)], True),
+                ([], False),
+            ]
+        )
+        assert time.time() - start < 0.3
+        assert [outcome.value for outcome in outcomes] == [False, True, True]
+
+        outcomes = executor.map_short_circuit(
+            [([check("timeout", True, 5)], False), ([check("error", ValueError("tag service down"))], True)]
+        )
+        assert isinstance(outcomes[0].error, ExecutorTimeoutError)
+        assert isinstance(outcomes[1].error, ValueError)
+    finally:
+        release.set()
+        executor.shutdown()
+
+
+def test_client_checks_tags_on_thread_pool():
+    def tag_filter(experiment_name, tag_id, user_tag_columns, device_id, **ignore):
+        time.sleep(0.2)
+        # 线程池里也能读到请求的 context
+        return experiment_context.user_id == 1 and device_id % tag_id == 0
+
+    experiment_items = []
+    for i, tag_ids in enumerate([(2, 3, 5), (7, 11)]):
+        experiment_item = ExperimentItem(
+            name=f"tags_{i}",
+            bucket=5,
+            group_items=[GroupItem(f"g_{i}", 1)],
+            user_tags=[{"id": tag_id, "columns": [], "not_in": tag_id == 5} for tag_id in tag_ids],
+            tag_filter_func=tag_filter,
+        )
+        experiment_items.append(experiment_item)
+    experiment_items[1].tag_filter_type = UserTagFilterType.OR
+    namespace = NamespaceItem(name="thread_tags", experiment_items=experiment_items)
+
+    executor = ThreadExecutor(max_workers=8, timeout=1)
+    c = ExperimentGroupClient([namespace], executor=executor)
+    try:
+        for device_id in (6, 30, 77):
+            c.setup_experiment_context(user_id=1)
+            try:
+                start = time.time()
+                group = c.get_group("thread_tags", unit="u", track=False, cache=False, device_id=device_id)
+                assert time.time() - start < 0.5
+                assert group == namespace.get_group("u", device_id=device_id)
+            finally:
+                c.release_context()
+    finally:
+        executor.shutdown()